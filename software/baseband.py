@@ -0,0 +1,571 @@
+"""
+Tools for ALBATROS baseband data, used by the dumper and offline.
+
+Only needs numpy, so it can be used on analysis machines that don't have
+casperfpga, pcapy or a GPS attached.
+"""
+import collections
+import os
+import time
+import warnings
+import numpy as np
+
+def _make_4bit_luts():
+    """Tables mapping every byte to its (re, im) pair. The high nibble is the
+    real part, the low nibble the imaginary part, both two's complement."""
+    byte = np.arange(256, dtype=np.uint8)
+    re = np.asarray(byte >> 4, dtype=np.int8)
+    im = np.asarray(byte & 0x0f, dtype=np.int8)
+    re[re > 8] -= 16
+    im[im > 8] -= 16
+    lut_int8 = np.ascontiguousarray(np.stack([re, im], axis=-1))
+    lut_complex64 = np.asarray(re + 1J*im, dtype=np.complex64)
+    return lut_int8, lut_complex64
+
+LUT_4BIT_INT8, LUT_4BIT_COMPLEX64 = _make_4bit_luts()
+LUT_4BIT_COMPLEX128 = np.asarray(LUT_4BIT_COMPLEX64, dtype=np.complex128)
+
+def _as_bytes_array(buf):
+    if isinstance(buf, np.ndarray):
+        if buf.dtype != np.uint8:
+            buf = buf.view(np.uint8)
+        return buf
+    return np.frombuffer(buf, dtype=np.uint8)
+
+def unpack_4bit(buf, out=None, dtype="complex64"):
+    """
+    Unpack 4-bit complex samples with a 256-entry lookup table.
+
+    :param buf: Raw bytes, or a uint8 array of any shape, e.g. (npacket, nbyte)
+        to unpack many packets at once. Strided views are fine.
+    :param out: Optional preallocated output. Must have buf's shape for complex
+        output, or buf's shape plus a trailing axis of 2 (re, im) for int8.
+    :param dtype: "complex64", "complex128" or "int8".
+
+    :return: Unpacked samples, written into out if one was given.
+    """
+    raw = _as_bytes_array(buf)
+    # every byte is a valid index, mode="wrap" just stops np.take buffering out
+    if dtype == "int8":
+        return np.take(LUT_4BIT_INT8, raw, axis=0, out=out, mode="wrap")
+    if dtype == "complex64":
+        return np.take(LUT_4BIT_COMPLEX64, raw, out=out, mode="wrap")
+    if dtype == "complex128":
+        return np.take(LUT_4BIT_COMPLEX128, raw, out=out, mode="wrap")
+    raise ValueError(f"dtype must be complex64, complex128 or int8, not {dtype}")
+
+def unpack_4bit_packets(packets, spec_per_packet, out=None, dtype="complex64"):
+    """
+    Unpack a block of 4-bit baseband packet payloads at once.
+
+    :param packets: (npacket, bytes_per_packet) uint8 array of UDP payloads,
+        each a big-endian uint32 spectrum number followed by the spectra.
+    :param spec_per_packet: Number of spectra in each packet.
+    :param out: Optional preallocated C-contiguous output, see return shape.
+    :param dtype: "complex64", "complex128" or "int8".
+
+    :return: specno, (npacket,) uint32; data, (npacket*spec_per_packet, nchan, 2)
+        with pol0/pol1 on the last axis, plus a trailing (re, im) axis for int8.
+    """
+    packets = _as_bytes_array(packets)
+    npacket = packets.shape[0]
+    specno = packets[:, :4].copy().view(">u4")[:, 0].astype(np.uint32)
+    payload = packets[:, 4:]
+    nchan = payload.shape[1] // spec_per_packet // 2
+    # splitting the payload axis keeps this a view of packets, no copy
+    payload = payload.reshape(npacket, spec_per_packet, nchan, 2)
+    shape = (npacket * spec_per_packet, nchan, 2) + ((2,) if dtype == "int8" else ())
+    if out is None:
+        out = np.empty(shape, dtype=np.int8 if dtype == "int8" else dtype)
+    unpack_4bit(payload, out=out.reshape((npacket, spec_per_packet) + shape[1:]), dtype=dtype)
+    return specno, out
+
+def _index_runs(idx):
+    """Split idx into runs of consecutive values, as (out start, out stop, idx start, idx stop)."""
+    idx = np.asarray(idx, dtype=np.int64)
+    if len(idx) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(idx) != 1) + 1
+    starts = np.concatenate([[0], breaks])
+    stops = np.concatenate([breaks, [len(idx)]])
+    return [(int(a), int(b), int(idx[a]), int(idx[b-1]) + 1) for a, b in zip(starts, stops)]
+
+def unpack_channels(raw, idx, pol=None, out=None, dtype="complex64"):
+    """
+    Unpack only some channels of 4-bit baseband.
+
+    Each run of consecutive channel indices is a strided view of raw, so the
+    bytes of the other channels are never touched, let alone decoded.
+
+    :param raw: (npacket, spec_per_packet, nchan, 2) uint8 payloads, e.g. from
+        BasebandFile.raw or a packet block reshaped.
+    :param idx: Channel indices (positions, not channel numbers) to unpack.
+    :param pol: 0 or 1 for one polarisation, None for both.
+    :param out: Optional preallocated output, see return shape.
+    :param dtype: "complex64", "complex128" or "int8".
+
+    :return: (npacket*spec_per_packet, len(idx)) plus a trailing pol axis if
+        pol is None, plus a trailing (re, im) axis for int8.
+    """
+    if pol is not None:
+        raw = raw[..., pol]
+    npacket, spec_per_packet = raw.shape[:2]
+    shape = (npacket*spec_per_packet, len(idx)) + raw.shape[3:] + ((2,) if dtype == "int8" else ())
+    if out is None:
+        out = np.empty(shape, dtype=np.int8 if dtype == "int8" else dtype)
+    out4 = out.reshape((npacket, spec_per_packet) + shape[1:])
+    for a, b, c0, c1 in _index_runs(idx):
+        unpack_4bit(raw[:, :, c0:c1], out=out4[:, :, a:b], dtype=dtype)
+    return out
+
+LOSS_MAP_SUFFIX = ".loss"
+
+class LossTracker():
+    """
+    Tracks spectrum number continuity packet by packet, a block at a time.
+
+    Spectrum numbers are uint32 and wrap, so they are unwrapped into int64.
+    Every packet whose specno isn't spec_per_packet after the previous one's
+    is a gap, recorded as (packet index in file, expected specno, npacket)
+    where npacket is the number of packets missing there. It is negative when
+    the counter went backwards (duplicated or reordered packets).
+    """
+    def __init__(self, spec_per_packet, window=60.):
+        """
+        :param spec_per_packet: Spectra per packet, the expected specno step.
+        :param window: Length in seconds of the window for `rolling_loss`.
+        """
+        self.spec_per_packet = spec_per_packet
+        self.window = window
+        self.last = None # unwrapped specno of the last packet seen
+        self.history = collections.deque()
+        self.total_packets = 0
+        self.total_missing = 0
+        self.start_file()
+
+    def start_file(self):
+        """Reset the per-file counters and gap list."""
+        self.npacket = 0
+        self.nmissing = 0
+        self.nreordered = 0
+        self.first = None
+        self.gaps = []
+
+    def update(self, specno, now=None):
+        """
+        :param specno: Spectrum numbers of a block of packets, uint32 or
+            big-endian '>u4' as found in the packets.
+        :return: Net number of packets missing before and within this block.
+        """
+        specno = np.asarray(specno, dtype=np.uint32)
+        n = len(specno)
+        if n == 0:
+            return 0
+        spp = self.spec_per_packet
+        if self.last is None:
+            self.last = int(specno[0]) - spp
+        # uint32 subtraction wraps, reading it back as int32 gives the signed step
+        step = np.diff(specno, prepend=np.uint32(self.last % 2**32)).view(np.int32).astype(np.int64)
+        unwrapped = self.last + np.cumsum(step)
+        bad = np.flatnonzero(step != spp)
+        missing = 0
+        if len(bad):
+            npack = step[bad]//spp - 1
+            self.gaps.append(np.stack([self.npacket + bad, unwrapped[bad] - step[bad] + spp, npack], axis=-1))
+            # net count, so a duplicated packet and the jump back after it cancel out
+            missing = int(np.sum(npack))
+            self.nreordered += int(np.sum(npack < 0))
+        if self.first is None:
+            self.first = int(unwrapped[0])
+        self.last = int(unwrapped[-1])
+        self.npacket += n
+        self.nmissing += missing
+        self.total_packets += n
+        self.total_missing += missing
+        self.history.append((time.time() if now is None else now, n, missing))
+        return missing
+
+    def gap_list(self):
+        """(ngap, 3) int64 array of (packet index, expected specno, npacket) for this file."""
+        if len(self.gaps) == 0:
+            return np.zeros((0, 3), dtype=np.int64)
+        return np.concatenate(self.gaps)
+
+    def loss_fraction(self):
+        """Fraction of packets missing from the current file."""
+        expected = self.npacket + self.nmissing
+        return max(self.nmissing, 0)/expected if expected > 0 else 0.
+
+    def rolling_loss(self, now=None):
+        """Fraction of packets lost over the last `window` seconds."""
+        now = time.time() if now is None else now
+        while self.history and self.history[0][0] < now - self.window:
+            self.history.popleft()
+        nrecv = sum(h[1] for h in self.history)
+        nmiss = sum(h[2] for h in self.history)
+        return max(nmiss, 0)/(nrecv + nmiss) if nrecv + nmiss > 0 else 0.
+
+    def end_file(self, fname):
+        """Write the loss map for the current file next to it, return a summary dict."""
+        gaps = self.gap_list()
+        write_loss_map(fname, gaps, self.npacket, self.first, self.last)
+        return {"packets": self.npacket, "missing": self.nmissing, "reordered": self.nreordered,
+                "gaps": len(gaps), "loss": self.loss_fraction(), "first_specno": self.first,
+                "last_specno": self.last}
+
+def write_loss_map(fname, gaps, npacket, first_specno, last_specno):
+    """
+    Write the gap list of baseband file fname to fname + ".loss". Layout is
+    big-endian int64 [npacket, first_specno, last_specno, ngap] followed by ngap
+    rows of (packet index, expected specno, npacket missing), with unwrapped
+    spectrum numbers.
+    """
+    gaps = np.asarray(gaps, dtype=np.int64).reshape(-1, 3)
+    first_specno = -1 if first_specno is None else first_specno
+    last_specno = -1 if last_specno is None else last_specno
+    with open(fname + LOSS_MAP_SUFFIX, "wb") as f:
+        np.asarray([npacket, first_specno, last_specno, len(gaps)], dtype=">i8").tofile(f)
+        gaps.astype(">i8").tofile(f)
+
+def read_loss_map(fname):
+    """
+    Read the loss map written next to baseband file fname (or the .loss file itself).
+
+    :return: dict with npacket, first_specno, last_specno and gaps, an
+        (ngap, 3) int64 array of (packet index, expected specno, npacket missing).
+    """
+    if not fname.endswith(LOSS_MAP_SUFFIX):
+        fname = fname + LOSS_MAP_SUFFIX
+    raw = np.fromfile(fname, dtype=">i8")
+    npacket, first, last, ngap = (int(x) for x in raw[:4])
+    gaps = raw[4:4 + 3*ngap].astype(np.int64).reshape(ngap, 3)
+    return {"npacket": npacket, "first_specno": first, "last_specno": last, "gaps": gaps}
+
+def _read_raw_header(fname):
+    """
+    Parse the header of a baseband .raw file. Handles both the header written
+    by dump_baseband.py (big-endian, every channel listed twice in 4-bit mode)
+    and the one written by the C dumper (has a version, header_bytes counts
+    itself, chans and coeffs are in native byte order).
+    """
+    with open(fname, "rb") as f:
+        head = np.frombuffer(f.read(8*12), dtype=">u8")
+        if len(head) < 12:
+            raise ValueError(f"{fname} is too short to be a baseband file")
+        hdr = {}
+        if head[0] == 80 + 8*head[2]:
+            # python: header_bytes doesn't include its own 8 bytes
+            hdr["format"] = "python"
+            hdr["version"] = None
+            hdr["data_start"] = 8 + int(head[0])
+            hdr["bytes_per_packet"], nchan_header, hdr["spec_per_packet"], hdr["bits"], hdr["have_gps"] = (int(x) for x in head[1:6])
+            f.seek(8*6)
+            chans = np.fromfile(f, dtype=">u8", count=nchan_header).astype(np.int64)
+            gps_week, gps_time = np.fromfile(f, dtype=">u8", count=2)
+            lat, lon, elev = np.fromfile(f, dtype=">f8", count=3)
+            hdr["coeffs"] = None
+            if hdr["bits"] == 4:
+                chans = chans[::2]
+        elif head[0] == 8*(12 + 2*head[3]):
+            hdr["format"] = "c"
+            hdr["data_start"] = int(head[0])
+            hdr["version"], hdr["bytes_per_packet"], nchan, hdr["spec_per_packet"], hdr["bits"], hdr["have_gps"], gps_week, gps_time = (int(x) for x in head[1:9])
+            lat, lon, elev = head[9:12].view(">f8")
+            chans = np.fromfile(f, dtype="=u8", count=nchan).astype(np.int64)
+            hdr["coeffs"] = np.fromfile(f, dtype="=u8", count=nchan)
+        else:
+            raise ValueError(f"Could not recognise the header of {fname}")
+    hdr["chans"] = chans
+    hdr["gps_week"] = int(gps_week)
+    hdr["gps_time"] = int(gps_time)
+    hdr["lat"], hdr["lon"], hdr["elev"] = float(lat), float(lon), float(elev)
+    hdr["have_gps"] = bool(hdr["have_gps"])
+    return hdr
+
+class BasebandFile():
+    """
+    Memory-mapped reader for a baseband .raw file.
+
+    Nothing is read until asked for. `packets` is a structured memmap with a
+    big-endian 'specno' and a uint8 'payload' per packet, and `raw` gives
+    (npacket, spec_per_packet, nchan, 2) uint8 views of packet ranges with
+    pol on the last axis. Only 4-bit data can be unpacked for now.
+
+    Usage::
+
+        bb = BasebandFile("1712345678.raw")
+        pol0 = bb.pol(0, 0, 1000)   # first 1000 packets of pol0, complex64
+        rfi = bb.read_channels([305, 306], pol=1)   # just two channels
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        hdr = _read_raw_header(fname)
+        self.header = hdr
+        self.format = hdr["format"]
+        self.version = hdr["version"]
+        self.data_start = hdr["data_start"]
+        self.bytes_per_packet = hdr["bytes_per_packet"]
+        self.spec_per_packet = hdr["spec_per_packet"]
+        self.bits = hdr["bits"]
+        self.chans = hdr["chans"]
+        self.coeffs = hdr["coeffs"]
+        self.have_gps = hdr["have_gps"]
+        self.gps_time = hdr["gps_time"]
+        self.lat, self.lon, self.elev = hdr["lat"], hdr["lon"], hdr["elev"]
+        self.nchan = len(self.chans)
+        self.bytes_per_spectrum = (self.bytes_per_packet - 4)//self.spec_per_packet
+        if self.bits == 4 and self.bytes_per_spectrum != 2*self.nchan:
+            raise ValueError(f"{fname}: {self.nchan} channels don't fit {self.bytes_per_spectrum} bytes per spectrum")
+        nbyte = os.path.getsize(fname) - self.data_start
+        self.npacket = nbyte//self.bytes_per_packet
+        if nbyte % self.bytes_per_packet:
+            warnings.warn(f"{fname}: ignoring partial packet at the end of the file")
+        self.dtype = np.dtype([("specno", ">u4"), ("payload", np.uint8, (self.bytes_per_packet - 4,))])
+        if self.npacket > 0:
+            self.packets = np.memmap(fname, dtype=self.dtype, mode="r", offset=self.data_start, shape=(self.npacket,))
+        else:
+            self.packets = np.zeros(0, dtype=self.dtype)
+
+    def __len__(self):
+        return self.npacket
+
+    @property
+    def nspec(self):
+        return self.npacket*self.spec_per_packet
+
+    @property
+    def specno(self):
+        """(npacket,) spectrum number of the first spectrum in each packet."""
+        return self.packets["specno"]
+
+    def spectrum_numbers(self, start=0, stop=None):
+        """(npacket*spec_per_packet,) spectrum number of every spectrum, unwrapped to int64."""
+        sn = np.asarray(self.specno[start:stop], dtype=np.uint32)
+        if len(sn):
+            step = np.diff(sn, prepend=sn[:1]).view(np.int32).astype(np.int64)
+            sn = int(sn[0]) + np.cumsum(step)
+        return (sn[:, None] + np.arange(self.spec_per_packet)).ravel()
+
+    def chan_index(self, chan):
+        """Position of channel number chan in the file."""
+        return int(self.chan_indices([chan])[0])
+
+    def chan_indices(self, chans):
+        """Positions of channel numbers chans in the file."""
+        chans = np.atleast_1d(np.asarray(chans, dtype=np.int64))
+        sorter = np.argsort(self.chans, kind="stable")
+        pos = np.searchsorted(self.chans, chans, sorter=sorter)
+        idx = sorter[np.minimum(pos, len(sorter) - 1)]
+        missing = self.chans[idx] != chans
+        if np.any(missing):
+            raise ValueError(f"Channels {chans[missing]} are not in {self.fname}")
+        return idx
+
+    def byte_offsets(self, chans, pol=None):
+        """
+        Offsets of channel numbers chans within a spectrum's bytes. Bytes go
+        pol0, pol1 for each channel in turn, so channel index i is at 2*i + pol.
+        Returns (len(chans), 2) for both pols, (len(chans),) if pol is given.
+        """
+        off = 2*self.chan_indices(chans)[:, None] + np.arange(2)
+        return off if pol is None else off[:, pol]
+
+    def raw(self, start=0, stop=None):
+        """
+        (npacket, spec_per_packet, nchan, 2) uint8 view of packets start:stop,
+        last axis is pol0, pol1. Reshaping the payload doesn't copy.
+        """
+        payload = self.packets["payload"][start:stop]
+        return payload.reshape(len(payload), self.spec_per_packet, self.bytes_per_spectrum//2, 2)
+
+    def _unpack(self, raw, dtype):
+        if self.bits != 4:
+            raise NotImplementedError(f"Can only unpack 4-bit baseband, this file is {self.bits}-bit")
+        return unpack_4bit(raw, dtype=dtype)
+
+    def read(self, start=0, stop=None, dtype="complex64"):
+        """Unpack packets start:stop, returns (nspec, nchan, 2) with pol on the last axis."""
+        out = self._unpack(self.raw(start, stop), dtype)
+        return out.reshape((-1,) + out.shape[2:])
+
+    def pol(self, p, start=0, stop=None, dtype="complex64"):
+        """Unpack one polarisation of packets start:stop, returns (nspec, nchan)."""
+        out = self._unpack(self.raw(start, stop)[..., p], dtype)
+        return out.reshape((-1,) + out.shape[2:])
+
+    def read_channels(self, chans, start=0, stop=None, pol=None, dtype="complex64", out=None):
+        """
+        Unpack only channel numbers chans of packets start:stop, without decoding
+        (or reading from disk) the bytes of any other channel.
+
+        :return: (nspec, len(chans), 2), or (nspec, len(chans)) if pol is given.
+        """
+        if self.bits != 4:
+            raise NotImplementedError(f"Can only unpack 4-bit baseband, this file is {self.bits}-bit")
+        return unpack_channels(self.raw(start, stop), self.chan_indices(chans), pol=pol, out=out, dtype=dtype)
+
+    def channel(self, chan, pol=None, start=0, stop=None, dtype="complex64"):
+        """
+        Unpack a single channel (channel number, not index) of packets start:stop.
+        Returns (nspec, 2), or (nspec,) if pol is given.
+        """
+        return self.read_channels([chan], start, stop, pol=pol, dtype=dtype)[:, 0]
+
+    def close(self):
+        # the map goes away once the last view of it does
+        self.packets = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def find_baseband_files(root):
+    """All .raw files under root (e.g. dump_baseband_output_directory), in time order."""
+    fnames = []
+    for dirpath, dirnames, files in os.walk(root):
+        fnames += [os.path.join(dirpath, f) for f in files if f.endswith(".raw")]
+    def _ctime(fname):
+        stem = os.path.basename(fname)[:-4]
+        return (int(stem), fname) if stem.isdigit() else (float("inf"), fname)
+    return sorted(fnames, key=_ctime)
+
+def _signed32(x):
+    """uint32 difference read as a signed step."""
+    return int(np.asarray(x % 2**32, dtype=np.uint32).view(np.int32))
+
+def packet_specno(bb, file_start=None):
+    """
+    Unwrapped specno of every packet of BasebandFile bb, counting on from
+    file_start (the unwrapped specno of its first packet, its raw one if None).
+    Rebuilt from the file's .loss map if there is one, so the file isn't read.
+    """
+    if file_start is None:
+        file_start = int(bb.specno[0])
+    try:
+        lossmap = read_loss_map(bb.fname)
+    except (OSError, ValueError):
+        lossmap = None
+    if lossmap is not None and lossmap["npacket"] == bb.npacket:
+        step = np.ones(bb.npacket, dtype=np.int64)
+        gaps = lossmap["gaps"]
+        step[gaps[:, 0]] += gaps[:, 2]
+        step[0] = 0
+        return file_start + bb.spec_per_packet*np.cumsum(step)
+    sn = np.asarray(bb.specno, dtype=np.uint32)
+    return file_start + np.cumsum(np.diff(sn, prepend=sn[:1]).view(np.int32).astype(np.int64))
+
+class BasebandStream():
+    """
+    Several consecutive baseband files seen as one stream indexed by spectrum number.
+
+    Spectrum numbers are unwrapped across files (assuming no gap between two
+    consecutive files is longer than 2**31 spectra, ~10 hours at 250 MHz),
+    taking the first file's raw specno as the origin. Only the first and last
+    packet of each file are read up front. A file's packet spectrum numbers
+    come from its .loss map if there is one (see LossTracker), otherwise from
+    its specno column, and only once a requested range touches the file.
+
+    Usage::
+
+        bbs = BasebandStream("/media/BASEBAND/baseband", chans=[305, 306])
+        for specno, data, mask in bbs.chunks(bbs.start, bbs.start + 10**7):
+            ...   # data is zero where mask is False
+    """
+    def __init__(self, files, chans=None, pol=None, dtype="complex64"):
+        """
+        :param files: Root directory to search for .raw files, or a list of them.
+        :param chans: Channel numbers to read, all channels if None.
+        :param pol: 0 or 1 for one polarisation, None for both.
+        :param dtype: "complex64", "complex128" or "int8".
+        """
+        if isinstance(files, str):
+            files = find_baseband_files(files)
+        if len(files) == 0:
+            raise ValueError("No baseband files to stitch")
+        self.files = []
+        for fname in files:
+            bb = BasebandFile(fname)
+            if bb.npacket > 0:
+                self.files.append(bb)
+        if len(self.files) == 0:
+            raise ValueError("All baseband files are empty")
+        ref = self.files[0]
+        for bb in self.files[1:]:
+            if bb.spec_per_packet != ref.spec_per_packet or bb.bits != ref.bits or not np.array_equal(bb.chans, ref.chans):
+                raise ValueError(f"{bb.fname} has a different channel or packet layout from {ref.fname}")
+        self.spec_per_packet = ref.spec_per_packet
+        self.chans = ref.chans if chans is None else np.atleast_1d(np.asarray(chans, dtype=np.int64))
+        self.idx = ref.chan_indices(self.chans)
+        self.pol = pol
+        self.dtype = dtype
+        # unwrapped specno of each file's first packet and one past its last spectrum
+        self.file_start = np.empty(len(self.files), dtype=np.int64)
+        self.file_stop = np.empty(len(self.files), dtype=np.int64)
+        prev = None
+        for i, bb in enumerate(self.files):
+            first, last = int(bb.specno[0]), int(bb.specno[-1])
+            start = first if prev is None else prev + _signed32(first - prev)
+            self.file_start[i] = start
+            self.file_stop[i] = start + _signed32(last - first) + self.spec_per_packet
+            prev = int(self.file_stop[i]) - self.spec_per_packet
+        self._sn = {}
+
+    @property
+    def start(self):
+        return int(self.file_start[0])
+
+    @property
+    def stop(self):
+        return int(self.file_stop[-1])
+
+    def packet_specno(self, i):
+        """Unwrapped specno of every packet in file i."""
+        if i not in self._sn:
+            self._sn[i] = packet_specno(self.files[i], int(self.file_start[i]))
+        return self._sn[i]
+
+    def _empty(self, n):
+        shape = (n, len(self.idx)) + (() if self.pol is not None else (2,)) + ((2,) if self.dtype == "int8" else ())
+        return np.zeros(shape, dtype=np.int8 if self.dtype == "int8" else self.dtype)
+
+    def read(self, start, stop):
+        """
+        Spectra start:stop (unwrapped spectrum numbers) as one dense array.
+
+        :return: data, (stop-start, nchan) plus a pol axis if pol is None, zero
+            for missing spectra; mask, (stop-start,) bool, True where data is real.
+        """
+        n = stop - start
+        data = self._empty(n)
+        mask = np.zeros(n, dtype=bool)
+        spp = self.spec_per_packet
+        for i in np.flatnonzero((self.file_start < stop) & (self.file_stop > start)):
+            sn = self.packet_specno(i)
+            # packets are in order apart from the odd duplicate, so searchsorted gets the range
+            p0 = max(np.searchsorted(sn, start - spp, side="right") - 1, 0)
+            p1 = np.searchsorted(sn, stop, side="left")
+            if p1 <= p0:
+                continue
+            raw = self.files[i].raw(p0, p1)
+            block = unpack_channels(raw, self.idx, pol=self.pol, dtype=self.dtype)
+            pos = ((sn[p0:p1, None] - start) + np.arange(spp)).ravel()
+            ok = (pos >= 0) & (pos < n)
+            data[pos[ok]] = block[ok]
+            mask[pos[ok]] = True
+        return data, mask
+
+    def chunks(self, start=None, stop=None, chunk_spectra=2**16):
+        """
+        Iterate over spectra start:stop in chunks of at most chunk_spectra, so
+        memory stays bounded however long the range is.
+
+        :return: Generator of (first specno, data, mask), as for read.
+        """
+        start = self.start if start is None else start
+        stop = self.stop if stop is None else stop
+        for c0 in range(start, stop, chunk_spectra):
+            c1 = min(c0 + chunk_spectra, stop)
+            data, mask = self.read(c0, c1)
+            yield c0, data, mask
@@ -0,0 +1,130 @@
+"""
+Benchmark the baseband capture backends on loopback with packet_generator.py.
+
+The generator runs in its own process at the requested rate, this process
+captures through capture.CaptureThread like dump_baseband.py does, optionally
+writing the blocks to a file, and checks the spectrum numbers with
+baseband.LossTracker. Reports throughput, packets lost and the CPU used by
+the capture process for each backend.
+
+Any other capture program (e.g. the C dump_baseband set up to listen on lo)
+can be measured the same way with --command, its CPU comes from its rusage.
+
+Usage::
+
+    python bench_capture.py -b udp ring --rate 1 -t 10
+    python bench_capture.py --command "./dump_baseband config.ini" --rate 0.5
+"""
+import argparse
+import multiprocessing
+import os
+import shlex
+import signal
+import socket
+import subprocess
+import time
+import baseband
+import capture
+import packet_generator
+
+def _run_generator(args, result):
+    gen = packet_generator.get_generator_from_args(args)
+    result.put(gen.run(duration=args.duration))
+    gen.close()
+
+def start_generator(args):
+    result = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_run_generator, args=(args, result))
+    proc.start()
+    return proc, result
+
+def bench_backend(backend, args, bytes_per_packet, spec_per_packet):
+    cap = capture.open_capture(backend, bytes_per_packet, iface="lo", dest_ip=args.dest_ip, dest_prt=args.port)
+    sink = None
+    if backend != "udp":
+        # something has to be listening or every packet gets an ICMP reply
+        sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.bind((args.dest_ip, args.port))
+    pipe = capture.CaptureThread(cap, block_packets=args.block, nbuf=args.nbuf, timeout=0.2)
+    losses = baseband.LossTracker(spec_per_packet)
+    outfile = open(args.outfile, "wb", buffering=0) if args.outfile else None
+    pipe.start()
+    cpu0 = time.process_time()
+    t0 = time.time()
+    proc, result = start_generator(args)
+    nrecv = 0
+    while True:
+        got = pipe.get(timeout=0.5)
+        if got is None:
+            if not proc.is_alive():
+                break
+            continue
+        i, block = got
+        if outfile is not None:
+            outfile.write(block)
+        losses.update(block[:, :4].copy().view(">u4")[:, 0])
+        nrecv += len(block)
+        pipe.release(i)
+    wall = time.time() - t0
+    cpu = time.process_time() - cpu0
+    proc.join()
+    gen = result.get()
+    pipe.stop()
+    stats = pipe.stats()
+    cap.close()
+    if sink is not None:
+        sink.close()
+    if outfile is not None:
+        outfile.close()
+    # the generator's wall time, not ours which includes waiting for the last block
+    secs = gen["seconds"]
+    return {"backend": backend, "sent": gen["sent"], "received": nrecv,
+            "lost": gen["sent"] - nrecv, "loss_pct": 100*(gen["sent"] - nrecv)/max(gen["sent"], 1),
+            "gap_packets": losses.total_missing - gen["dropped"], "gbps_sent": gen["gbps"],
+            "mbps_recv": nrecv*bytes_per_packet/secs/1e6, "cpu_pct": 100*cpu/wall,
+            "high_water": stats["high_water"], "stalls": stats["stalls"]}
+
+def bench_command(command, args, bytes_per_packet):
+    proc = subprocess.Popen(shlex.split(command))
+    time.sleep(args.settle) # let it open its sockets
+    gen_proc, result = start_generator(args)
+    gen_proc.join()
+    gen = result.get()
+    time.sleep(0.5)
+    proc.send_signal(signal.SIGINT)
+    try:
+        _, status, rusage = os.wait4(proc.pid, 0)
+    except ChildProcessError:
+        rusage = None
+    cpu = rusage.ru_utime + rusage.ru_stime if rusage is not None else float("nan")
+    return {"backend": command, "sent": gen["sent"], "gbps_sent": gen["gbps"],
+            "cpu_pct": 100*cpu/(gen["seconds"] + args.settle + 0.5)}
+
+if __name__=="__main__":
+    parser=argparse.ArgumentParser(description="Benchmark baseband capture backends on loopback")
+    packet_generator.add_generator_args(parser)
+    parser.add_argument("-b", "--backends", nargs="+", default=["udp", "ring"], help="Backends to test: pcap, udp, ring")
+    parser.add_argument("-t", "--duration", type=float, default=5., help="Seconds to send for, per backend")
+    parser.add_argument("-k", "--block", type=int, default=256, help="Packets per capture block")
+    parser.add_argument("--nbuf", type=int, default=64, help="Capture buffers")
+    parser.add_argument("--outfile", type=str, default=None, help="Also write the blocks to this file, e.g. on the baseband drive")
+    parser.add_argument("--command", type=str, default=None, help="Benchmark this capture program instead of the python backends")
+    parser.add_argument("--settle", type=float, default=1., help="Seconds to let --command start up")
+    args=parser.parse_args()
+
+    chans=packet_generator.utils.get_channels_from_str(args.channels, 4)
+    spec_per_packet=packet_generator.utils.get_nspec(chans, max_nbyte=args.max_bytes)
+    bytes_per_packet=chans.shape[0]*spec_per_packet+4
+    print(f"{bytes_per_packet} byte packets, rate {args.rate or 'max'} Gbit/s, drop {args.drop}, reorder {args.reorder}, {args.duration} s per run")
+    if args.command is not None:
+        print(bench_command(args.command, args, bytes_per_packet))
+    else:
+        for backend in args.backends:
+            try:
+                r=bench_backend(backend, args, bytes_per_packet, spec_per_packet)
+            except (OSError, ImportError) as e:
+                print(f"{backend:6s} unavailable: {e}")
+                continue
+            print(f"{backend:6s} sent {r['sent']} ({r['gbps_sent']:.3f} Gbit/s) received {r['received']} "
+                  f"lost {r['lost']} ({r['loss_pct']:.4f}%) specno gaps {r['gap_packets']} recv {r['mbps_recv']:.1f} MB/s cpu {r['cpu_pct']:.0f}% "
+                  f"buffers high water {r['high_water']} stalls {r['stalls']}")
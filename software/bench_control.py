@@ -0,0 +1,67 @@
+"""
+Profile the control-path calls of sparrow_albatros.py against mock_fpga.MockFpga,
+to see where the time goes without a board and to measure changes to the
+readout. The mock runs on a virtual clock: each round trip adds --latency
+seconds instead of sleeping, so for each operation we report the round
+trips, the time they would cost on a board with that latency, and the wall
+time actually spent in Python (which includes the driver's own sleeps).
+
+Usage::
+
+    python bench_control.py --latency 2e-3
+"""
+import argparse
+import logging
+import time
+import numpy as np
+import mock_fpga
+import sparrow_albatros
+
+def profile(fpga, name, func, nrep=1):
+    """Run func nrep times, return round trips, modelled latency and wall time per call."""
+    fpga.reset_stats()
+    t0 = time.perf_counter()
+    for i in range(nrep):
+        func()
+    wall = (time.perf_counter() - t0)/nrep
+    stats = fpga.total_stats()
+    return {"name": name, "calls": stats["calls"]/nrep, "round_trips": stats["round_trips"]/nrep,
+            "bytes": stats["bytes"]/nrep, "latency": stats["latency"]/nrep, "wall": wall,
+            "total": stats["latency"]/nrep + wall}
+
+def get_operations(sparrow, pols, metadata_registers, chans, tune_kwargs):
+    return [("initialize_adc", sparrow.initialize_adc, 1),
+            ("tune", lambda: sparrow.tune(**tune_kwargs), 1),
+            ("sync_pulse", sparrow.sync_pulse, 1),
+            ("read_pols", lambda: sparrow.read_pols(pols, ">2048q"), 20),
+            ("read_registers", lambda: sparrow.read_registers(metadata_registers), 20),
+            ("read_accumulation", lambda: sparrow.read_accumulation(pols, metadata_registers, ">2048q"), 20),
+            ("get_optimal_coeffs_from_acc", lambda: sparrow.get_optimal_coeffs_from_acc(chans), 10),
+            ("get_adc_snapshot", sparrow.get_adc_snapshot, 10),
+            ("get_adc_temp", sparrow.get_adc_temp, 20)]
+
+if __name__=="__main__":
+    parser=argparse.ArgumentParser(description="Profile the Sparrow control calls against a mock FPGA")
+    parser.add_argument("-l", "--latency", type=float, default=2e-3, help="Seconds per KATCP round trip")
+    parser.add_argument("--fpga-clk", type=float, default=125., help="FPGA clock in MHz")
+    parser.add_argument("--acc-len", type=int, default=131072, help="Accumulation length")
+    parser.add_argument("--pols", type=str, default="pol00 pol11 pol01r pol01i", help="Pols read per accumulation, as in config.ini")
+    parser.add_argument("--metadata-registers", type=str, default="fft_of_count acc_cnt sync_cnt tx_of_cnt", help="Registers read per accumulation, as in config.ini")
+    parser.add_argument("-o", "--only", nargs="+", default=None, help="Only profile these operations")
+    args=parser.parse_args()
+
+    logger=logging.getLogger("bench_control")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate=False
+    fpga=mock_fpga.MockFpga(fpga_clk_mhz=args.fpga_clk, acc_len=args.acc_len, latency=args.latency, realtime=False)
+    sparrow=sparrow_albatros.AlbatrosDigitizer(fpga, None, 250., logger)
+    tune_kwargs={"ref_clock":10, "fftshift":0xffff, "acc_len":args.acc_len, "dest_ip":"10.10.11.99",
+                 "dest_prt":7417, "spectra_per_packet":8, "bytes_per_spectrum":160}
+    ops=get_operations(sparrow, args.pols.split(), args.metadata_registers.split(), np.arange(190, 230), tune_kwargs)
+    print(f"Latency {args.latency*1e3:.2f} ms per round trip, accumulation period {fpga.acc_period:.3f} s")
+    print(f"{'operation':28s} {'calls':>7s} {'trips':>7s} {'bytes':>9s} {'latency ms':>11s} {'python ms':>10s} {'total ms':>9s}")
+    for name, func, nrep in ops:
+        if args.only is not None and name not in args.only:
+            continue
+        r=profile(fpga, name, func, nrep)
+        print(f"{name:28s} {r['calls']:7.0f} {r['round_trips']:7.0f} {r['bytes']:9.0f} {r['latency']*1e3:11.2f} {r['wall']*1e3:10.2f} {r['total']*1e3:9.2f}")
@@ -0,0 +1,82 @@
+"""
+Benchmark NAV-PVT extraction from the Leo Bodnar's USB reports: the
+per-report offset scan lb_read used to do against ubx.UbxParser.
+
+The input is reports recorded with lbtools_l.record_reports (--reports), or
+a synthetic stream: per navigation epoch a NAV-PVT, a NAV-SAT-sized message
+and some NMEA, cut into 64-byte reports. Reports are cut from a continuous
+stream, so most NAV-PVTs span two reports, which the old scan can't see.
+
+Usage::
+
+    python bench_ubx.py -n 10000
+    python bench_ubx.py --reports lb_reports.bin
+"""
+import argparse
+import struct
+import time
+import ubx
+
+def legacy_scan(data):
+    """The search and unpacking lb_read did before ubx.py, returns (tstamp fields, lon, lat) or None."""
+    nhead = 4
+    packet = None
+    for i in range(len(data)-nhead):
+        if list(data[i:i+nhead]) == [0xb5, 0x62, 0x01, 0x07]:
+            if len(data) < i+46:
+                break
+            packet = data[i+10:i+46]
+            break
+    if packet is None:
+        return None
+    year = struct.unpack('<H', packet[0:2])[0]
+    month = struct.unpack('<B', packet[2:3])[0]
+    day = struct.unpack('<B', packet[3:4])[0]
+    hour = struct.unpack('<B', packet[4:5])[0]
+    minute = struct.unpack('<B', packet[5:6])[0]
+    second = struct.unpack('<B', packet[6:7])[0]
+    nano = struct.unpack('<l', packet[12:16])[0]*10**-9
+    lon = struct.unpack('<l', packet[20:24])[0]*10**-7
+    lat = struct.unpack('<l', packet[24:28])[0]*10**-7
+    return (year, month, day, hour, minute, second, nano), lon, lat
+
+def synthetic_reports(nepoch, report_size=64, t0=1792300000):
+    nmea = b"$GNGGA,051640.00,4506.00000,S,17030.00000,E,1,08,1.00,12.3,M,,M,,*5B\r\n"
+    stream = b"".join(ubx.make_nav_pvt(t0 + i, lat=-45.1, lon=170.5, alt=12.3, nano=i)
+                      + ubx.make_packet(0x01, 0x35, bytes(8 + 12*20)) + nmea for i in range(nepoch))
+    return [stream[i:i+report_size] for i in range(0, len(stream), report_size)]
+
+def bench(func, reports, nrep):
+    best = float("inf")
+    for r in range(nrep):
+        t0 = time.perf_counter()
+        nfix = func(reports)
+        best = min(best, time.perf_counter() - t0)
+    return best, nfix
+
+def run_legacy(reports):
+    return sum(legacy_scan(r) is not None for r in reports)
+
+def run_parser(reports):
+    parser = ubx.UbxParser()
+    return sum(len(parser.feed(r)) for r in reports)
+
+if __name__=="__main__":
+    parser=argparse.ArgumentParser(description="Benchmark NAV-PVT extraction from Leo Bodnar USB reports")
+    parser.add_argument("-n", "--nepoch", type=int, default=5000, help="Navigation epochs in the synthetic stream")
+    parser.add_argument("--reports", type=str, default=None, help="Reports recorded with lbtools_l.record_reports instead")
+    parser.add_argument("-r", "--nrep", type=int, default=3, help="Repetitions, the best is reported")
+    args=parser.parse_args()
+
+    if args.reports is not None:
+        import lbtools_l
+        reports=lbtools_l.load_reports(args.reports)
+        expected=None
+    else:
+        reports=synthetic_reports(args.nepoch)
+        expected=args.nepoch
+    nbytes=sum(len(r) for r in reports)
+    print(f"{len(reports)} reports, {nbytes} bytes" + (f", {expected} NAV-PVTs" if expected else ""))
+    for name, func in [("legacy scan", run_legacy), ("UbxParser", run_parser)]:
+        dt, nfix=bench(func, reports, args.nrep)
+        print(f"{name:12s} {dt*1e6/len(reports):7.2f} us/report {nbytes/dt/1e6:7.2f} MB/s  found {nfix} NAV-PVTs")
@@ -0,0 +1,73 @@
+"""Benchmark the lookup-table 4-bit unpacker against the original unpack_4bit,
+and channel-subset unpacking against decoding every channel."""
+import argparse
+import time
+import numpy as np
+import baseband
+import utils
+
+def unpack_4bit_original(buf):
+    """unpack_4bit as it was in dump_baseband.py (read as uint8 so it also runs on numpy 2)"""
+    raw=np.frombuffer(buf,'uint8')
+    re=np.asarray(np.right_shift(np.bitwise_and(raw, 0xf0), 4), dtype='int8')
+    re[re>8]=re[re>8]-16
+    im=np.asarray(np.bitwise_and(raw, 0x0f), dtype='int8')
+    im[im>8]=im[im>8]-16
+    vec=1J*im+re # complex vector
+    return vec
+
+def timeit(func, nrep):
+    t1=time.perf_counter()
+    for _ in range(nrep):
+        func()
+    return (time.perf_counter()-t1)/nrep
+
+if __name__=="__main__":
+    parser=argparse.ArgumentParser(description="Benchmark 4-bit baseband unpacking")
+    parser.add_argument("-n", "--npacket", type=int, default=5000, help="Number of packets per batch")
+    parser.add_argument("-r", "--nrep", type=int, default=5, help="Number of repetitions to average over")
+    parser.add_argument("--channels", type=str, default="190:230 300:340", help="Channel string as in config.ini")
+    parser.add_argument("--subset", type=str, default="305:309", help="Channels to extract in the subset benchmark")
+    parser.add_argument("--max-bytes", type=int, default=1400, help="max_bytes_per_packet as in config.ini")
+    args=parser.parse_args()
+
+    chans=utils.get_channels_from_str(args.channels, 4)
+    spec_per_packet=utils.get_nspec(chans, max_nbyte=args.max_bytes)
+    bytes_per_packet=chans.shape[0]*spec_per_packet+4
+    rng=np.random.default_rng(0)
+    packets=rng.integers(0, 256, (args.npacket, bytes_per_packet), dtype=np.uint8)
+    nbyte=packets[:, 4:].size
+    print(f"{args.npacket} packets of {bytes_per_packet} bytes ({spec_per_packet} spectra, {chans.shape[0]//2} channels)")
+
+    ref=np.concatenate([unpack_4bit_original(p[4:].tobytes()) for p in packets])
+    _, new=baseband.unpack_4bit_packets(packets, spec_per_packet)
+    assert np.array_equal(ref, new.ravel()), "lookup-table unpacker disagrees with the original"
+
+    results={}
+    results["original, per packet"]=timeit(lambda: [unpack_4bit_original(p[4:].tobytes()) for p in packets], args.nrep)
+    results["lut complex64, per packet"]=timeit(lambda: [baseband.unpack_4bit(p[4:]) for p in packets], args.nrep)
+    out=np.empty((args.npacket*spec_per_packet, chans.shape[0]//2, 2), dtype=np.complex64)
+    results["lut complex64, batched"]=timeit(lambda: baseband.unpack_4bit_packets(packets, spec_per_packet, out=out), args.nrep)
+    out8=np.empty(out.shape+(2,), dtype=np.int8)
+    results["lut int8, batched"]=timeit(lambda: baseband.unpack_4bit_packets(packets, spec_per_packet, out=out8, dtype="int8"), args.nrep)
+    base=results["original, per packet"]
+    for name, dt in results.items():
+        print(f"{name:28s} {dt*1e3:9.2f} ms  {nbyte/dt/1e6:8.1f} MB/s  x{base/dt:.1f}")
+
+    # Channel subset: only the requested channels' bytes are decoded
+    chan_numbers=chans[::2].astype(np.int64)
+    subset=utils.get_channels_from_str(args.subset, 4)[::2].astype(np.int64)
+    idx=np.searchsorted(chan_numbers, subset)
+    assert np.array_equal(chan_numbers[idx], subset), f"{args.subset} is not a subset of {args.channels}"
+    raw=packets[:, 4:].reshape(args.npacket, spec_per_packet, -1, 2)
+    sub=baseband.unpack_channels(raw, idx)
+    assert np.array_equal(sub, new[:, idx]), "channel subset disagrees with full decode"
+    full=timeit(lambda: baseband.unpack_4bit_packets(packets, spec_per_packet, out=out), args.nrep)
+    sub_out=np.empty_like(sub)
+    part=timeit(lambda: baseband.unpack_channels(raw, idx, out=sub_out), args.nrep)
+    pol_out=np.empty(sub.shape[:2], dtype=np.complex64)
+    part_pol=timeit(lambda: baseband.unpack_channels(raw, idx, pol=0, out=pol_out), args.nrep)
+    print(f"\n{len(idx)} of {len(chan_numbers)} channels ({args.subset})")
+    print(f"{'all channels':28s} {full*1e3:9.2f} ms")
+    print(f"{'subset, both pols':28s} {part*1e3:9.2f} ms  x{full/part:.1f}")
+    print(f"{'subset, one pol':28s} {part_pol*1e3:9.2f} ms  x{full/part_pol:.1f}")
@@ -0,0 +1,508 @@
+"""
+Block-oriented capture of the FPGA's baseband UDP packets.
+
+Every backend fills the rows of a caller-owned (npacket, bytes_per_packet) uint8
+array with UDP payloads, so a whole block can go to disk with a single write.
+
+    pcap : libpcap through pcapy, one packet per call. The old behaviour.
+    udp  : a plain UDP socket bound to dest_ip:dest_prt, drained with
+           recvmmsg(2) so one syscall returns up to a block of datagrams.
+    ring : an AF_PACKET socket with a TPACKET_V3 receive ring mmapped into
+           the process. The kernel fills whole blocks of frames, and a block
+           of payloads is gathered with numpy without any syscalls.
+
+Use `open_capture` to get one from the [networking] config options. Run this
+file to check a backend on loopback, e.g. `python capture.py -b udp`
+(the ring backend needs root or CAP_NET_RAW).
+"""
+import ctypes
+import ctypes.util
+import errno
+import mmap
+import os
+import select
+import socket
+import struct
+import threading
+import queue
+import time
+import numpy as np
+
+IP_HEADER_START = 14 # Safe to assume for Ethernet, but not for other link layers
+UDP_HEADER_START = IP_HEADER_START + 20 # 20 bytes is the smallest IPV4 header size w/o options
+UDP_PAYLOAD_START = UDP_HEADER_START + 8 # udp header is 8 bytes
+
+# From linux/if_packet.h
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+PACKET_IGNORE_OUTGOING = 23
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+ETH_P_ALL = 0x0003
+SO_ATTACH_FILTER = 26
+MSG_WAITFORONE = 0x10000
+MSG_TRUNC = 0x20
+
+class Capture():
+    """Base class, subclasses implement `read_block`."""
+    def __init__(self, bytes_per_packet):
+        self.bytes_per_packet = bytes_per_packet
+        self.npacket = 0
+        self.nblock = 0
+
+    def read_block(self, out, timeout=1.0):
+        """
+        Fill the first rows of out with packet payloads.
+
+        :param out: (n, bytes_per_packet) C-contiguous uint8 array.
+        :param timeout: Seconds to wait for the first packet.
+
+        :return: Number of rows filled, 0 on timeout.
+        :rtype: int
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        """Packets and blocks returned, plus kernel counters where available."""
+        return {"packets": self.npacket, "blocks": self.nblock}
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _check_out(self, out):
+        if out.dtype != np.uint8 or out.ndim != 2 or out.shape[1] != self.bytes_per_packet or not out.flags.c_contiguous:
+            raise ValueError(f"out must be a C-contiguous (n, {self.bytes_per_packet}) uint8 array")
+
+class PcapCapture(Capture):
+    def __init__(self, bytes_per_packet, iface="eth0", bpf_filter=None, snaplen=65535, promisc=1, timeout_ms=1000):
+        import pcapy
+        super().__init__(bytes_per_packet)
+        self.cap = pcapy.open_live(iface, snaplen, promisc, timeout_ms)
+        if bpf_filter is not None:
+            self.cap.setfilter(bpf_filter)
+
+    def read_block(self, out, timeout=1.0):
+        self._check_out(out)
+        end = UDP_PAYLOAD_START + self.bytes_per_packet
+        n = 0
+        while n < out.shape[0]:
+            header, packet = self.cap.next()
+            if header is None or len(packet) < end:
+                # pcap read timeout, hand back what we have
+                if n > 0 or header is None:
+                    break
+                continue
+            out[n] = np.frombuffer(packet, dtype=np.uint8, count=self.bytes_per_packet, offset=UDP_PAYLOAD_START)
+            n += 1
+        self.npacket += n
+        self.nblock += n > 0
+        return n
+
+    def stats(self):
+        out = super().stats()
+        out["kernel_packets"], out["kernel_drops"], out["iface_drops"] = self.cap.stats()
+        return out
+
+class _iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_iovec)), ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _msghdr), ("msg_len", ctypes.c_uint)]
+
+_libc = None
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        _libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        _libc.recvmmsg.restype = ctypes.c_int
+    return _libc
+
+class UdpCapture(Capture):
+    def __init__(self, bytes_per_packet, dest_ip="0.0.0.0", dest_prt=7417, rcvbuf=64*1024*1024):
+        super().__init__(bytes_per_packet)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.sock.bind((dest_ip, dest_prt))
+        self.rcvbuf = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        self.libc = _get_libc()
+        self.truncated = 0
+        self._timeout = None
+        self._out_addr = None
+        self._msgs = None
+
+    def _set_timeout(self, timeout):
+        # SO_RCVTIMEO rather than settimeout(), which would make the fd non-blocking
+        if timeout != self._timeout:
+            sec = int(timeout)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack("ll", sec, int((timeout - sec)*1e6)))
+            self._timeout = timeout
+
+    def _setup_msgs(self, out):
+        # (re)point one iovec at each row of out, only when out changes
+        addr = out.ctypes.data
+        if self._out_addr == addr and len(self._msgs) == out.shape[0]:
+            return
+        n = out.shape[0]
+        self._iovs = (_iovec * n)()
+        self._msgs = (_mmsghdr * n)()
+        for i in range(n):
+            self._iovs[i].iov_base = addr + i*self.bytes_per_packet
+            self._iovs[i].iov_len = self.bytes_per_packet
+            self._msgs[i].msg_hdr.msg_iov = ctypes.pointer(self._iovs[i])
+            self._msgs[i].msg_hdr.msg_iovlen = 1
+        # numpy views of the per-message length and flags, to check a block without a python loop
+        words = np.frombuffer(self._msgs, dtype=np.uint32).reshape(n, ctypes.sizeof(_mmsghdr)//4)
+        self._msg_len = words[:, _mmsghdr.msg_len.offset//4]
+        self._msg_flags = words[:, _msghdr.msg_flags.offset//4]
+        self._out_addr = addr
+        self._out = out # keep the buffer alive while the iovecs point into it
+
+    def read_block(self, out, timeout=1.0):
+        self._check_out(out)
+        self._set_timeout(timeout)
+        self._setup_msgs(out)
+        n = self.libc.recvmmsg(self.sock.fileno(), self._msgs, out.shape[0], MSG_WAITFORONE, None)
+        if n < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return 0
+            raise OSError(err, os.strerror(err))
+        # drop anything that isn't exactly one of our packets
+        ok = (self._msg_len[:n] == self.bytes_per_packet) & (self._msg_flags[:n] & MSG_TRUNC == 0)
+        if not np.all(ok):
+            self.truncated += int(np.sum(~ok))
+            good = np.flatnonzero(ok)
+            out[:len(good)] = out[good]
+            n = len(good)
+        self.npacket += n
+        self.nblock += n > 0
+        return n
+
+    def stats(self):
+        out = super().stats()
+        out["truncated"] = self.truncated
+        return out
+
+    def close(self):
+        self.sock.close()
+
+def _bpf_program(dest_prt, dest_ip=None, src_ip=None):
+    """Classic BPF for 'udp and dst port P [and dst host D] [and src host S]',
+    unfragmented IPv4 over Ethernet only. Returns a list of (code, jt, jf, k)."""
+    FAIL = -1
+    prog = [(0x28, 0, 0, 12),           # ldh [12]       ethertype
+            (0x15, 0, FAIL, 0x0800),    # jeq IPv4
+            (0x30, 0, 0, 23),           # ldb [23]       ip proto
+            (0x15, 0, FAIL, 17),        # jeq UDP
+            (0x28, 0, 0, 20),           # ldh [20]       fragment offset
+            (0x45, FAIL, 0, 0x1fff),    # jset -> fail
+            (0xb1, 0, 0, 14),           # ldxb 4*([14]&0xf)
+            (0x48, 0, 0, 16),           # ldh [x+16]     udp dst port
+            (0x15, 0, FAIL, dest_prt)]
+    if dest_ip is not None:
+        prog += [(0x20, 0, 0, 30), (0x15, 0, FAIL, struct.unpack(">I", socket.inet_aton(dest_ip))[0])]
+    if src_ip is not None:
+        prog += [(0x20, 0, 0, 26), (0x15, 0, FAIL, struct.unpack(">I", socket.inet_aton(src_ip))[0])]
+    prog += [(0x06, 0, 0, 0x40000)] # ret accept
+    ifail = len(prog)
+    prog += [(0x06, 0, 0, 0)] # ret drop
+    return [(code, ifail-i-1 if jt == FAIL else jt, ifail-i-1 if jf == FAIL else jf, k)
+            for i, (code, jt, jf, k) in enumerate(prog)]
+
+class RingCapture(Capture):
+    def __init__(self, bytes_per_packet, iface="eth0", dest_prt=7417, dest_ip=None, src_ip=None,
+                 block_size=1<<20, block_nr=32, frame_size=2048, retire_ms=10):
+        """
+        :param block_size: Bytes per ring block, a multiple of the page size.
+        :param block_nr: Number of blocks, so the ring is block_size*block_nr bytes.
+        :param frame_size: Upper bound on a frame slot, only used to size the request.
+        :param retire_ms: The kernel hands over a part-filled block after this long.
+        """
+        super().__init__(bytes_per_packet)
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+        filt = b"".join(struct.pack("HBBI", *ins) for ins in _bpf_program(dest_prt, dest_ip, src_ip))
+        self._filt = ctypes.create_string_buffer(filt)
+        self.sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER,
+                             struct.pack("HP", len(filt)//8, ctypes.addressof(self._filt)))
+        try:
+            # on lo every packet would otherwise show up twice
+            self.sock.setsockopt(SOL_PACKET, PACKET_IGNORE_OUTGOING, 1)
+        except OSError:
+            pass
+        self.sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        req = struct.pack("7I", block_size, block_nr, frame_size, block_size//frame_size*block_nr, retire_ms, 0, 0)
+        self.sock.setsockopt(SOL_PACKET, PACKET_RX_RING, req)
+        self.sock.bind((iface, ETH_P_ALL))
+        self.block_size = block_size
+        self.block_nr = block_nr
+        self.ring = mmap.mmap(self.sock.fileno(), block_size*block_nr, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        self._u8 = np.frombuffer(self.ring, dtype=np.uint8)
+        self._u32 = self._u8.view(np.uint32)
+        self.poller = select.poll()
+        self.poller.register(self.sock.fileno(), select.POLLIN | select.POLLERR)
+        self.need = UDP_PAYLOAD_START + bytes_per_packet
+        self.short = 0
+        self.kernel_packets = 0
+        self.kernel_drops = 0
+        self._block = 0  # block we are reading
+        self._pos = 0    # packets of it already consumed
+
+    def _block_ready(self, timeout):
+        status = self._u32[self._block*self.block_size//4 + 2]
+        if status & TP_STATUS_USER:
+            return True
+        if timeout is None or not self.poller.poll(int(timeout*1000)):
+            return False
+        return bool(self._u32[self._block*self.block_size//4 + 2] & TP_STATUS_USER)
+
+    def _release_block(self):
+        self._u32[self._block*self.block_size//4 + 2] = TP_STATUS_KERNEL
+        self._block = (self._block + 1) % self.block_nr
+        self._pos = 0
+
+    def _frame_offsets(self, base, npkt):
+        """Absolute offsets of the frames in a block, walking the chain only if
+        the frames aren't evenly spaced (they are when all packets are equal size)."""
+        first = base + int(self._u32[base//4 + 4])
+        if npkt == 1:
+            return np.array([first])
+        stride = int(self._u32[first//4])
+        offsets = first + stride*np.arange(npkt)
+        if stride > 0 and np.all(self._u32[offsets[:-1]//4] == stride):
+            return offsets
+        offsets = np.empty(npkt, dtype=np.int64)
+        off = first
+        for i in range(npkt):
+            offsets[i] = off
+            off += int(self._u32[off//4])
+        return offsets
+
+    def _copy_block(self, out, n):
+        base = self._block*self.block_size
+        npkt = int(self._u32[base//4 + 3])
+        take = min(npkt - self._pos, out.shape[0] - n)
+        offsets = self._frame_offsets(base, npkt)[self._pos:self._pos + take]
+        snaplen = self._u32[offsets//4 + 3]
+        start = offsets + (self._u32[offsets//4 + 6] & 0xffff) + UDP_PAYLOAD_START
+        ok = snaplen >= self.need
+        if not np.all(ok):
+            self.short += int(np.sum(~ok))
+            start = start[ok]
+        if len(start) > 1 and np.all(np.diff(start) == start[1] - start[0]):
+            # evenly spaced payloads: one strided view, one copy
+            src = np.lib.stride_tricks.as_strided(self._u8[start[0]:], shape=(len(start), self.bytes_per_packet),
+                                                  strides=(int(start[1] - start[0]), 1))
+            out[n:n + len(start)] = src
+        else:
+            for i, s in enumerate(start):
+                out[n + i] = self._u8[s:s + self.bytes_per_packet]
+        self._pos += take
+        if self._pos == npkt:
+            self._release_block()
+        return n + len(start)
+
+    def read_block(self, out, timeout=1.0):
+        self._check_out(out)
+        n = 0
+        wait = timeout
+        while n < out.shape[0] and self._block_ready(wait):
+            n = self._copy_block(out, n)
+            wait = None # only block for the first packet
+        self.npacket += n
+        self.nblock += n > 0
+        return n
+
+    def stats(self):
+        # the kernel resets these counters on every read
+        packets, drops, freeze = struct.unpack("3I", self.sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, 12))
+        self.kernel_packets += packets
+        self.kernel_drops += drops
+        out = super().stats()
+        out.update(kernel_packets=self.kernel_packets, kernel_drops=self.kernel_drops, short=self.short)
+        return out
+
+    def close(self):
+        del self._u8, self._u32
+        self.ring.close()
+        self.sock.close()
+
+class CaptureThread(threading.Thread):
+    """
+    Capture stage of the baseband dumper. Reads blocks from a Capture into a
+    preallocated ring of buffers on its own thread, so disk latency on the
+    consumer side only costs buffer space instead of dropped packets.
+
+    The consumer calls `get` for the next filled block and `release` once it
+    has been written out. If every buffer is full the capture thread has to
+    wait, that time is counted as a stall (the kernel may drop packets then).
+    """
+    def __init__(self, cap, block_packets=256, nbuf=64, timeout=1.0):
+        super().__init__(daemon=True)
+        self.cap = cap
+        self.timeout = timeout
+        self.buffers = np.empty((nbuf, block_packets, cap.bytes_per_packet), dtype=np.uint8)
+        self.free = queue.Queue()
+        self.full = queue.Queue()
+        for i in range(nbuf):
+            self.free.put(i)
+        self.nbuf = nbuf
+        self.high_water = 0
+        self.stalls = 0
+        self.stall_time = 0.
+        self.error = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    i = self.free.get_nowait()
+                except queue.Empty:
+                    t0 = time.time()
+                    i = self.free.get()
+                    self.stalls += 1
+                    self.stall_time += time.time() - t0
+                if i is None:
+                    break
+                n = self.cap.read_block(self.buffers[i], timeout=self.timeout)
+                if n == 0:
+                    self.free.put(i)
+                    continue
+                self.full.put((i, n))
+                self.high_water = max(self.high_water, self.full.qsize())
+        except Exception as e:
+            self.error = e
+        self.full.put(None)
+
+    def get(self, timeout=None):
+        """
+        :return: (i, block) with block a view of the filled rows of buffer i,
+            or None on timeout or once the thread has stopped.
+        """
+        try:
+            item = self.full.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if item is None:
+            self.full.put(None) # stay stopped for any later get
+            return None
+        i, n = item
+        return i, self.buffers[i, :n]
+
+    def release(self, i):
+        """Hand buffer i back to the capture thread."""
+        self.free.put(i)
+
+    def stop(self):
+        self._stop_event.set()
+        self.free.put(None) # wake it if it is stalled
+        self.join()
+
+    def stats(self):
+        out = self.cap.stats()
+        out.update(buffers=self.nbuf, buffers_queued=self.full.qsize(), high_water=self.high_water,
+                   stalls=self.stalls, stall_time=round(self.stall_time, 3))
+        return out
+
+def open_capture(backend, bytes_per_packet, iface="eth0", dest_ip="0.0.0.0", dest_prt=7417, src_ip=None, **kwargs):
+    """
+    Open a capture backend by name, "pcap", "udp" or "ring".
+
+    :param iface: Network interface, for pcap and ring.
+    :param dest_ip: Address the FPGA sends to, the udp backend binds to it.
+    :param src_ip: Only accept packets from this address (pcap and ring).
+    :param kwargs: Passed to the backend constructor.
+    """
+    if backend == "pcap":
+        bpf_filter = f"udp and dst port {dest_prt} and dst host {dest_ip}"
+        if src_ip is not None:
+            bpf_filter += f" and src host {src_ip}"
+        return PcapCapture(bytes_per_packet, iface=iface, bpf_filter=bpf_filter, **kwargs)
+    if backend == "udp":
+        return UdpCapture(bytes_per_packet, dest_ip=dest_ip, dest_prt=dest_prt, **kwargs)
+    if backend == "ring":
+        return RingCapture(bytes_per_packet, iface=iface, dest_prt=dest_prt, dest_ip=dest_ip, src_ip=src_ip, **kwargs)
+    raise ValueError(f"Unknown capture backend {backend}, options are pcap, udp, ring")
+
+def get_capture_from_config(config_file, bytes_per_packet):
+    """Open the capture backend selected in the [networking] section of config.ini."""
+    backend = config_file.get("networking", "capture_backend", fallback="pcap")
+    kwargs = {}
+    if backend == "ring":
+        kwargs["block_size"] = config_file.getint("networking", "ring_block_size", fallback=1<<20)
+        kwargs["block_nr"] = config_file.getint("networking", "ring_block_nr", fallback=32)
+    return open_capture(backend, bytes_per_packet,
+                        iface=config_file.get("networking", "capture_interface", fallback="eth0"),
+                        dest_ip=config_file.get("fpga_register_vals", "dest_ip"),
+                        dest_prt=config_file.getint("fpga_register_vals", "dest_prt"),
+                        src_ip=config_file.get("networking", "src_host", fallback=None),
+                        **kwargs)
+
+if __name__=="__main__":
+    import argparse
+    parser=argparse.ArgumentParser(description="Send synthetic baseband packets over loopback and capture them")
+    parser.add_argument('-b','--backend', type=str, default='udp', help='pcap, udp or ring')
+    parser.add_argument('-n','--npacket', type=int, default=100000, help='Number of packets to send')
+    parser.add_argument('-s','--bytes-per-packet', type=int, default=1284, help='UDP payload size')
+    parser.add_argument('-k','--block', type=int, default=256, help='Packets per block')
+    parser.add_argument('--nbuf', type=int, default=64, help='Number of block buffers')
+    parser.add_argument('--write-delay', type=float, default=0., help='Seconds the consumer sleeps per block')
+    parser.add_argument('-p','--port', type=int, default=7417, help='UDP port')
+    args=parser.parse_args()
+
+    cap=open_capture(args.backend, args.bytes_per_packet, iface="lo", dest_ip="127.0.0.1", dest_prt=args.port)
+    if args.backend == "ring":
+        # something has to be listening or every packet gets an ICMP reply
+        sink=socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.bind(("127.0.0.1", args.port))
+
+    def send():
+        tx=socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        packet=bytearray(np.random.randint(0, 256, args.bytes_per_packet, dtype=np.uint8).tobytes())
+        for i in range(args.npacket):
+            packet[:4]=i.to_bytes(4, "big")
+            tx.sendto(packet, ("127.0.0.1", args.port))
+            if i % 64 == 63:
+                time.sleep(0) # give the reader a look in
+        tx.close()
+
+    pipe=CaptureThread(cap, block_packets=args.block, nbuf=args.nbuf, timeout=0.5)
+    sender=threading.Thread(target=send)
+    t0=time.time()
+    pipe.start()
+    sender.start()
+    specno=[]
+    while True:
+        got=pipe.get(timeout=0.5)
+        if got is None:
+            if not sender.is_alive():
+                break
+            continue
+        i, block=got
+        specno.append(block[:, :4].copy().view(">u4")[:, 0])
+        time.sleep(args.write_delay) # pretend to be a slow disk
+        pipe.release(i)
+    dt=time.time()-t0
+    sender.join()
+    specno=np.concatenate(specno)
+    print(f"{args.backend}: received {len(specno)}/{args.npacket} packets in {dt:.2f}s, "
+          f"{len(specno)*args.bytes_per_packet/dt/1e6:.1f} MB/s, in order: {bool(np.all(np.diff(specno.astype(np.int64)) > 0))}")
+    pipe.stop()
+    print(pipe.stats())
+    cap.close()
@@ -0,0 +1,198 @@
+"""
+Offline auto/cross correlation of 4-bit baseband, to check baseband against the
+FPGA's pol00/pol11/pol01r/pol01i accumulators or to make spectra with other
+accumulation lengths.
+
+Every byte pair (pol0, pol1) of a channel is read as one big-endian uint16,
+which indexes a 65536-entry table holding all four products, so correlating
+is a table lookup and a sum, no unpacking or multiplying. Accumulations are
+aligned to spectrum numbers (accumulation k covers specno k*nacc to
+(k+1)*nacc), missing packets just leave fewer spectra in an accumulation.
+
+Output goes to pol00.scio, pol11.scio, pol01r.scio and pol01i.scio, 2048
+channel int64 frames as written by dump_spectra.py, with channels that aren't
+in the baseband left at zero. Values are sums of products of the 4-bit
+integers, not the FPGA's fixed point, and pol01 is pol0*conj(pol1).
+"""
+import argparse
+import os
+from os.path import join
+import time
+import numpy as np
+import baseband
+import scio
+
+POLS = ["pol00", "pol11", "pol01r", "pol01i"]
+NCHAN_FPGA = 2048
+
+def make_product_lut():
+    """(65536, 4) int16 table of pol00, pol11, pol01r, pol01i for key (pol0 byte << 8) | pol1 byte."""
+    x = baseband.LUT_4BIT_COMPLEX64.astype(np.complex128)
+    x0 = np.repeat(x, 256) # high byte
+    x1 = np.tile(x, 256)   # low byte
+    cross = x0*np.conj(x1)
+    lut = np.stack([np.abs(x0)**2, np.abs(x1)**2, cross.real, cross.imag], axis=-1)
+    return np.ascontiguousarray(np.round(lut).astype(np.int16))
+
+LUT_PRODUCTS = make_product_lut()
+
+def packet_keys(raw):
+    """(npacket, spec_per_packet, nchan, 2) uint8 payload view to (nspec, nchan) uint16 keys, no copy of the bytes."""
+    keys = raw.view(">u2")[..., 0]
+    return keys.reshape((-1,) + keys.shape[2:])
+
+def correlate_keys(keys, starts):
+    """
+    Sum the products of each segment of spectra.
+
+    :param keys: (nspec, nchan) uint16 keys from packet_keys.
+    :param starts: Index of the first spectrum of each segment, increasing.
+
+    :return: (len(starts), nchan, 4) int64 sums of pol00, pol11, pol01r, pol01i.
+    """
+    prod = np.take(LUT_PRODUCTS, keys, axis=0, mode="wrap")
+    return np.add.reduceat(prod, starts, axis=0, dtype=np.int64)
+
+class Correlator():
+    """
+    Accumulates products over nacc spectra, aligned on spectrum number, across
+    as many blocks and files as it is fed. Completed accumulations come out of
+    `add` and `finish` as (acc index, nspec, (nchan, 4) int64 sums).
+    """
+    def __init__(self, nchan, nacc):
+        self.nchan = nchan
+        self.nacc = nacc
+        self.acc = None # index of the accumulation in progress
+        self.sums = np.zeros((nchan, 4), dtype=np.int64)
+        self.nspec = 0
+
+    def add(self, specno, keys):
+        """
+        :param specno: (nspec,) increasing unwrapped spectrum numbers of keys.
+        :param keys: (nspec, nchan) uint16 keys.
+        :return: List of completed accumulations.
+        """
+        if len(specno) == 0:
+            return []
+        acc = specno//self.nacc
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(acc)) + 1])
+        sums = correlate_keys(keys, starts)
+        counts = np.diff(np.concatenate([starts, [len(acc)]]))
+        done = []
+        for a, s, n in zip(acc[starts], sums, counts):
+            if a != self.acc:
+                if self.acc is not None and self.nspec > 0:
+                    done.append((self.acc, self.nspec, self.sums.copy()))
+                self.acc = int(a)
+                self.sums[:] = 0
+                self.nspec = 0
+            self.sums += s
+            self.nspec += int(n)
+        return done
+
+    def finish(self):
+        """The accumulation in progress, even if it is incomplete."""
+        if self.acc is None or self.nspec == 0:
+            return []
+        out = [(self.acc, self.nspec, self.sums.copy())]
+        self.acc = None
+        return out
+
+def correlate_stream(stream, nacc, block_packets=512):
+    """
+    Correlate every file of a baseband.BasebandStream.
+
+    :return: Generator of (acc index, nspec, (nchan, 4) int64 sums), the last
+        accumulation is passed on even if incomplete, check nspec.
+    """
+    spp = stream.spec_per_packet
+    corr = Correlator(len(stream.files[0].chans), nacc)
+    for i, bb in enumerate(stream.files):
+        sn = stream.packet_specno(i)
+        for p0 in range(0, bb.npacket, block_packets):
+            p1 = min(p0 + block_packets, bb.npacket)
+            specno = (sn[p0:p1, None] + np.arange(spp)).ravel()
+            if np.any(np.diff(specno) <= 0):
+                # reordered or duplicated packets, keep the first of each spectrum in order
+                order = np.argsort(specno, kind="stable")
+                keep = order[np.concatenate([[True], np.diff(specno[order]) > 0])]
+                keys = packet_keys(bb.raw(p0, p1))[keep]
+                specno = specno[keep]
+            else:
+                keys = packet_keys(bb.raw(p0, p1))
+            yield from corr.add(specno, keys)
+    yield from corr.finish()
+
+def write_accumulations(outsubdir, accs, chans, nacc, specno0, t0, spec_time, compress=None, diff=False, scio_version=2):
+    """
+    Write accumulations to pol00/pol11/pol01r/pol01i.scio in outsubdir, as
+    2048 channel int64 frames like dump_spectra.py's.
+
+    :param accs: Iterable of (acc index, nspec, (nchan, 4) int64 sums).
+    :param chans: Channel numbers of the sums' rows.
+    :param specno0: Spectrum number at time t0, for the timestamps.
+    :param spec_time: Seconds per spectrum.
+    :param scio_version: 2 puts specno_start, nspec, time_start and time_stop
+        in scio columns, 1 writes them to .raw files next to the scio files.
+
+    :return: Number of accumulations and of spectra written.
+    """
+    meta_names=["specno_start", "nspec", "time_start", "time_stop"]
+    meta=None
+    if scio_version == 2:
+        meta=[("specno_start","int64"), ("nspec","int64"), ("time_start","float64"), ("time_stop","float64")]
+    scio_files={pol: scio.scio(join(outsubdir, f"{pol}.scio"), diff=diff, compress=compress,
+                               version=scio_version, meta=meta) for pol in POLS}
+    raw_files={}
+    if scio_version == 1:
+        raw_files={name: open(join(outsubdir, f"{name}.raw"), "w") for name in meta_names}
+    frame=np.zeros(NCHAN_FPGA, dtype=np.int64)
+    nacc_done=0
+    nspec_done=0
+    for acc, nspec, sums in accs:
+        specno_start=acc*nacc
+        frame_meta={"specno_start":specno_start, "nspec":nspec,
+                    "time_start":t0 + (specno_start - specno0)*spec_time,
+                    "time_stop":t0 + (specno_start + nacc - specno0)*spec_time}
+        for j, pol in enumerate(POLS):
+            frame[chans]=sums[:, j]
+            scio_files[pol].append(frame.copy(), frame_meta if meta is not None else None)
+        for name, f in raw_files.items():
+            np.array(frame_meta[name], dtype="float64" if name.startswith("time") else "int64").tofile(f)
+        nacc_done+=1
+        nspec_done+=nspec
+    for pol in POLS:
+        scio_files[pol].close()
+    for f in raw_files.values():
+        f.close()
+    return nacc_done, nspec_done
+
+if __name__=="__main__":
+    parser=argparse.ArgumentParser(description="Correlate 4-bit baseband into scio files like dump_spectra.py's")
+    parser.add_argument("files", nargs="+", help=".raw files, or a directory to search for them")
+    parser.add_argument("-o", "--outdir", type=str, default=".", help="Output directory, a ctime-named subdirectory is made in it")
+    parser.add_argument("-n", "--nacc", type=int, default=131072, help="Spectra per accumulation (accumulation_length in config.ini)")
+    parser.add_argument("-b", "--block-packets", type=int, default=512, help="Packets read per block, small enough that the products stay in cache")
+    parser.add_argument("--adc-clk", type=float, default=250., help="ADC clock in MHz, for accumulation timestamps")
+    parser.add_argument("--compress", type=str, default=None, help="scio compression, e.g. bzip2, zstd")
+    parser.add_argument("--diff", action="store_true", help="Write diff scio files")
+    parser.add_argument("--scio-version", type=int, default=2, help="1 writes the metadata to .raw files, 2 into the scio files")
+    args=parser.parse_args()
+
+    files=args.files[0] if len(args.files) == 1 and os.path.isdir(args.files[0]) else args.files
+    stream=baseband.BasebandStream(files)
+    chans=stream.files[0].chans
+    spec_time=2*NCHAN_FPGA/(args.adc_clk*1e6) # seconds per spectrum
+    t0=stream.files[0].gps_time
+    outsubdir=join(args.outdir, str(t0)[:5], str(t0))
+    os.makedirs(outsubdir, exist_ok=True)
+    print(f"{len(stream.files)} files, {len(chans)} channels, spectra {stream.start} to {stream.stop}, writing to {outsubdir}")
+
+    t1=time.time()
+    # the header time is when the file was opened, near enough to its first spectrum
+    nacc_done, nspec_done=write_accumulations(outsubdir, correlate_stream(stream, args.nacc, args.block_packets),
+                                              chans, args.nacc, stream.start, t0, spec_time,
+                                              compress=args.compress, diff=args.diff, scio_version=args.scio_version)
+    dt=time.time()-t1
+    print(f"{nacc_done} accumulations of {nspec_done} spectra in {dt:.2f} s, "
+          f"{nspec_done*spec_time/max(dt, 1e-9):.1f}x real time")
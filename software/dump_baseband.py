@@ -8,64 +8,64 @@ import os
 from os.path import join
 from configparser import ConfigParser
 import utils
+import baseband
 import logging
 import datetime
 import lbtools_l
+import timing
+import metadata_service
 import struct
-import pcapy
-import dpkt
+import capture
+from capture import UDP_PAYLOAD_START
 
-IP_HEADER_START = 14 # Safe to assume for Ethernet, but not for other link layers
-UDP_HEADER_START = IP_HEADER_START + 20 # 20 bytes is the smallest IPV4 header size w/o options
-UDP_PAYLOAD_START = UDP_HEADER_START + 8 # udp header is 8 bytes
-
-def unpack_4bit(buf):
-    """Takes raw bytes, returns complex numpy array"""
-    raw=np.frombuffer(buf,'int8')
-    re=np.asarray(np.right_shift(np.bitwise_and(raw, 0xf0), 4), dtype='int8')
-    re[re>8]=re[re>8]-16
-    im=np.asarray(np.bitwise_and(raw, 0x0f), dtype='int8')
-    im[im>8]=im[im>8]-16
-    vec=1J*im+re # complex vector
-    return vec
+def unpack_4bit(buf, out=None):
+    """Takes raw bytes, returns complex numpy array (lookup-table unpacker, see baseband.py)"""
+    return baseband.unpack_4bit(buf, out=out, dtype="complex64")
 
 def unpack_packet(packet_raw_eth_frame, bits, spec_per_packet, bytes_per_packet):
     packet = packet_raw_eth_frame[UDP_PAYLOAD_START:UDP_PAYLOAD_START + bytes_per_packet]
     assert len(packet)==bytes_per_packet, "packet too small" # prob need try-catch
-    specno = np.frombuffer(packet, '>I', 1)
     if bits==4:
-        vec=unpack_4bit(packet[4:])
-        nchan=(len(vec)//spec_per_packet)//2
-        pol0=np.reshape(vec[::2], [spec_per_packet, nchan])
-        pol1=np.reshape(vec[1::2], [spec_per_packet, nchan])
+        specno, vec = baseband.unpack_4bit_packets(np.frombuffer(packet, dtype=np.uint8)[None, :], spec_per_packet)
+        pol0=vec[:, :, 0]
+        pol1=vec[:, :, 1]
     return pol0, pol1
 
 def get_4bit_packet_channel_stats(cap, acc_len, spec_per_packet, bytes_per_packet):
     """Takes 
 
-    cap : udp packet reader (pcapy.open_live object)
+    cap : udp packet reader (capture.Capture object, see capture.py)
     acc_len : int, the number of specs to accumulate
     spec_per_packet : 
     """
-    # Read a bunch of packets
+    # Read a bunch of packets, then unpack them all in one go
     npack=(acc_len + spec_per_packet - 1)//spec_per_packet
-    pol0,pol1,specno=[None]*npack,[None]*npack,[None]*npack
-    for i in range(npack):
-        rawpack = cap.next()[1]
-        specno[i] = np.frombuffer(rawpack[UDP_PAYLOAD_START:UDP_PAYLOAD_START + bytes_per_packet], '>I', 1)[0]
-        pol0[i],pol1[i] = unpack_packet(rawpack, 4, spec_per_packet, bytes_per_packet)
-    # Estimate stdev in each channel
-    pol0,pol1 = np.vstack(pol0)[:acc_len,:], np.vstack(pol1)[:acc_len,:]
-    std0re = np.std(np.real(pol0),axis=0)
-    std0im = np.std(np.imag(pol0),axis=0)
-    std1re = np.std(np.real(pol1),axis=0)
-    std1im = np.std(np.imag(pol1),axis=0)
+    packets=np.empty((npack, bytes_per_packet), dtype=np.uint8)
+    i=0
+    while i < npack:
+        i += cap.read_block(packets[i:])
+    specno, vec = baseband.unpack_4bit_packets(packets, spec_per_packet)
+    specno = list(specno)
+    # Estimate stdev in each channel, accumulating in float64 (the samples are complex64)
+    pol0,pol1 = vec[:acc_len,:,0], vec[:acc_len,:,1]
+    std0re = np.std(np.real(pol0),axis=0,dtype=np.float64)
+    std0im = np.std(np.imag(pol0),axis=0,dtype=np.float64)
+    std1re = np.std(np.real(pol1),axis=0,dtype=np.float64)
+    std1im = np.std(np.imag(pol1),axis=0,dtype=np.float64)
     return std0re,std0im,std1re,std1im,pol0,pol1,specno
 
-def write_header(file_object, chans, spec_per_packet, bytes_per_packet, bits):
+def write_header(file_object, chans, spec_per_packet, bytes_per_packet, bits, clock=None):
+    """clock: a timing.GpsClock to take the time and position from, rather than opening the LB with lb_read"""
     have_trimble = True
     header_bytes = 8*10 + 8*len(chans) # 8 bytes per element in the header
-    gpsread = lbtools_l.lb_read()
+    if clock is not None:
+        utc, err = clock.now()
+        fix = clock.source.latest()
+        gpsread = (None if utc is None else int(utc), None if fix is None else fix.auxdat, None)
+        if utc is not None:
+            logger.info(f"File GPS time {utc:.6f} +/- {err*1e3:.3f} ms")
+    else:
+        gpsread = lbtools_l.lb_read()
     gps_time = gpsread[0]
     if gps_time is None:
         logger.info('File timestamp coming from Sparrow clock. This is unreliable.')
@@ -142,39 +142,22 @@ if __name__=="__main__":
     #logger.info(f"# (2) UDP packet destination port: {dest_prt}")
     FILE_SIZE=config_file.getfloat("baseband", "file_size")
     HOST=config_file.get("networking", "host")
+    CAPTURE_BACKEND=config_file.get("networking", "capture_backend", fallback="pcap")
+    CAPTURE_BLOCK_PACKETS=config_file.getint("networking", "capture_block_packets", fallback=256)
+    CAPTURE_BUFFERS=config_file.getint("networking", "capture_buffers", fallback=64)
+    LOSS_LOG_INTERVAL=config_file.getfloat("baseband", "loss_log_interval", fallback=60.)
     MAX_BYTES_PER_PACKET=config_file.getint("networking", "max_bytes_per_packet")
     CHANNELS_STRING=config_file.get("baseband", "channels")
     BITS=config_file.getint("baseband", "bits") # 1 or 4
     FPGFILE=config_file.get("paths", "fpgfile")
     COEFFS_BINARY_PATH=config_file.get("paths", "coeffs_binary_path")
     ADC_CLK=config_file.getint("baseband", "adc_clk")
+    GPS_READER=config_file.getboolean("baseband", "gps_reader", fallback=False)
 
     ## Construct FPGA and AlbatrosDigitizer (SparrowAlbatros) object without tuning
     fpga=casperfpga.CasperFpga(HOST,transport=casperfpga.KatcpTransport)
     sparrow=AlbatrosDigitizer(fpga,FPGFILE,ADC_CLK,logger)
 
-    ## ==== Set up comms ====
-    max_bytes=65565
-    #sock=socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    #bufsize=sock.getsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF)
-    #logger.info(f"UDP buf size in bytes: {bufsize}")
-    ## timeout prevents hanging on sock.recvfrom_into(packet, bytes_per_packet) after overheat
-    #sock.settimeout(10)
-    #try:
-    #    sock.bind((DEST_IP, DEST_PRT))
-    #    #sock.bind(('0.0.0.0', DEST_PRT))
-    #    logger.info(f"Connected to {DEST_IP}:{DEST_PRT}")
-    #except:
-    #    logger.error(f"Cannot bind to {DEST_IP}:{DEST_PRT}")
-
-    #sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.ntohs(3))
-    #sock.bind(('eth0', 0))
-    snaplen, promisc, timeout_ms = 65535, 1, 1000
-    cap = pcapy.open_live('eth0', snaplen, promisc, timeout_ms)
-    #cap.set_buffer_size(200 * 1024 * 1024)
-    cap.setfilter("udp and dst port 7417 and dst host 10.10.11.99 and src host 192.168.41.10")
-    UDP_PORT = 7417
-
     chans_fpga=utils.get_channels_from_str(CHANNELS_STRING, BITS)
     # chans_fpga is a sequence made for the fpga reorder block, channels is an array for numpy 
     spec_per_packet=utils.get_nspec(chans_fpga, max_nbyte=MAX_BYTES_PER_PACKET)
@@ -191,6 +174,11 @@ if __name__=="__main__":
     logger.info(f"Bytes per packet: {bytes_per_packet}")
     logger.info(f"Num packets per file: {num_of_packets_per_file}")
     logger.info(f"Num spectra per file: {spec_per_file}")
+
+    ## ==== Set up comms ====
+    # Packets are read and written to disk a block at a time, see capture.py for the backends
+    cap=capture.get_capture_from_config(config_file, bytes_per_packet)
+    logger.info(f"Capture backend: {CAPTURE_BACKEND}, {CAPTURE_BLOCK_PACKETS} packets per block")
     
     # Autotuning
     if BITS==4:
@@ -212,43 +200,58 @@ if __name__=="__main__":
     assert os.path.isdir(bbpath), "Drive not mounted, crashing program"
     print("bytes_per_packet", bytes_per_packet)
     #input("[Enter to continue, ^c to exit]")
+    # Capture runs on its own thread into a ring of CAPTURE_BUFFERS blocks, this thread only
+    # writes them to disk, so a slow drive eats buffers rather than dropping packets
+    pipe=capture.CaptureThread(cap, block_packets=CAPTURE_BLOCK_PACKETS, nbuf=CAPTURE_BUFFERS)
+    logger.info(f"Capture buffers: {CAPTURE_BUFFERS} ({pipe.buffers.nbytes/1e6:.1f} MB)")
+    pipe.start()
+    clock=None
+    bus=metadata_service.connect(config_file, logger)
+    if bus is not None:
+        # the metadata service holds the GPS, header times come from its clock fit
+        logger.info("Taking GPS times from the metadata service")
+        clock=metadata_service.SharedGpsClock(bus)
+    elif GPS_READER:
+        # header times from a fit to the GPS fixes instead of opening the LB for every file
+        clock=timing.GpsClock(lbtools_l.GpsReader(logger=logger).start(), logger=logger)
+    pending=None # block that straddles a file boundary
+    # Follows specno of every packet, writes a gap list next to each file, see baseband.py
+    losses=baseband.LossTracker(spec_per_packet, window=LOSS_LOG_INTERVAL)
+    last_loss_log=time.time()
     while True:
         dirtime=str(int(time.time()))[:5] # first five digitis of ctime
         if not os.path.isdir(join(bbpath, dirtime)):
             os.mkdir(join(bbpath, dirtime))
         fname=f"{int(time.time())}.raw"
         fpath=join(bbpath, dirtime, fname)
-        with open(fpath, "wb", buffering=20*1024*1024) as bbfile:
-            write_header(bbfile, chans_fpga, spec_per_packet, bytes_per_packet, BITS)
-            for i in range(num_of_packets_per_file):
-                #print(i,end=',')
-                try:
-                    (header, packet) = cap.next()
-                    bbfile.write(packet[UDP_PAYLOAD_START:UDP_PAYLOAD_START + bytes_per_packet])
-                    sn = int.from_bytes(packet[UDP_PAYLOAD_START:UDP_PAYLOAD_START + 4], byteorder='big', signed=False)
-                    if i == 0:
-                        start_sn = sn
-                except Exception as e:
-                    logger.warning(f"Ignoring exception {e}")
-                    continue
-        print(f"num packets per file {num_of_packets_per_file}")
-        print(f"spec_per_packet {spec_per_packet}")
-        print(f"sn {sn}")
-        print(f"start sn {start_sn}")
-        missing_frac = 1. - float(num_of_packets_per_file * spec_per_packet)/(sn - start_sn + spec_per_packet)
-        perc_missing = missing_frac * 100
+        # unbuffered, each block of payloads is already one big contiguous write
+        with open(fpath, "wb", buffering=0) as bbfile:
+            write_header(bbfile, chans_fpga, spec_per_packet, bytes_per_packet, BITS, clock)
+            losses.start_file()
+            npacket=0
+            while npacket < num_of_packets_per_file:
+                if pending is None:
+                    got=pipe.get(timeout=10)
+                    if got is None:
+                        if pipe.error is not None:
+                            raise pipe.error
+                        logger.warning("No packets received before timeout")
+                        continue
+                    ibuf, block=got
+                    pending=block
+                k=min(len(pending), num_of_packets_per_file-npacket)
+                bbfile.write(pending[:k])
+                losses.update(pending[:k, :4].copy().view(">u4")[:, 0])
+                npacket += k
+                pending=pending[k:]
+                if len(pending) == 0:
+                    pipe.release(ibuf)
+                    pending=None
+                if time.time() - last_loss_log > LOSS_LOG_INTERVAL:
+                    logger.info(f"Packet loss over last {LOSS_LOG_INTERVAL:.0f}s: {losses.rolling_loss()*100:.5f}%")
+                    last_loss_log=time.time()
+        summary=losses.end_file(fpath)
+        perc_missing = summary["loss"] * 100
         logger.info(f"Wrote file to {fpath}. Missing percentage of packets is {perc_missing:.5f}")
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+        logger.info(f"{summary['missing']} packets missing in {summary['gaps']} gaps, {summary['reordered']} out of order, specno {summary['first_specno']} to {summary['last_specno']}")
+        logger.info(f"Capture stats: {pipe.stats()}")
@@ -1,4 +1,3 @@
-import casperfpga
 import argparse
 import datetime
 from configparser import ConfigParser
@@ -11,12 +10,15 @@ import sparrow_albatros
 import time
 import numpy as np
 import lbtools_l
+import timing
+import metadata_service
 import sys
 
 if __name__=="__main__":
     parser=argparse.ArgumentParser()
     parser.add_argument("-c", "--configfile", type=str, default="config.ini", help="Config file that defines DAQ software parameters including data storage paths, fpga register values, and other configuration variables.")
     parser.add_argument("-d", "--debug", action="store_true", help="Print log info to stdout")
+    parser.add_argument("--mock", action="store_true", help="Read from a simulated board (mock_fpga.MockFpga) instead of the Sparrow, for testing")
     args=parser.parse_args()
     config_file=ConfigParser()
     config_file.read(args.configfile)
@@ -61,16 +63,56 @@ if __name__=="__main__":
     logger.info(f"# (9) Bitstream (.fpg) file path: {FPGFILE}")
     ADC_CLK=config_file.get("baseband", "adc_clk")
     logger.info(f"# (10) ADC clock set to: {ADC_CLK}")
+    SCIO_CHUNK_FRAMES=config_file.getint("spectra", "scio_chunk_frames", fallback=64)
+    logger.info(f"# (11) Scio compression chunk size (frames): {SCIO_CHUNK_FRAMES}")
+    ASYNC_SCIO_WRITES=config_file.getboolean("spectra", "async_scio_writes", fallback=False)
+    SCIO_QUEUE_SIZE=config_file.getint("spectra", "scio_queue_size", fallback=16)
+    SCIO_FLUSH_INTERVAL=config_file.getfloat("spectra", "scio_flush_interval", fallback=None)
+    logger.info(f"# (12) Async scio writes: {ASYNC_SCIO_WRITES} (queue size {SCIO_QUEUE_SIZE}, flush interval {SCIO_FLUSH_INTERVAL})")
+    SCIO_VERSION=config_file.getint("spectra", "scio_version", fallback=1)
+    logger.info(f"# (13) Scio file version: {SCIO_VERSION}")
+    ACC_WAIT_GUARD=config_file.getfloat("spectra", "acc_wait_guard", fallback=0.01)
+    ACC_POLL_INTERVAL=config_file.getfloat("spectra", "acc_poll_interval", fallback=0.002)
+    logger.info(f"# (14) Poll acc_cnt every {ACC_POLL_INTERVAL} s from {ACC_WAIT_GUARD} s before each accumulation is due")
+    GPS_READER=config_file.getboolean("spectra", "gps_reader", fallback=False)
+    logger.info(f"# (15) Keep the GPS open in a reader thread: {GPS_READER}")
     logger.info("#"*50)
 
+    gps=None
+    bus=None
+    clock=None
     try:
-        fpga=casperfpga.CasperFpga(HOST,transport=casperfpga.KatcpTransport)
+        if args.mock:
+            import mock_fpga
+            logger.info("Using a mock FPGA, data are simulated")
+            fpga=mock_fpga.MockFpga(acc_len=ACC_LEN)
+            FPGFILE=None # nothing to read the design from
+        else:
+            import casperfpga
+            fpga=casperfpga.CasperFpga(HOST,transport=casperfpga.KatcpTransport)
         sparrow=sparrow_albatros.AlbatrosDigitizer(fpga,FPGFILE,ADC_CLK,logger)
         #sparrow.cfpga.get_system_information(FPGFILE) # need this?
         pols=POLS.split()
         metadata_registers=METADATA_REGISTERS.split()
+        watcher=sparrow.watch_accumulations(guard=ACC_WAIT_GUARD, poll=ACC_POLL_INTERVAL)
+        logger.info(f"Accumulation period {watcher.nominal_period:.3f} s at FPGA clock {watcher.fpga_clk_mhz:.2f} MHz")
+        pol_buffers=sparrow.make_pol_buffers(pols, ">2048q") # decoded into every accumulation, scio copies on append
+        read_gps=lbtools_l.lb_read
+        if use_gps:
+            bus=metadata_service.connect(config_file, logger)
+        if bus is not None:
+            # the metadata service holds the GPS, accumulation times come from its clock fit
+            logger.info("Taking GPS times from the metadata service")
+            read_gps=bus.read
+            clock=metadata_service.SharedGpsClock(bus)
+        elif use_gps and GPS_READER:
+            gps=lbtools_l.GpsReader(logger=logger).start()
+            gps.wait_for_fix(timeout=3)
+            read_gps=gps.read
+            # accumulation times come from a fit to the fixes against the monotonic clock
+            clock=timing.GpsClock(gps, logger=logger)
         if use_gps:
-            gps_tstamp = lbtools_l.lb_read()[0]
+            gps_tstamp = read_gps()[0]
             if gps_tstamp is None:
                 logger.info("Trying to use GPS clock but unable to read from LB.")
             else:
@@ -89,75 +131,138 @@ if __name__=="__main__":
             start_raw_files = {}
             end_raw_files = {}
             scio_files = {}
-            if use_gps:
-                file_gps_timestamp1 = open(join(outsubdir,"time_gps_start.raw"),"w")
-                file_gps_timestamp2 = open(join(outsubdir,"time_gps_stop.raw"),"w")
-            file_sys_timestamp1 = open(join(outsubdir,"time_sys_start.raw"),"w")
-            file_sys_timestamp2 = open(join(outsubdir,"time_sys_stop.raw"),"w")
-            file_adc_temp = open(join(outsubdir,"adc_temp.raw"),"w")
-            for register in metadata_registers:
-                start_raw_files[register] = open(join(outsubdir,f"{register}1.raw"),"w")
-                end_raw_files[register] = open(join(outsubdir,f"{register}2.raw"),"w")
+            meta_columns = None
+            if SCIO_VERSION == 1:
+                if use_gps:
+                    file_gps_timestamp1 = open(join(outsubdir,"time_gps_start.raw"),"w")
+                    file_gps_timestamp2 = open(join(outsubdir,"time_gps_stop.raw"),"w")
+                if use_gps and clock is not None:
+                    # the whole-second uint32 files stay as they were, the clock fit's sub-ms times go alongside as float64
+                    file_gps_utc1 = open(join(outsubdir,"time_gps_start_utc.raw"),"w")
+                    file_gps_utc2 = open(join(outsubdir,"time_gps_stop_utc.raw"),"w")
+                    file_gps_err = open(join(outsubdir,"time_gps_err.raw"),"w")
+                file_sys_timestamp1 = open(join(outsubdir,"time_sys_start.raw"),"w")
+                file_sys_timestamp2 = open(join(outsubdir,"time_sys_stop.raw"),"w")
+                file_adc_temp = open(join(outsubdir,"adc_temp.raw"),"w")
+                for register in metadata_registers:
+                    start_raw_files[register] = open(join(outsubdir,f"{register}1.raw"),"w")
+                    end_raw_files[register] = open(join(outsubdir,f"{register}2.raw"),"w")
+            else:
+                # v2 scio files carry what used to go in the .raw files as per-frame columns, same names
+                meta_columns = [("time_sys_start","float64"), ("time_sys_stop","float64"), ("adc_temp","int64")]
+                if use_gps:
+                    meta_columns += [("time_gps_start","float64"), ("time_gps_stop","float64"), ("time_gps_err","float64")]
+                for register in metadata_registers:
+                    meta_columns += [(f"{register}1","int64"), (f"{register}2","int64")]
             for pol in pols:
                 scio_files[pol] = scio.scio(join(outsubdir,f"{pol}.scio"), 
                         diff=DIFF_SCIO_FILES, 
-                        compress=COMPRESS_SCIO_FILES)
-            acc_cnt = 0
+                        compress=COMPRESS_SCIO_FILES,
+                        chunk_frames=SCIO_CHUNK_FRAMES,
+                        async_write=ASYNC_SCIO_WRITES,
+                        queue_size=SCIO_QUEUE_SIZE,
+                        flush_interval=SCIO_FLUSH_INTERVAL,
+                        version=SCIO_VERSION,
+                        meta=meta_columns)
+            read_times = []
+            torn_reads = 0
             while time.time()-start_time < 60*60: # new folder every hour
-                # read accumulation count from FPGA registers
-                new_acc_cnt = sparrow.cfpga.registers.acc_cnt.read_uint() 
-                if new_acc_cnt > acc_cnt:
-                    if use_gps:
-                        startread = lbtools_l.lb_read()
+                # sleeps until just before the next accumulation is due, then polls acc_cnt for it
+                acc_cnt = watcher.wait(timeout=max(10*watcher.period, 1))
+                if acc_cnt is not None:
+                    if use_gps and clock is None:
+                        startread = read_gps()
                         start_gps_timestamp = startread[0] 
-                    start_sys_timestamp = time.time()
-                    start_reg_data = sparrow.read_registers(metadata_registers)
-                    pol_data = sparrow.read_pols(pols, ">2048q")
-                    end_reg_data = sparrow.read_registers(metadata_registers)
-                    end_sys_timestamp = time.time()
-                    if use_gps:
-                        endread = lbtools_l.lb_read()
+                    pol_data, start_reg_data, end_reg_data, read_timing = sparrow.read_accumulation(pols, metadata_registers, ">2048q", out=pol_buffers)
+                    start_sys_timestamp = read_timing["start"]
+                    end_sys_timestamp = read_timing["stop"]
+                    gps_err = np.nan # unknown for whole-second lb_read times
+                    if use_gps and clock is not None:
+                        clock.update()
+                        start_gps_timestamp, gps_err = clock.to_utc(read_timing["start_mono_ns"])
+                        end_gps_timestamp, _ = clock.to_utc(read_timing["stop_mono_ns"])
+                    elif use_gps:
+                        endread = read_gps()
                         end_gps_timestamp = endread[0]
-                    read_time = end_sys_timestamp - start_sys_timestamp
+                    read_time = read_timing["latency"]
+                    read_times.append(read_time)
                     if use_gps:
                         if start_gps_timestamp is None:
                             start_gps_timestamp = 0
                         if end_gps_timestamp is None:
                             end_gps_timestamp = 0
                     if start_reg_data["acc_cnt"] != end_reg_data["acc_cnt"]:
-                        logger.warning("Accumulation counter changed during read")
-                    for register in metadata_registers:
-                        np.array(start_reg_data[register]).tofile(start_raw_files[register])
-                        start_raw_files[register].flush()
-                        np.array(end_reg_data[register]).tofile(end_raw_files[register])
-                        end_raw_files[register].flush()
-                    np.array(start_sys_timestamp).tofile(file_sys_timestamp1)
-                    np.array(sparrow.get_adc_temp()).tofile(file_adc_temp)
-                    np.array(end_sys_timestamp).tofile(file_sys_timestamp2)
-                    if use_gps:
-                        np.array(start_gps_timestamp, dtype=np.uint32).tofile(file_gps_timestamp1)
-                        np.array(end_gps_timestamp, dtype=np.uint32).tofile(file_gps_timestamp2)
-                    file_sys_timestamp1.flush() 
-                    file_adc_temp.flush() 
-                    file_sys_timestamp2.flush()
-                    if use_gps:
-                        file_gps_timestamp1.flush()
-                        file_gps_timestamp2.flush()
+                        logger.warning(f"Accumulation counter changed during read ({read_time*1e3:.1f} ms)")
+                        torn_reads += 1
+                    adc_temp = sparrow.get_adc_temp()
+                    frame_meta = None
+                    if SCIO_VERSION == 1:
+                        for register in metadata_registers:
+                            np.array(start_reg_data[register]).tofile(start_raw_files[register])
+                            start_raw_files[register].flush()
+                            np.array(end_reg_data[register]).tofile(end_raw_files[register])
+                            end_raw_files[register].flush()
+                        np.array(start_sys_timestamp).tofile(file_sys_timestamp1)
+                        np.array(adc_temp).tofile(file_adc_temp)
+                        np.array(end_sys_timestamp).tofile(file_sys_timestamp2)
+                        if use_gps:
+                            np.array(start_gps_timestamp, dtype=np.uint32).tofile(file_gps_timestamp1)
+                            np.array(end_gps_timestamp, dtype=np.uint32).tofile(file_gps_timestamp2)
+                        if use_gps and clock is not None:
+                            np.array(start_gps_timestamp, dtype=np.float64).tofile(file_gps_utc1)
+                            np.array(end_gps_timestamp, dtype=np.float64).tofile(file_gps_utc2)
+                            np.array(np.nan if gps_err is None else gps_err, dtype=np.float64).tofile(file_gps_err)
+                        file_sys_timestamp1.flush() 
+                        file_adc_temp.flush() 
+                        file_sys_timestamp2.flush()
+                        if use_gps:
+                            file_gps_timestamp1.flush()
+                            file_gps_timestamp2.flush()
+                        if use_gps and clock is not None:
+                            file_gps_utc1.flush()
+                            file_gps_utc2.flush()
+                            file_gps_err.flush()
+                    else:
+                        frame_meta = {"time_sys_start":start_sys_timestamp, "time_sys_stop":end_sys_timestamp, "adc_temp":adc_temp}
+                        if use_gps:
+                            frame_meta["time_gps_start"] = start_gps_timestamp
+                            frame_meta["time_gps_stop"] = end_gps_timestamp
+                            frame_meta["time_gps_err"] = np.nan if gps_err is None else gps_err
+                        for register in metadata_registers:
+                            frame_meta[f"{register}1"] = start_reg_data[register]
+                            frame_meta[f"{register}2"] = end_reg_data[register]
                     for pol in pols:
-                        scio_files[pol].append(pol_data[pol])
-                time.sleep(1) # wait so that while loop not always going
+                        scio_files[pol].append(pol_data[pol], frame_meta)
+            wstats = watcher.stats()
+            logger.info(f"Accumulation period {wstats['period']*1e3:.3f} ms (nominal {wstats['nominal_period']*1e3:.3f}), tick jitter {wstats['jitter_std']*1e3:.2f} ms rms {wstats['jitter_max']*1e3:.2f} ms max, "
+                        f"latency {wstats['latency_mean']*1e3:.2f} ms mean, {wstats['polls_per_wait']:.1f} polls per accumulation, {wstats['missed']} missed")
+            if read_times:
+                logger.info(f"Read {len(read_times)} accumulations in {np.mean(read_times)*1e3:.1f} ms mean, {np.max(read_times)*1e3:.1f} ms max, {torn_reads} torn")
             for pol in pols:
                 scio_files[pol].close()
-            for register in metadata_registers:
-                start_raw_files[register].close()
-                end_raw_files[register].close()
-            file_sys_timestamp1.close()
-            file_adc_temp.close()
-            file_sys_timestamp2.close()
-            if use_gps:
-                file_gps_timestamp1.close()
-                file_gps_timestamp2.close()
+                stats=scio_files[pol].stats
+                logger.info(f"Closed {pol} scio file: {stats['written']} frames written, max queue depth {stats['max_depth']}, blocked {stats['blocked']} times for {stats['blocked_time']:.3f} s")
+            if SCIO_VERSION == 1:
+                for register in metadata_registers:
+                    start_raw_files[register].close()
+                    end_raw_files[register].close()
+                file_sys_timestamp1.close()
+                file_adc_temp.close()
+                file_sys_timestamp2.close()
+                if use_gps:
+                    file_gps_timestamp1.close()
+                    file_gps_timestamp2.close()
+                if use_gps and clock is not None:
+                    file_gps_utc1.close()
+                    file_gps_utc2.close()
+                    file_gps_err.close()
     finally:
+        if gps is not None:
+            logger.info(f"GPS reader: {gps.stats()}, clock fit: {clock.stats()}")
+            gps.stop()
+        if bus is not None:
+            logger.info(f"Metadata service clock fit: {clock.stats()}, {bus.nretry} read retries")
+            bus.close()
         logger.info(f"Terminating DAQ at {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
 
 
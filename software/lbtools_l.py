@@ -1,7 +1,11 @@
+import collections
 import datetime
 import usb.core                 # https://github.com/pyusb/pyusb
 import struct
 import os
+import threading
+import time
+import ubx
 
 
 def usb_safe_cleanup(dev,interface):
@@ -156,11 +160,8 @@ def lb_read(ntry=1000, timeout=1000):
             usb_safe_cleanup(dev,interface)
             return tstamp, auxdat, gpstime
 
-    packet = None
-    nhead = 4
-    offset1 = 10
-    offset2 = 46
-
+    parser = ubx.UbxParser() # NAV-PVT packets span reads
+    pvt = None
     for j in range(ntry):
         try:
             data = dev.read(0x81, 64, timeout=timeout)
@@ -175,22 +176,11 @@ def lb_read(ntry=1000, timeout=1000):
             lb_set()
             return tstamp, auxdat, gpstime
 
-        if len(data) < nhead:
-            continue
-        # Look for nav-pvt packet somewhere in the line
-        for i in range(len(data)-nhead):
-            # Look for nav-pvt packet somewhere in the line
-            # Skip the bytes for packet id, class id, length, and gps time of week of the nav epoch
-             if data[i:i+nhead].tolist() == [0xb5, 0x62, 0x01, 0x07]:
-                # Check if nav-pvt packet appears too close to the end
-                if len(data) < i+offset2:
-                    break
-                # ...otherwise snarf the bits we care about
-                packet = data[i+offset1:i+offset2]
-                break
-        if packet:
+        pvts = parser.feed(data)
+        if pvts:
+            pvt = pvts[-1]
             break
-    if packet is None:
+    if pvt is None:
         print("lb_read: read failed")
         #usb.util.release_interface(dev, interface)
         #usb.util.dispose_resources(dev)
@@ -199,57 +189,9 @@ def lb_read(ntry=1000, timeout=1000):
         return tstamp, auxdat, gpstime
 
     try:
-        year = struct.unpack('<H', packet[0:2])
-        year = year[0]
-
-        month = struct.unpack('<B', packet[2:3])
-        month = month[0]
-
-        day = struct.unpack('<B', packet[3:4])
-        day = day[0]
-
-        hour = struct.unpack('<B', packet[4:5])
-        hour = hour[0]
-
-        minute = struct.unpack('<B', packet[5:6])
-        minute = minute[0]
-
-        second = struct.unpack('<B', packet[6:7])
-        second = second[0]
-    except:
-        print("lb_read(): bad tstamp unpack")
-        return tstamp, auxdat, gpstime
-
-    try:
-        datetime.datetime(year, month, day, hour, minute, second)
-    except:
+        tstamp, auxdat, gpstime = pvt.to_lb_read()
+    except ValueError:
         print("lb_read: bad datetime object")
-        return tstamp, auxdat, gpstime
-
-    try:
-        validity = packet[7]
-        validity = "{0:b}".format(validity)  # format as binary string to get the bitfield
-        validity = (4-len(validity))*'0'+validity # use the 4 bits of validity to check for a good reading
-
-        nano = struct.unpack('<l', packet[12:16])
-        nano = nano[0]*10**-9
-
-        lon = struct.unpack('<l', packet[20:24])
-        lon = lon[0]*10**-7
-
-        lat = struct.unpack('<l', packet[24:28])
-        lat = lat[0]*10**-7
-
-        alt = struct.unpack('<l', packet[32:36])
-        alt = alt[0]*10**-3
-    except:
-        print("lb_read: bad auxdat unpack")
-        return tstamp, auxdat, gpstime
-
-    tstamp = (datetime.datetime(year,month,day,hour,minute,second)-datetime.datetime(1970,1,1)).total_seconds()
-    auxdat = (nano, validity, lon, lat, alt)
-    gpstime = datetime.datetime(year, month, day, hour, minute, second)
-
     return tstamp, auxdat, gpstime
 
 #====================================================================
@@ -277,3 +219,231 @@ def set_clock_lb(current_year=2021):
     to_exec='sudo date -s " %s "' % mytime.ctime()
     os.system(to_exec)
     return True
+
+#====================================================================
+VENDOR_LB = 0x1DD2     # Leo Bodnar's Vendor ID
+PRODUCT_MGPS = 0x2211  # Mini GPS product ID
+INTERFACE_MGPS = 0     # 0-based
+SETTING_MGPS = 0       # 0-based
+
+class LbUsbDevice():
+    """
+    The Leo Bodnar, found, detached from the kernel driver and claimed once
+    and then held open, unlike lb_read which does all that every call.
+    Raises IOError if the device can't be opened.
+    """
+    def __init__(self):
+        dev = usb.core.find(idVendor=VENDOR_LB, idProduct=PRODUCT_MGPS)
+        if dev is None:
+            raise IOError("failed to find USB device")
+        try:
+            if dev.is_kernel_driver_active(INTERFACE_MGPS):
+                dev.detach_kernel_driver(INTERFACE_MGPS)
+            configuration = dev.get_active_configuration()
+            self.interface = configuration[(INTERFACE_MGPS, SETTING_MGPS)]
+            usb.util.claim_interface(dev, self.interface)
+            if configuration.bConfigurationValue != dev[0].bConfigurationValue:
+                dev.set_configuration(dev[0])
+        except Exception as e:
+            raise IOError(f"failed to open USB device: {e}")
+        self.dev = dev
+
+    def read(self, size=64, timeout=1000):
+        """One USB report, raises on timeout like pyusb."""
+        return self.dev.read(0x81, size, timeout=timeout)
+
+    def close(self):
+        usb_safe_cleanup(self.dev, self.interface)
+
+class FakeLbDevice():
+    """
+    Replays recorded USB reports in place of LbUsbDevice, for testing without
+    a Leo Bodnar. Reports come from record_reports (via load_reports) or are
+    cut from a stream of ubx.make_nav_pvt packets, one every `interval`
+    seconds, looping if `loop`.
+    """
+    def __init__(self, reports, interval=0.1, loop=True):
+        self.reports = [bytes(r) for r in reports]
+        self.interval = interval
+        self.loop = loop
+        self.i = 0
+        self.next_time = time.monotonic()
+        self.closed = False
+
+    def read(self, size=64, timeout=1000):
+        if self.closed:
+            raise IOError("device closed")
+        wait = self.next_time - time.monotonic()
+        if self.i >= len(self.reports) and not self.loop:
+            wait = float("inf")
+        if wait > timeout/1000:
+            time.sleep(timeout/1000)
+            raise TimeoutError("fake LB read timed out")
+        if wait > 0:
+            time.sleep(wait)
+        report = self.reports[self.i % len(self.reports)]
+        self.i += 1
+        self.next_time += self.interval
+        return report[:size]
+
+    def close(self):
+        self.closed = True
+
+def record_reports(fname, nreport=100, timeout=1000):
+    """Save raw USB reports from the Leo Bodnar, each as a >H length then the bytes, for FakeLbDevice."""
+    dev = LbUsbDevice()
+    try:
+        with open(fname, "wb") as f:
+            for i in range(nreport):
+                data = bytes(dev.read(64, timeout))
+                f.write(struct.pack(">H", len(data)) + data)
+    finally:
+        dev.close()
+
+def load_reports(fname):
+    """Reports saved by record_reports."""
+    reports = []
+    with open(fname, "rb") as f:
+        while True:
+            head = f.read(2)
+            if len(head) < 2:
+                break
+            reports.append(f.read(struct.unpack(">H", head)[0]))
+    return reports
+
+GpsFix = collections.namedtuple("GpsFix", ["tstamp", "auxdat", "gpstime", "mono_ns"])
+GpsFix.__doc__ = "lb_read's tstamp, auxdat and gpstime, and time.monotonic_ns() when the report carrying it was read."
+
+def _is_timeout(e):
+    return isinstance(e, TimeoutError) or getattr(e, "errno", None) in (110, 60) or "timeout" in type(e).__name__.lower()
+
+class GpsReader():
+    """
+    Holds the Leo Bodnar open in a background thread that reads reports as
+    they arrive and keeps the latest NAV-PVT fix, so callers get it from memory
+    instead of opening the device. The device can only be claimed by one
+    process at a time.
+
+    Usage::
+
+        gps = GpsReader().start()
+        tstamp, auxdat, gpstime = gps.read() # drop-in for lb_read()
+        fix = gps.latest() # or the GpsFix with its monotonic capture time
+        fixes = gps.fixes_since(fix.mono_ns) # every fix after that one
+    """
+    def __init__(self, open_device=LbUsbDevice, timeout=1000, max_age=2., reconnect_interval=5., history=4096, logger=None):
+        """
+        :param open_device: Returns an object with read(size, timeout) and close(),
+            LbUsbDevice or e.g. lambda: FakeLbDevice(reports).
+        :param timeout: USB read timeout in milliseconds.
+        :param max_age: Seconds after which read() treats the latest fix as stale.
+        :param reconnect_interval: Seconds between attempts to reopen the device.
+        :param history: Number of recent fixes kept for fixes_since, about an hour at 1 Hz.
+        """
+        self.open_device = open_device
+        self.timeout = timeout
+        self.max_age = max_age
+        self.reconnect_interval = reconnect_interval
+        self.logger = logger
+        self._fix = None # replaced, never modified, so readers need no lock
+        self.history = collections.deque(maxlen=history) # appended by the thread only
+        self._stop = threading.Event()
+        self.thread = None
+        self.parser = ubx.UbxParser()
+        self.nreport = 0
+        self.nfix = 0
+        self.nerror = 0
+        self.nopen = 0
+
+    def _log(self, msg):
+        if self.logger is not None:
+            self.logger.warning(msg)
+        else:
+            print(f"GpsReader: {msg}")
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="gps_reader", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        dev = None
+        while not self._stop.is_set():
+            if dev is None:
+                try:
+                    dev = self.open_device()
+                    self.parser = ubx.UbxParser()
+                    self.nopen += 1
+                except Exception as e:
+                    self._log(f"can't open GPS: {e}")
+                    self._stop.wait(self.reconnect_interval)
+                    continue
+            try:
+                data = dev.read(64, self.timeout)
+            except Exception as e:
+                if _is_timeout(e):
+                    continue
+                self.nerror += 1
+                self._log(f"read error, reopening: {e}")
+                try:
+                    dev.close()
+                except Exception:
+                    pass
+                dev = None
+                if self.open_device is LbUsbDevice:
+                    lb_set() # as lb_read does, put it back in nav-data mode
+                self._stop.wait(self.reconnect_interval)
+                continue
+            mono_ns = time.monotonic_ns()
+            self.nreport += 1
+            for pvt in self.parser.feed(data, mono_ns):
+                try:
+                    fix = pvt.to_lb_read()
+                except ValueError:
+                    continue
+                self._fix = GpsFix(*fix, mono_ns)
+                self.history.append(self._fix)
+                self.nfix += 1
+        if dev is not None:
+            dev.close()
+
+    def latest(self):
+        """The most recent GpsFix, or None if there hasn't been one."""
+        return self._fix
+
+    def fixes_since(self, mono_ns=None):
+        """Fixes read after time.monotonic_ns() value mono_ns (all those kept if None), oldest first."""
+        fixes = list(self.history) # copied in one go, safe against the thread appending
+        if mono_ns is None:
+            return fixes
+        return [fix for fix in fixes if fix.mono_ns > mono_ns]
+
+    def age(self):
+        """Seconds since the latest fix was read, inf if there is none."""
+        fix = self._fix
+        if fix is None:
+            return float("inf")
+        return (time.monotonic_ns() - fix.mono_ns)*1e-9
+
+    def read(self):
+        """Like lb_read: tstamp, auxdat, gpstime of the latest fix, Nones if there is none younger than max_age."""
+        fix = self._fix
+        if fix is None or (time.monotonic_ns() - fix.mono_ns)*1e-9 > self.max_age:
+            return None, None, None
+        return fix.tstamp, fix.auxdat, fix.gpstime
+
+    def wait_for_fix(self, timeout=None):
+        """Block until there is a fix, return it or None on timeout."""
+        t0 = time.monotonic()
+        while self._fix is None and (timeout is None or time.monotonic() - t0 < timeout):
+            time.sleep(0.01)
+        return self._fix
+
+    def stats(self):
+        return {"reports": self.nreport, "fixes": self.nfix, "errors": self.nerror, "opens": self.nopen, "age": self.age(),
+                "parser": self.parser.stats()}
@@ -0,0 +1,260 @@
+"""
+Local metadata bus shared by dump_spectra.py and dump_baseband.py.
+
+One process, this script, holds the Leo Bodnar (lbtools_l.GpsReader plus a
+timing.GpsClock fit) and publishes the latest fix and the fit to a shared
+memory segment. The DAQs attach to it with MetadataClient and read it
+without any USB traffic, so they stop fighting over the one GPS and their
+timestamps come from the same clock fit. It doesn't talk to the FPGA, the
+DAQs read their registers themselves as before.
+
+The segment holds a single fixed-layout record (LAYOUT) under a seqlock:
+the writer makes `seq` odd, writes the record and its CRC32, and makes
+`seq` even again. A reader copies the record and accepts the copy only if
+`seq` was even and unchanged around it and the CRC matches, otherwise it
+tries again. Readers never block the writer.
+
+The clock is published as the fit itself, not as a time, so each client
+converts its own time.monotonic_ns() (the same clock in every process) to
+UTC with timing.GpsClock.to_utc.
+
+Usage::
+
+    python metadata_service.py -c config.ini &
+
+    client = metadata_service.connect(config_file)
+    if client is not None:
+        clock = metadata_service.SharedGpsClock(client)
+        utc, err = clock.now()
+"""
+import argparse
+from configparser import ConfigParser
+import datetime
+import logging
+from multiprocessing import shared_memory, resource_tracker
+import os
+import sys
+import time
+import zlib
+import numpy as np
+import lbtools_l
+import timing
+
+LAYOUT = np.dtype([
+    ("seq", "<u8"), ("crc", "<u4"), ("version", "<u4"),
+    # everything from here on is covered by the CRC
+    ("pid", "<i8"), ("publish_mono_ns", "<i8"), ("publish_time", "<f8"),
+    ("have_fix", "<u1"), ("fix_valid", "<u1"), ("fix_tstamp", "<f8"), ("fix_nano", "<f8"),
+    ("fix_lat", "<f8"), ("fix_lon", "<f8"), ("fix_alt", "<f8"), ("fix_mono_ns", "<i8"),
+    ("have_fit", "<u1"), ("fit_mono_ref", "<i8"), ("fit_utc_ref", "<f8"), ("fit_offset", "<f8"),
+    ("fit_rate", "<f8"), ("fit_xmean", "<f8"), ("fit_sxx", "<f8"), ("fit_rms", "<f8"), ("fit_n", "<i8"),
+], align=True)
+VERSION = 1
+CRC_START = LAYOUT.fields["pid"][1]
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before python 3.13 attaching registers the segment with the resource
+        # tracker, which would unlink it when this client exits
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+class MetadataBus():
+    """The publishing side: creates the segment and writes records to it."""
+    def __init__(self, name="albatros_metadata"):
+        self.name = name
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=LAYOUT.itemsize)
+        except FileExistsError:
+            # left behind by a service that died, start afresh
+            old = _attach(name)
+            old.close()
+            old.unlink()
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=LAYOUT.itemsize)
+        self.rec = np.ndarray((), dtype=LAYOUT, buffer=self.shm.buf)
+        self.raw = np.ndarray(LAYOUT.itemsize, dtype=np.uint8, buffer=self.shm.buf)
+        self.staging_bytes = np.zeros(LAYOUT.itemsize, dtype=np.uint8)
+        self.staging = self.staging_bytes.view(LAYOUT)[0]
+        self.staging["version"] = VERSION
+        self.staging["pid"] = os.getpid()
+        self.seq = 0
+        self.npublish = 0
+
+    def publish(self, fix=None, fit=None):
+        """
+        :param fix: Latest lbtools_l.GpsFix, or None.
+        :param fit: A timing.GpsClock's fit tuple (GpsClock.fit()), or None.
+        """
+        s = self.staging
+        s["publish_mono_ns"] = time.monotonic_ns()
+        s["publish_time"] = time.time()
+        s["have_fix"] = fix is not None
+        if fix is not None:
+            nano, validity, lon, lat, alt = fix.auxdat
+            s["fix_valid"] = int(validity, 2)
+            s["fix_tstamp"], s["fix_nano"] = fix.tstamp, nano
+            s["fix_lat"], s["fix_lon"], s["fix_alt"] = lat, lon, alt
+            s["fix_mono_ns"] = fix.mono_ns
+        s["have_fit"] = fit is not None
+        if fit is not None:
+            mono_ref, utc_ref, offset, rate, xmean, sxx, rms, n = fit
+            s["fit_mono_ref"], s["fit_utc_ref"], s["fit_offset"], s["fit_rate"] = mono_ref, utc_ref, offset, rate
+            s["fit_xmean"], s["fit_sxx"], s["fit_rms"], s["fit_n"] = xmean, sxx, np.nan if rms is None else rms, n
+        body = self.staging_bytes
+        s["crc"] = zlib.crc32(body[CRC_START:])
+        self.seq += 1 # odd: write in progress
+        self.rec["seq"] = self.seq
+        self.raw[8:] = body[8:]
+        self.seq += 1
+        self.rec["seq"] = self.seq
+        self.npublish += 1
+
+    def close(self):
+        del self.rec, self.raw
+        self.shm.close()
+        self.shm.unlink()
+
+class MetadataClient():
+    """The reading side, for the DAQs. Raises FileNotFoundError if the service isn't running."""
+    def __init__(self, name="albatros_metadata", max_age=5., fix_max_age=2.):
+        """
+        :param max_age: Seconds without a publish after which the service counts as dead.
+        :param fix_max_age: Seconds after which read() no longer returns a fix, as GpsReader's max_age.
+        """
+        self.shm = _attach(name)
+        self.raw = np.ndarray(LAYOUT.itemsize, dtype=np.uint8, buffer=self.shm.buf)
+        self.max_age = max_age
+        self.fix_max_age = fix_max_age
+        self.nretry = 0
+
+    def snapshot(self, ntry=1000):
+        """A consistent copy of the record (a 0-d LAYOUT array), or None if the writer kept interfering."""
+        for i in range(ntry):
+            seq = int(self.raw[:8].view("<u8")[0])
+            if seq % 2 == 0:
+                copy = self.raw.copy()
+                rec = copy.view(LAYOUT)[0]
+                if int(self.raw[:8].view("<u8")[0]) == seq and seq > 0 \
+                        and zlib.crc32(copy[CRC_START:]) == int(rec["crc"]):
+                    return rec
+            self.nretry += 1
+            time.sleep(1e-5)
+        return None
+
+    def alive(self):
+        rec = self.snapshot()
+        return rec is not None and (time.monotonic_ns() - int(rec["publish_mono_ns"]))*1e-9 < self.max_age
+
+    def latest(self):
+        """Latest GPS fix as an lbtools_l.GpsFix, or None, so a client can stand in for a GpsReader."""
+        rec = self.snapshot()
+        if rec is None or not rec["have_fix"]:
+            return None
+        validity = "{0:b}".format(int(rec["fix_valid"]))
+        validity = (4-len(validity))*'0'+validity
+        tstamp = float(rec["fix_tstamp"])
+        gpstime = datetime.datetime(1970,1,1) + datetime.timedelta(seconds=tstamp)
+        return lbtools_l.GpsFix(tstamp, (float(rec["fix_nano"]), validity, float(rec["fix_lon"]), float(rec["fix_lat"]),
+                                         float(rec["fix_alt"])), gpstime, int(rec["fix_mono_ns"]))
+
+    def read(self):
+        """Like lb_read: tstamp, auxdat, gpstime of the latest fix, Nones if there is none younger than fix_max_age."""
+        fix = self.latest()
+        if fix is None or (time.monotonic_ns() - fix.mono_ns)*1e-9 > self.fix_max_age:
+            return None, None, None
+        return fix.tstamp, fix.auxdat, fix.gpstime
+
+    def fit(self):
+        """The publisher's clock fit, in timing.GpsClock.fit() form, or None."""
+        rec = self.snapshot()
+        if rec is None or not rec["have_fit"]:
+            return None
+        rms = float(rec["fit_rms"])
+        return (int(rec["fit_mono_ref"]), float(rec["fit_utc_ref"]), float(rec["fit_offset"]), float(rec["fit_rate"]),
+                float(rec["fit_xmean"]), float(rec["fit_sxx"]), None if np.isnan(rms) else rms, int(rec["fit_n"]))
+
+    def close(self):
+        del self.raw
+        self.shm.close()
+
+class SharedGpsClock(timing.GpsClock):
+    """A timing.GpsClock whose fit is the metadata service's, fixes are never added locally."""
+    def __init__(self, client, **kwargs):
+        super().__init__(source=client, **kwargs)
+
+    def update(self):
+        self._fit = self.source.fit()
+
+    def add_fix(self, utc, mono_ns):
+        raise RuntimeError("SharedGpsClock takes its fit from the metadata service")
+
+def connect(config_file, logger=None):
+    """A MetadataClient if [metadata_service] is enabled and the service is running, else None."""
+    if not config_file.getboolean("metadata_service", "enabled", fallback=False):
+        return None
+    name = config_file.get("metadata_service", "shm_name", fallback="albatros_metadata")
+    try:
+        client = MetadataClient(name)
+    except FileNotFoundError:
+        if logger is not None:
+            logger.warning(f"Metadata service enabled but segment {name} doesn't exist, is metadata_service.py running?")
+        return None
+    if not client.alive():
+        if logger is not None:
+            logger.warning(f"Metadata service on {name} isn't publishing")
+        client.close()
+        return None
+    return client
+
+if __name__=="__main__":
+    parser=argparse.ArgumentParser(description="Hold the GPS, publishing its fixes and clock fit to shared memory for the DAQs")
+    parser.add_argument("-c", "--configfile", type=str, default="config.ini", help="Config file")
+    parser.add_argument("-d", "--debug", action="store_true", help="Print log info to stdout")
+    parser.add_argument("--replay", type=str, default=None, help="Replay USB reports recorded with lbtools_l.record_reports instead of the GPS")
+    parser.add_argument("--replay-interval", type=float, default=0.1, help="Seconds between replayed reports")
+    args=parser.parse_args()
+    config_file=ConfigParser()
+    config_file.read(args.configfile)
+
+    logger=logging.getLogger("metadata_service")
+    logger.propagate=False
+    logger.setLevel(logging.INFO)
+    LOG_DIR=os.path.join(config_file.get("paths", "log_directory"), "metadata")
+    os.makedirs(LOG_DIR, exist_ok=True)
+    file_logger=logging.FileHandler(os.path.join(LOG_DIR, f"albatros_metadata_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.log"))
+    file_logger.setFormatter(logging.Formatter("%(asctime)s %(name)s %(message)s", "%Y-%m-%d %H:%M:%S"))
+    logger.addHandler(file_logger)
+    if args.debug:
+        logger.addHandler(logging.StreamHandler(sys.stdout))
+
+    if not config_file.getboolean("metadata_service", "enabled", fallback=False):
+        # the DAQs read the GPS themselves, holding it here would lock them out
+        logger.info("Metadata service disabled in config, exiting")
+        sys.exit(0)
+    SHM_NAME=config_file.get("metadata_service", "shm_name", fallback="albatros_metadata")
+    PUBLISH_INTERVAL=config_file.getfloat("metadata_service", "publish_interval", fallback=0.1)
+    logger.info(f"Publishing to {SHM_NAME} every {PUBLISH_INTERVAL} s")
+
+    if args.replay is not None:
+        reports=lbtools_l.load_reports(args.replay)
+        gps=lbtools_l.GpsReader(open_device=lambda: lbtools_l.FakeLbDevice(reports, interval=args.replay_interval), logger=logger).start()
+    else:
+        gps=lbtools_l.GpsReader(logger=logger).start()
+    clock=timing.GpsClock(gps, logger=logger)
+    bus=MetadataBus(SHM_NAME)
+    last_log=time.monotonic()
+    try:
+        while True:
+            clock.update()
+            bus.publish(gps.latest(), clock.fit())
+            if time.monotonic() - last_log > 600:
+                logger.info(f"GPS {gps.stats()}, clock {clock.stats()}, {bus.npublish} publishes")
+                last_log=time.monotonic()
+            time.sleep(PUBLISH_INTERVAL)
+    finally:
+        gps.stop()
+        bus.close()
+        logger.info("Metadata service stopped")
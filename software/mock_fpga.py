@@ -0,0 +1,264 @@
+"""
+Stand-in for casperfpga.CasperFpga, so the control code (SparrowAlbatros,
+AlbatrosDigitizer, Ads5404, Adf4351) and the DAQ loops can be tested and
+profiled without a Sparrow board.
+
+Implements the parts of the CasperFpga API this repo uses: `registers`,
+`snapshots`, `read`, `write`, `blindwrite`, `write_int`, `read_uint`,
+`read_int`, `estimate_fpga_clock`, `upload_to_ram_and_program`,
+`get_system_information` and `listdev`.
+
+The correlator is simulated: `acc_cnt` ticks once every acc_len*2048/fpga_clk
+seconds, counting from construction (as if config_fpga.py had already run) or
+from the last sync pulse, and pol00/pol11/pol01r/pol01i hold a
+deterministic (seeded by acc_cnt) bandpass plus noise, in the firmware's
+>2048q format.
+
+Every call costs `latency` seconds, like a KATCP round trip, and a non-blind
+write_int costs two (casperfpga reads the value back to check it). With
+realtime=False the latency is added to a virtual clock instead of slept, so
+benchmarks run fast and give the same answer every time. `stats` counts
+calls, round trips and bytes by method.
+
+Usage::
+
+    fpga = MockFpga(latency=1e-3)
+    sparrow = AlbatrosDigitizer(fpga, None, 250, logger)
+"""
+import collections
+import struct
+import time
+import numpy as np
+
+NCHAN = 2048
+POLS = ["pol00", "pol11", "pol01i", "pol01r"]
+
+# name: size in bytes. Registers are 4 bytes, the SPI controllers have a few words.
+DEFAULT_DEVICES = {
+    "sync_adc": 4, "sparrow_adc_en": 4, "sparrow_pll_ctrl": 8,
+    "ads5404_delay_ctrl": 4, "ads5404_delay_val": 4, "ads5404_hardware_rst": 4,
+    "ads5404_pll_lock": 4, "ads5404_spi_controller": 12,
+    "pfb_fft_shift": 4, "fft_of_count": 4, "acc_len": 4, "acc_cnt": 4, "cnt_rst": 4,
+    "sync": 4, "sync_cnt": 4, "pack_rst": 4, "gbe_rst": 4, "gbe_en": 4, "tx_of_cnt": 4,
+    "packetiser_spectra_per_packet": 4, "packetiser_bytes_per_spectrum": 4,
+    "dest_ip": 4, "dest_prt": 4, "sys_clkcounter": 4,
+    "four_bit_reorder_map1": 2*NCHAN, "four_bit_quant_coeffs": 4*NCHAN,
+    "pol00": 8*NCHAN, "pol11": 8*NCHAN, "pol01i": 8*NCHAN, "pol01r": 8*NCHAN,
+}
+
+class MockRegister():
+    """Enough of casperfpga.Register: read_uint, read_int, write_int."""
+    def __init__(self, parent, name):
+        self.parent = parent
+        self.name = name
+
+    def read_uint(self, **kwargs):
+        return self.parent.read_uint(self.name, **kwargs)
+
+    def read_int(self, **kwargs):
+        return self.parent.read_int(self.name, **kwargs)
+
+    def write_int(self, val, **kwargs):
+        return self.parent.write_int(self.name, val, **kwargs)
+
+    def __repr__(self):
+        return f"MockRegister({self.name})"
+
+class MockSnapshot():
+    """casperfpga.Snapshot.read_raw returning interleaved >h ADC samples of both channels."""
+    def __init__(self, parent, name, nsample=2**14):
+        self.parent = parent
+        self.name = name
+        self.nsample = nsample
+
+    def read_raw(self, man_trig=False, **kwargs):
+        self.parent._transact("snapshot", nbyte=4*self.nsample)
+        rng = np.random.default_rng(self.parent._ncall)
+        samples = np.clip(np.round(rng.normal(0, 200, 2*self.nsample)), -2048, 2047).astype(">i2")
+        data = samples.tobytes()
+        return {"length": len(data), "data": data}, self.parent.now()
+
+class _Container(dict):
+    """Devices by name, as attributes or items like casperfpga's AttributeContainer."""
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+class MockFpga():
+    def __init__(self, fpga_clk_mhz=125., acc_len=131072, latency=0., realtime=True, bandpass=None, seed=0,
+                 clock_estimate_time=0., devices=None):
+        """
+        :param fpga_clk_mhz: FPGA fabric clock, sets the accumulation period.
+        :param acc_len: Initial value of the acc_len register.
+        :param latency: Seconds per round trip.
+        :param realtime: Sleep the latency if True, else advance a virtual clock.
+        :param bandpass: (2048,) relative power per channel, a smooth default if None.
+        :param clock_estimate_time: Seconds estimate_fpga_clock takes (casperfpga
+            counts clocks over a couple of seconds).
+        :param devices: Extra {name: nbytes} on top of DEFAULT_DEVICES.
+        """
+        self.fpga_clk_mhz = fpga_clk_mhz
+        self.latency = latency
+        self.realtime = realtime
+        self.seed = seed
+        self.clock_estimate_time = clock_estimate_time
+        self.acc_len = acc_len
+        chan = np.arange(NCHAN)
+        self.bandpass = bandpass if bandpass is not None else 0.2 + np.exp(-0.5*((chan - 900)/500.)**2)
+        self.device_sizes = dict(DEFAULT_DEVICES)
+        if devices is not None:
+            self.device_sizes.update(devices)
+        self.virtual_time = 0.
+        self.stats = collections.defaultdict(lambda: {"calls": 0, "round_trips": 0, "bytes": 0})
+        self._ncall = 0
+        self.programmed = None
+        self._reset()
+
+    def _reset(self):
+        self.memory = {name: bytearray(n) for name, n in self.device_sizes.items()}
+        self.registers = _Container({n: MockRegister(self, n) for n, size in self.device_sizes.items() if size <= 12})
+        self.snapshots = _Container({"ss_adc": MockSnapshot(self, "ss_adc")})
+        self.sync_time = self.now()
+        self._acc_cache = (None, None)
+        self._poke("ads5404_pll_lock", 1)
+        self._poke("acc_len", self.acc_len)
+
+    def now(self):
+        """Wall clock, or the virtual one if not realtime."""
+        return time.time() if self.realtime else self.virtual_time
+
+    def _transact(self, method, nbyte=0, round_trips=1):
+        self._ncall += 1
+        s = self.stats[method]
+        s["calls"] += 1
+        s["round_trips"] += round_trips
+        s["bytes"] += nbyte
+        if self.latency > 0:
+            if self.realtime:
+                time.sleep(self.latency*round_trips)
+            else:
+                self.virtual_time += self.latency*round_trips
+
+    def reset_stats(self):
+        self.stats.clear()
+
+    def total_stats(self):
+        """Calls, round trips and bytes summed over methods, plus the latency they cost."""
+        out = {"calls": 0, "round_trips": 0, "bytes": 0}
+        for s in self.stats.values():
+            for k in out:
+                out[k] += s[k]
+        out["latency"] = out["round_trips"]*self.latency
+        return out
+
+    def _check(self, dev, size, offset):
+        if dev not in self.memory:
+            raise KeyError(f"No device {dev} in the mock design")
+        if offset + size > len(self.memory[dev]):
+            raise ValueError(f"Access of {size} bytes at {offset} overruns {dev} ({len(self.memory[dev])} bytes)")
+
+    # ---- simulated firmware ----
+    @property
+    def acc_period(self):
+        acc_len = self._peek("acc_len") or 1
+        return acc_len*NCHAN/(self.fpga_clk_mhz*1e6)
+
+    def _acc_cnt(self):
+        return int((self.now() - self.sync_time)//self.acc_period)
+
+    def _accumulators(self, acc_cnt):
+        if self._acc_cache[0] == acc_cnt:
+            return self._acc_cache[1]
+        acc_len = self._peek("acc_len") or 1
+        rng = np.random.default_rng((self.seed, acc_cnt))
+        noise = lambda: 1 + rng.normal(0, 1/np.sqrt(acc_len), NCHAN)
+        scale = acc_len*float(1<<36)*8 # autos are 64_35, ~std 2 per re/im
+        accs = {"pol00": scale*self.bandpass*noise(),
+                "pol11": scale*0.8*self.bandpass*noise(),
+                "pol01r": scale*0.1*self.bandpass*noise(),
+                "pol01i": scale*0.05*self.bandpass*(noise() - 1)}
+        accs = {k: np.asarray(v, dtype=">i8").tobytes() for k, v in accs.items()}
+        self._acc_cache = (acc_cnt, accs)
+        return accs
+
+    def _poke(self, dev, val, word_offset=0):
+        struct.pack_into(">I", self.memory[dev], 4*word_offset, val & 0xffffffff)
+
+    def _peek(self, dev, word_offset=0):
+        return struct.unpack_from(">I", self.memory[dev], 4*word_offset)[0]
+
+    def _on_write(self, dev):
+        if dev == "sync" and self._peek("sync") == 1:
+            self.sync_time = self.now()
+            self._poke("sync_cnt", self._peek("sync_cnt") + 1)
+        elif dev == "ads5404_spi_controller":
+            # echo the addressed SPI word back into the readback word
+            self._poke(dev, self._peek(dev, 1) & 0xffff, 2)
+
+    def _contents(self, dev):
+        if dev == "acc_cnt":
+            self._poke("acc_cnt", self._acc_cnt())
+        elif dev == "sys_clkcounter":
+            self._poke("sys_clkcounter", int(self.now()*self.fpga_clk_mhz*1e6))
+        elif dev in POLS:
+            self.memory[dev][:] = self._accumulators(self._acc_cnt())[dev]
+        return self.memory[dev]
+
+    # ---- CasperFpga API ----
+    def read(self, device_name, size, offset=0, **kwargs):
+        self._check(device_name, size, offset)
+        self._transact("read", nbyte=size)
+        return bytes(self._contents(device_name)[offset:offset + size])
+
+    def write(self, device_name, data, offset=0, **kwargs):
+        self._check(device_name, len(data), offset)
+        self._transact("write", nbyte=len(data), round_trips=2)
+        self.memory[device_name][offset:offset + len(data)] = data
+        self._on_write(device_name)
+
+    def blindwrite(self, device_name, data, offset=0, **kwargs):
+        self._check(device_name, len(data), offset)
+        self._transact("blindwrite", nbyte=len(data))
+        self.memory[device_name][offset:offset + len(data)] = data
+        self._on_write(device_name)
+
+    def write_int(self, device_name, integer, blindwrite=False, word_offset=0, **kwargs):
+        self._check(device_name, 4, 4*word_offset)
+        self._transact("write_int", nbyte=4, round_trips=1 if blindwrite else 2)
+        self._poke(device_name, int(integer), word_offset)
+        self._on_write(device_name)
+
+    def read_uint(self, device_name, word_offset=0, **kwargs):
+        self._check(device_name, 4, 4*word_offset)
+        self._transact("read_uint", nbyte=4)
+        return struct.unpack_from(">I", self._contents(device_name), 4*word_offset)[0]
+
+    def read_int(self, device_name, word_offset=0, **kwargs):
+        self._check(device_name, 4, 4*word_offset)
+        self._transact("read_int", nbyte=4)
+        return struct.unpack_from(">i", self._contents(device_name), 4*word_offset)[0]
+
+    def estimate_fpga_clock(self):
+        self._transact("estimate_fpga_clock", round_trips=2)
+        if self.clock_estimate_time > 0:
+            if self.realtime:
+                time.sleep(self.clock_estimate_time)
+            else:
+                self.virtual_time += self.clock_estimate_time
+        return self.fpga_clk_mhz
+
+    def upload_to_ram_and_program(self, filename, **kwargs):
+        self._transact("upload_to_ram_and_program")
+        self._reset()
+        self.programmed = filename
+
+    def get_system_information(self, filename=None, **kwargs):
+        self._transact("get_system_information")
+
+    def listdev(self):
+        return sorted(self.memory)
+
+    def is_running(self):
+        return self.programmed is not None
@@ -0,0 +1,123 @@
+"""
+Send synthetic 4-bit ALBATROS baseband packets over UDP, for testing the
+dumpers without a Sparrow board.
+
+Packets are laid out like the FPGA's: a big-endian uint32 spectrum number
+followed by spec_per_packet spectra of bytes_per_spectrum bytes, sized with
+utils.get_nspec from the same channels string as config.ini. The spectrum
+number goes up by spec_per_packet every packet, including dropped ones.
+Payload bytes are 4-bit Gaussian noise (std ~2.8, as after the digital gain).
+
+Usage::
+
+    python packet_generator.py --rate 1 --duration 30 --drop 1e-4 --reorder 1e-4
+"""
+import argparse
+import socket
+import time
+import numpy as np
+import utils
+
+def make_payloads(npayload, bytes_per_payload, std=2.83, seed=0):
+    """(npayload, bytes_per_payload) uint8 of packed 4-bit complex Gaussian noise."""
+    rng = np.random.default_rng(seed)
+    x = np.clip(np.round(rng.normal(0, std, (npayload, bytes_per_payload, 2))), -7, 7).astype(np.int8)
+    return ((x[..., 0].astype(np.uint8) & 0x0f) << 4 | (x[..., 1].astype(np.uint8) & 0x0f)).astype(np.uint8)
+
+class PacketGenerator():
+    def __init__(self, spec_per_packet, bytes_per_spectrum, dest=("127.0.0.1", 7417), rate=0., drop=0.,
+                 reorder=0., start_specno=0, seed=0):
+        """
+        :param rate: UDP payload rate in Gbit/s, 0 for as fast as possible.
+        :param drop: Probability of not sending each packet.
+        :param reorder: Probability of swapping each packet with the next.
+        """
+        self.spec_per_packet = spec_per_packet
+        self.bytes_per_packet = spec_per_packet*bytes_per_spectrum + 4
+        self.dest = dest
+        self.rate = rate
+        self.drop = drop
+        self.reorder = reorder
+        self.specno = start_specno
+        self.rng = np.random.default_rng(seed)
+        # a pool of payloads to cycle through, generating noise per packet would be the bottleneck
+        self.payloads = make_payloads(256, self.bytes_per_packet - 4, seed=seed)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16*1024*1024)
+        self.nsent = 0
+        self.ndropped = 0
+        self.nreordered = 0
+
+    def _batch(self, n):
+        """Next n packets as a list of bytes, after drops and reordering."""
+        packets = np.empty((n, self.bytes_per_packet), dtype=np.uint8)
+        specno = (self.specno + self.spec_per_packet*np.arange(n, dtype=np.int64)) % 2**32
+        packets[:, :4] = specno.astype(">u4").view(np.uint8).reshape(n, 4)
+        packets[:, 4:] = self.payloads[self.rng.integers(0, len(self.payloads), n)]
+        self.specno = (self.specno + n*self.spec_per_packet) % 2**32
+        order = np.arange(n)
+        if self.reorder > 0:
+            swap = np.flatnonzero(self.rng.random(n - 1) < self.reorder)
+            swap = swap[np.concatenate([[True], np.diff(swap) > 1])] if len(swap) else swap
+            order[swap], order[swap + 1] = swap + 1, swap
+            self.nreordered += len(swap)
+        if self.drop > 0:
+            keep = self.rng.random(n) >= self.drop
+            self.ndropped += int(np.sum(~keep))
+            order = order[keep[order]]
+        return [packets[i].tobytes() for i in order]
+
+    def run(self, npacket=None, duration=None, batch=64):
+        """Send npacket packets, or for duration seconds, at the configured rate."""
+        pps = self.rate*1e9/8/self.bytes_per_packet if self.rate > 0 else 0
+        t0 = time.time()
+        ngen = 0
+        while (npacket is None or ngen < npacket) and (duration is None or time.time() - t0 < duration):
+            n = batch if npacket is None else min(batch, npacket - ngen)
+            for packet in self._batch(n):
+                self.sock.sendto(packet, self.dest)
+                self.nsent += 1
+            ngen += n
+            if pps:
+                ahead = t0 + ngen/pps - time.time()
+                if ahead > 0:
+                    time.sleep(ahead)
+        return self.stats(time.time() - t0)
+
+    def stats(self, elapsed):
+        return {"generated": self.nsent + self.ndropped, "sent": self.nsent, "dropped": self.ndropped,
+                "reordered": self.nreordered, "seconds": round(elapsed, 3),
+                "gbps": round(self.nsent*self.bytes_per_packet*8/elapsed/1e9, 4) if elapsed > 0 else 0.}
+
+    def close(self):
+        self.sock.close()
+
+def get_generator_from_args(args):
+    chans = utils.get_channels_from_str(args.channels, 4)
+    spec_per_packet = utils.get_nspec(chans, max_nbyte=args.max_bytes)
+    return PacketGenerator(spec_per_packet, chans.shape[0], dest=(args.dest_ip, args.port), rate=args.rate,
+                           drop=args.drop, reorder=args.reorder, start_specno=args.start_specno, seed=args.seed)
+
+def add_generator_args(parser):
+    parser.add_argument("--channels", type=str, default="190:230 300:340", help="Channel string as in config.ini")
+    parser.add_argument("--max-bytes", type=int, default=1400, help="max_bytes_per_packet as in config.ini")
+    parser.add_argument("--dest-ip", type=str, default="127.0.0.1", help="Destination address")
+    parser.add_argument("-p", "--port", type=int, default=7417, help="Destination UDP port")
+    parser.add_argument("-r", "--rate", type=float, default=0., help="UDP payload rate in Gbit/s, 0 for as fast as possible")
+    parser.add_argument("--drop", type=float, default=0., help="Probability of dropping each packet")
+    parser.add_argument("--reorder", type=float, default=0., help="Probability of swapping each packet with the next")
+    parser.add_argument("--start-specno", type=int, default=0, help="First spectrum number, e.g. 4294900000 to test wrapping")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+
+if __name__=="__main__":
+    parser=argparse.ArgumentParser(description="Send synthetic 4-bit ALBATROS baseband packets")
+    add_generator_args(parser)
+    parser.add_argument("-n", "--npacket", type=int, default=None, help="Number of packets to generate")
+    parser.add_argument("-t", "--duration", type=float, default=None, help="Seconds to send for")
+    args=parser.parse_args()
+    if args.npacket is None and args.duration is None:
+        args.duration=10.
+    gen=get_generator_from_args(args)
+    print(f"Sending {gen.bytes_per_packet} byte packets ({gen.spec_per_packet} spectra) to {args.dest_ip}:{args.port}")
+    print(gen.run(npacket=args.npacket, duration=args.duration))
+    gen.close()
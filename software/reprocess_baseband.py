@@ -0,0 +1,237 @@
+"""
+Reprocess a tree of baseband .raw files on all cores.
+
+Files are handed out one per task to a process pool. Each worker opens its
+file with baseband.BasebandFile (so the header written by dump_baseband.py, or
+the C dumper's) and runs a kernel over it a block of packets at a time. A
+file's output is saved to <outdir>/<kernel>/<ctime>.npz (written to a temporary
+name and renamed), which doubles as the checkpoint: rerunning the same command
+skips every file that already has one. Once all files are done the per-file
+outputs are merged in time order.
+
+Kernels, pick one with -k:
+
+    unpack     : unpack all (or --chans) channels to complex64
+    select     : same as unpack, --chans required
+    correlate  : auto/cross accumulations as in correlate_baseband.py, merged
+                 into pol00/pol11/pol01r/pol01i.scio
+    requantize : requantize to 1 bit (sign of re and im), bit-packed
+
+New kernels subclass Kernel and go in KERNELS.
+
+Usage::
+
+    python reprocess_baseband.py /media/BASEBAND/baseband -o /data/reproc -k correlate -n 131072
+"""
+import argparse
+import json
+import multiprocessing
+import os
+from os.path import join
+import time
+import numpy as np
+import baseband
+import correlate_baseband
+import utils
+
+class Kernel():
+    """
+    Runs over one file. `process` is called for each block of packets with
+    the (npacket, spec_per_packet, nchan, 2) uint8 payload view and the
+    unwrapped specno of each spectrum, `result` returns a dict of arrays to
+    save. `merge` gets the saved dicts of every file in time order.
+    """
+    def __init__(self, bb, **options):
+        self.bb = bb
+        self.options = options
+
+    def process(self, raw, specno):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+    @classmethod
+    def merge(cls, results, fnames, outdir, options):
+        """Default merge: an index of the per-file outputs and their specno ranges, in time order."""
+        index = [{"file": f, "specno_start": int(r["specno"][0]), "specno_stop": int(r["specno"][-1]) + 1}
+                 for f, r in zip(fnames, results) if len(r["specno"])]
+        with open(join(outdir, "index.json"), "w") as f:
+            json.dump(index, f, indent=1)
+
+class UnpackKernel(Kernel):
+    def __init__(self, bb, chans=None, pol=None, **options):
+        super().__init__(bb, **options)
+        self.idx = np.arange(bb.nchan) if chans is None else bb.chan_indices(chans)
+        self.pol = pol
+        self.data = []
+        self.specno = []
+
+    def process(self, raw, specno):
+        self.data.append(baseband.unpack_channels(raw, self.idx, pol=self.pol))
+        self.specno.append(specno)
+
+    def result(self):
+        return {"specno": np.concatenate(self.specno), "data": np.concatenate(self.data),
+                "chans": self.bb.chans[self.idx]}
+
+class SelectKernel(UnpackKernel):
+    def __init__(self, bb, chans=None, **options):
+        if chans is None:
+            raise ValueError("The select kernel needs --chans")
+        super().__init__(bb, chans=chans, **options)
+
+class RequantizeKernel(UnpackKernel):
+    """1-bit requantization: the sign of re and im, packed 8 values to a byte along the last axis."""
+    def process(self, raw, specno):
+        x = baseband.unpack_channels(raw, self.idx, pol=self.pol, dtype="int8")
+        self.data.append(np.packbits(x.reshape(x.shape[0], -1) >= 0, axis=-1))
+        self.specno.append(specno)
+
+class CorrelateKernel(Kernel):
+    def __init__(self, bb, nacc=131072, **options):
+        super().__init__(bb, **options)
+        self.corr = correlate_baseband.Correlator(bb.nchan, nacc)
+        self.accs = []
+
+    def process(self, raw, specno):
+        keys = correlate_baseband.packet_keys(raw)
+        if np.any(np.diff(specno) <= 0):
+            order = np.argsort(specno, kind="stable")
+            keep = order[np.concatenate([[True], np.diff(specno[order]) > 0])]
+            keys, specno = keys[keep], specno[keep]
+        self.accs += self.corr.add(specno, keys)
+
+    def result(self):
+        accs = self.accs + self.corr.finish()
+        return {"acc": np.array([a[0] for a in accs], dtype=np.int64),
+                "nspec": np.array([a[1] for a in accs], dtype=np.int64),
+                "sums": np.array([a[2] for a in accs], dtype=np.int64).reshape(-1, self.bb.nchan, 4),
+                "chans": self.bb.chans, "gps_time": self.bb.gps_time,
+                "specno_start": self.bb.specno[0] if self.bb.npacket else 0}
+
+    @classmethod
+    def merge(cls, results, fnames, outdir, options):
+        # an accumulation can straddle two files, sum its pieces
+        results = [r for r in results if len(r["acc"])]
+        if len(results) == 0:
+            return
+        acc = np.concatenate([r["acc"] for r in results])
+        uacc, inv = np.unique(acc, return_inverse=True)
+        nspec = np.zeros(len(uacc), dtype=np.int64)
+        sums = np.zeros((len(uacc),) + results[0]["sums"].shape[1:], dtype=np.int64)
+        np.add.at(nspec, inv, np.concatenate([r["nspec"] for r in results]))
+        np.add.at(sums, inv, np.concatenate([r["sums"] for r in results]))
+        nacc = options.get("nacc", 131072)
+        spec_time = 2*correlate_baseband.NCHAN_FPGA/(options.get("adc_clk", 250.)*1e6)
+        first = results[0]
+        # unwrapped specno of the first accumulation is acc*nacc, pin the first file's gps_time to it
+        specno0 = int(first["acc"][0])*nacc + (int(first["specno_start"]) - int(first["acc"][0])*nacc) % 2**32
+        correlate_baseband.write_accumulations(outdir, zip(uacc, nspec, sums), first["chans"], nacc,
+                                               specno0, int(first["gps_time"]), spec_time,
+                                               compress=options.get("compress"), scio_version=2)
+
+KERNELS = {"unpack": UnpackKernel, "select": SelectKernel, "correlate": CorrelateKernel,
+           "requantize": RequantizeKernel}
+
+def _output_fname(outdir, fname):
+    return join(outdir, os.path.basename(fname)[:-4] + ".npz")
+
+def process_file(task):
+    """
+    Worker: run a kernel over one file and save its output.
+
+    :param task: (fname, unwrapped specno of its first packet, kernel name,
+        kernel options, output directory, packets per block).
+    :return: (fname, npacket, seconds taken, error message or None)
+    """
+    fname, file_start, kernel, options, outdir, block_packets = task
+    t0 = time.time()
+    try:
+        bb = baseband.BasebandFile(fname)
+        sn = baseband.packet_specno(bb, file_start)
+        k = KERNELS[kernel](bb, **options)
+        for p0 in range(0, bb.npacket, block_packets):
+            p1 = min(p0 + block_packets, bb.npacket)
+            k.process(bb.raw(p0, p1), (sn[p0:p1, None] + np.arange(bb.spec_per_packet)).ravel())
+        out = _output_fname(outdir, fname)
+        tmp = out[:-4] + ".tmp.npz"
+        np.savez(tmp, **k.result())
+        os.replace(tmp, out) # only complete outputs ever have the checkpoint name
+        return fname, bb.npacket, time.time() - t0, None
+    except Exception as e:
+        return fname, 0, time.time() - t0, f"{type(e).__name__}: {e}"
+
+def reprocess(files, outdir, kernel, options, ncpu=0, block_packets=512, merge=True):
+    """
+    Run kernel over files (a directory tree or list of .raw files) on ncpu
+    processes (all cores if 0), skipping files already done, then merge.
+
+    :return: List of (fname, error) for files that failed.
+    """
+    stream = baseband.BasebandStream(files)
+    kdir = join(outdir, kernel)
+    os.makedirs(kdir, exist_ok=True)
+    # refuse to resume with different options, the checkpoints would be a mix
+    opt_fname = join(kdir, "options.json")
+    if os.path.isfile(opt_fname):
+        with open(opt_fname) as f:
+            old = json.load(f)
+        if old != json.loads(json.dumps(options)):
+            raise ValueError(f"{kdir} was made with options {old}, not {options}")
+    else:
+        with open(opt_fname, "w") as f:
+            json.dump(options, f)
+    fnames = [bb.fname for bb in stream.files]
+    tasks = [(bb.fname, int(start), kernel, options, kdir, block_packets)
+             for bb, start in zip(stream.files, stream.file_start)
+             if not os.path.isfile(_output_fname(kdir, bb.fname))]
+    print(f"{len(fnames)} files, {len(fnames) - len(tasks)} already done, {len(tasks)} to process")
+    failed = []
+    t0 = time.time()
+    npacket = 0
+    with multiprocessing.Pool(ncpu if ncpu > 0 else None) as pool:
+        for i, (fname, n, dt, err) in enumerate(pool.imap_unordered(process_file, tasks)):
+            if err is not None:
+                failed.append((fname, err))
+                print(f"[{i+1}/{len(tasks)}] {fname} failed: {err}")
+                continue
+            npacket += n
+            elapsed = time.time() - t0
+            print(f"[{i+1}/{len(tasks)}] {fname} {n} packets in {dt:.1f} s, overall {npacket/elapsed:.0f} packets/s")
+    if merge and not failed:
+        results = []
+        for fname in fnames:
+            with np.load(_output_fname(kdir, fname)) as r:
+                results.append(dict(r))
+        KERNELS[kernel].merge(results, [_output_fname(kdir, f) for f in fnames], kdir, options)
+        print(f"Merged {len(fnames)} files into {kdir}")
+    return failed
+
+if __name__=="__main__":
+    parser=argparse.ArgumentParser(description="Reprocess baseband files in parallel, resuming where a previous run stopped")
+    parser.add_argument("files", nargs="+", help=".raw files, or a directory to search for them")
+    parser.add_argument("-o", "--outdir", type=str, required=True, help="Output directory")
+    parser.add_argument("-k", "--kernel", type=str, default="correlate", help=f"One of {', '.join(KERNELS)}")
+    parser.add_argument("-j", "--ncpu", type=int, default=0, help="Number of processes, 0 for all cores")
+    parser.add_argument("-b", "--block-packets", type=int, default=512, help="Packets per block")
+    parser.add_argument("--chans", type=str, default=None, help="Channels for unpack/select/requantize, e.g. '305:309 1834:1836'")
+    parser.add_argument("--pol", type=int, default=None, help="Only this polarisation for unpack/select/requantize")
+    parser.add_argument("-n", "--nacc", type=int, default=131072, help="Spectra per accumulation for correlate")
+    parser.add_argument("--adc-clk", type=float, default=250., help="ADC clock in MHz, for correlate timestamps")
+    parser.add_argument("--compress", type=str, default=None, help="scio compression for correlate")
+    parser.add_argument("--no-merge", action="store_true", help="Only process files, don't merge")
+    args=parser.parse_args()
+
+    if args.kernel not in KERNELS:
+        raise ValueError(f"Unknown kernel {args.kernel}, options are {', '.join(KERNELS)}")
+    if args.kernel == "correlate":
+        options={"nacc": args.nacc, "adc_clk": args.adc_clk, "compress": args.compress}
+    else:
+        options={"pol": args.pol}
+        if args.chans is not None:
+            options["chans"]=[int(c) for c in utils.get_channels_from_str(args.chans, 4)[::2]]
+    files=args.files[0] if len(args.files) == 1 and os.path.isdir(args.files[0]) else args.files
+    failed=reprocess(files, args.outdir, args.kernel, options, args.ncpu, args.block_packets, merge=not args.no_merge)
+    if failed:
+        print(f"{len(failed)} files failed, rerun to retry them")
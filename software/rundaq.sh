@@ -2,6 +2,9 @@ echo "Mounding /dev/sda1 to /media/BASEBAND"
 sudo mount /dev/sda1 /media/BASEBAND
 echo "Configuring FPGA"
 /home/casper/python3-venv/bin/python configfpga.py
+echo "Spawning metadata service"
+/home/casper/python3-venv/bin/python metadata_service.py & # exits straight away unless [metadata_service] enabled=True
+sleep 2 # let it open the GPS and create the shared memory before the DAQs look for it
 echo "Spawning dump spectra process"
 /home/casper/python3-venv/bin/python dump_spectra.py
 echo "Spawning dump baseband process"
@@ -2,21 +2,66 @@ import numpy
 import os
 import bz2
 import gzip
+import zlib
 import multiprocessing
+from multiprocessing import shared_memory,resource_tracker
+import threading
+import queue
 import time
     
+#first int32 of a v2 file, chosen so it can't be mistaken for a v1 ndim.  reads 'scv2' on disk.
+SCIO_V2_MAGIC=0x32766373
+SCIO_IDX_MAGIC=0x78646973 #'sidx', first word of a sidecar index
+SCIO_V2_NAMELEN=32
 
 class scio:
-    def __init__(self,fname,arr=None,status='w',compress=None,diff=False):
+    def __init__(self,fname,arr=None,status='w',compress=None,diff=False,chunk_frames=64,async_write=False,queue_size=16,flush_interval=None,version=1,meta=None):
         if not(compress is None):
             if len(compress)==0:
                 compress=None
+        meta=_parse_meta(meta)
+        #known compressors are applied in-process as frames come in, anything else is
+        #treated as a shell command to run on the finished file like we used to.
+        self.compressor=None
+        if not(compress is None):
+            tmp=_get_compressor(compress)
+            if not(tmp is None):
+                suffix,self.compressor=tmp
+                fname=fname+suffix
+                status=status.replace('b','')+'b'
         self.fid=open(fname,status)
         self.fname=fname
         self.diff=diff
         self.last=None
         self.compress=compress
+        self.chunk_frames=chunk_frames
+        self.chunk=[]
+        self.nchunk=0
+        #version 2 files are written in chunks of chunk_frames frames, each with a CRC32 and
+        #optional per-frame metadata columns given as names or (name, dtype) pairs.
+        self.version=version
+        self.meta=meta
+        self.frames=[]
+        self.meta_rows=[]
+        #flush_interval of None flushes after every frame, otherwise at most every flush_interval seconds.
+        #chunks (compressed or version 2) are also closed once their first frame is flush_interval old,
+        #so a crash doesn't lose up to chunk_frames frames
+        self.flush_interval=flush_interval
+        self.last_flush=time.time()
+        self.chunk_start=None
+        self.dirty=False
         self.closed=False
+        self.stats={'queued':0,'written':0,'max_depth':0,'blocked':0,'blocked_time':0.0}
+        self.error=None
+
+        #in async mode appends are queued and a writer thread does the disk i/o.  the thread
+        #holds a reference to us, so async files have to be close()d explicitly.
+        self.queue=None
+        self.thread=None
+        if async_write:
+            self.queue=queue.Queue(maxsize=queue_size)
+            self.thread=threading.Thread(target=self._writer_loop,daemon=True)
+            self.thread.start()
 
         if arr is None:
             self.dtype=None
@@ -31,12 +76,21 @@ class scio:
 
             
     def __del__(self):
-        if self.closed==False:
+        if getattr(self,'closed',True)==False:
             print('closing scio file ' + self.fname)
+            if not(self.thread is None):
+                self.queue.put(None)
+                self.thread.join()
+                if not(self.error is None):
+                    print('scio writer thread on ' + self.fname + ' failed with ' + repr(self.error))
+            if self.version==2:
+                self._write_v2_chunk()
+            if not(self.compressor is None):
+                self.flush_chunk()
             self.fid.flush()        
             self.fid.close()
             self.closed=True
-            if not(self.compress is None):
+            if not(self.compress is None) and self.compressor is None:
                 to_exec=self.compress + ' ' + self.fname
                 os.system(to_exec)
 
@@ -45,6 +99,9 @@ class scio:
         self.__del__()
     def write_header(self,arr):
         sz=arr.shape
+        if self.version==2:
+            self._put(_make_v2_header(sz,dtype2int(arr),self.diff,self.chunk_frames,self.meta),False)
+            return
         myvec=numpy.zeros(len(sz)+2,dtype='int32')
         myvec[0]=len(sz)
         if self.diff:
@@ -52,10 +109,138 @@ class scio:
         for i in range(len(sz)):
             myvec[i+1]=sz[i]
         myvec[-1]=dtype2int(arr)
-        myvec.tofile(self.fid)
+        self._put(myvec,False)
+
+    def _put(self,arr,frame,meta=None):
+        if self.queue is None:
+            self._write_frame(arr,frame,meta)
+            return
+        if not(self.error is None):
+            print('scio writer thread on ' + self.fname + ' has failed, dropping data.')
+            return
+        try:
+            self.queue.put_nowait((arr,frame,meta))
+        except queue.Full:
+            #storage is falling behind, block until the writer catches up
+            t1=time.time()
+            self.queue.put((arr,frame,meta))
+            self.stats['blocked']+=1
+            self.stats['blocked_time']+=time.time()-t1
+        if frame:
+            self.stats['queued']+=1
+        self.stats['max_depth']=max(self.stats['max_depth'],self.queue.qsize())
+
+    def _writer_loop(self):
+        while True:
+            try:
+                item=self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self._flush_if_dirty()
+                try:
+                    self._close_chunk_if_due()
+                except Exception as e:
+                    self.error=e
+                continue
+            if item is None:
+                return
+            if not(self.error is None):
+                continue
+            try:
+                self._write_frame(*item)
+            except Exception as e:
+                self.error=e
+
+    def _write_frame(self,arr,frame,meta=None):
+        if not(frame):
+            self._write(arr)
+            return
+        self.stats['written']+=1
+        if self.version==2:
+            if len(self.frames)==0:
+                self.chunk_start=time.time()
+            self.frames.append(arr.tobytes())
+            self.meta_rows.append(meta)
+            if len(self.frames)>=self.chunk_frames or self._chunk_due():
+                self._write_v2_chunk()
+            return
+        self._write(arr)
+        if self.compressor is None:
+            self.dirty=True
+            if self.flush_interval is None or time.time()-self.last_flush>=self.flush_interval:
+                self._flush_if_dirty()
+        else:
+            if self.nchunk==0:
+                self.chunk_start=time.time()
+            self.nchunk=self.nchunk+1
+            if self.nchunk>=self.chunk_frames or self._chunk_due():
+                self.flush_chunk()
 
+    def _chunk_due(self):
+        return not(self.flush_interval is None or self.chunk_start is None) and time.time()-self.chunk_start>=self.flush_interval
+
+    def _close_chunk_if_due(self):
+        if not(self._chunk_due()):
+            return
+        if self.version==2:
+            self._write_v2_chunk()
+        elif not(self.compressor is None) and self.nchunk>0:
+            self.flush_chunk()
+
+    def _write_v2_chunk(self):
+        #chunk is uint32 [nframe, crc32 of body] followed by a body of nframe data frames
+        #and then nframe values of each metadata column in turn.
+        if len(self.frames)==0:
+            return
+        body=[b''.join(self.frames)]
+        for j in range(len(self.meta)):
+            body.append(numpy.asarray([row[j] for row in self.meta_rows],dtype=self.meta[j][1]).tobytes())
+        body=b''.join(body)
+        self._write(numpy.asarray([len(self.frames),zlib.crc32(body)],dtype='uint32'))
+        self._write(numpy.frombuffer(body,dtype='uint8'))
+        self.frames=[]
+        self.meta_rows=[]
+        self.chunk_start=None
+        if self.compressor is None:
+            self.dirty=True
+            if self.flush_interval is None or time.time()-self.last_flush>=self.flush_interval:
+                self._flush_if_dirty()
+        else:
+            self.flush_chunk()
+
+    def _meta_row(self,meta):
+        if meta is None:
+            meta={}
+        if isinstance(meta,dict):
+            return tuple([meta.get(name,0) for name,dtype in self.meta])
+        if len(meta)!=len(self.meta):
+            print('expected ' + repr(len(self.meta)) + ' metadata values in scio.append on file ' + self.fname)
+            meta=(list(meta)+[0]*len(self.meta))[:len(self.meta)]
+        return tuple(meta)
+
+    def _flush_if_dirty(self):
+        if self.dirty:
+            self.fid.flush()
+            self.dirty=False
+            self.last_flush=time.time()
+
+    def _write(self,arr):
+        if self.compressor is None:
+            arr.tofile(self.fid)
+        else:
+            self.chunk.append(arr.tobytes())
+
+    def flush_chunk(self):
+        #each chunk is an independent compressed stream, so a file cut short by a crash
+        #is still readable up to the last complete chunk.
+        if len(self.chunk)==0:
+            return
+        self.fid.write(self.compressor(b''.join(self.chunk)))
+        self.fid.flush()
+        self.chunk=[]
+        self.nchunk=0
+        self.chunk_start=None
         
-    def append(self,arr):
+    def append(self,arr,meta=None):
         if self.initialized==False:
             self.dtype=arr.dtype
             self.shape=arr.shape
@@ -75,8 +260,13 @@ class scio:
                 self.last=arr.copy()
             else:
                 arr_use=arr
-            arr_use.tofile(self.fid)
-            self.fid.flush()
+            if not(self.queue is None) and arr_use is arr:
+                #caller is free to reuse arr once we return
+                arr_use=arr.copy()
+            row=None
+            if self.version==2:
+                row=self._meta_row(meta)
+            self._put(arr_use,True,row)
         else:
             print('dtype mismatch in scio.append on file ' + self.fname)
         
@@ -109,9 +299,11 @@ class scio:
 #        arr.tofile(f)
 #        f.close()
 
-def _read_from_string(mystr):
+def _read_from_string(mystr,meta=False):
+    if len(mystr)>=4 and numpy.frombuffer(mystr[:4],dtype='int32')[0]==SCIO_V2_MAGIC:
+        return _read_v2_from_string(mystr,meta)
     icur=0;
-    ndim=numpy.fromstring(mystr[icur:icur+4],dtype='int32')[0]
+    ndim=numpy.frombuffer(mystr[icur:icur+4],dtype='int32')[0]
     icur=icur+4
     if (ndim<0):
         diff=True
@@ -119,13 +311,13 @@ def _read_from_string(mystr):
     else:
         diff=False        
     #print 'ndim is ',ndim
-    sz=numpy.fromstring(mystr[icur:icur+4*ndim],'int32')
+    sz=numpy.frombuffer(mystr[icur:icur+4*ndim],'int32')
     icur=icur+4*ndim
-    mytype=numpy.fromstring(mystr[icur:icur+4],'int32')[0]
+    mytype=numpy.frombuffer(mystr[icur:icur+4],'int32')[0]
     icur=icur+4
 
     #check for file size sanity
-    bytes_per_frame=int2nbyte(mytype)*numpy.product(sz)
+    bytes_per_frame=int2nbyte(mytype)*numpy.prod(sz)
     cur_bytes=len(mystr)-icur
     n_to_cut=numpy.remainder(cur_bytes,bytes_per_frame)
     if n_to_cut>0:
@@ -134,9 +326,9 @@ def _read_from_string(mystr):
         mystr=mystr[:-n_to_cut]
         #print 'new len: ',len(mystr)
         
-    vec=numpy.fromstring(mystr[icur:],dtype=int2dtype(mytype))
+    vec=numpy.frombuffer(mystr[icur:],dtype=int2dtype(mytype)).copy() # writeable, as fromstring's was
 
-    nmat=vec.size/numpy.product(sz)
+    nmat=vec.size//numpy.prod(sz)
     new_sz=numpy.zeros(sz.size+1,dtype='int32')
     new_sz[0]=nmat
     new_sz[1:]=sz
@@ -145,49 +337,228 @@ def _read_from_string(mystr):
     if diff:
         mat=numpy.cumsum(mat,0)
 
+    if meta:
+        return mat,{}
     return mat
     
+def _parse_meta(meta):
+    #metadata columns as a list of (name, dtype), plain names default to float64
+    out=[]
+    if meta is None:
+        return out
+    for col in meta:
+        if isinstance(col,str):
+            col=(col,'float64')
+        name,dtype=col[0],numpy.dtype(col[1])
+        if len(name.encode())>SCIO_V2_NAMELEN:
+            raise ValueError('scio metadata column name ' + name + ' is longer than ' + repr(SCIO_V2_NAMELEN) + ' bytes')
+        if dtype2int(dtype)==0:
+            raise ValueError('unsupported dtype ' + repr(dtype) + ' for scio metadata column ' + name)
+        out.append((name,dtype))
+    return out
 
-def _read_file_as_string(fname):
+def _make_v2_header(sz,mytype,diff,chunk_frames,meta):
+    #int32 magic, version, flags (1=diff, 2=crc), ndim, shape, dtype code, chunk_frames and
+    #the number of metadata columns, then a dtype code and padded name for each column.
+    flags=2
+    if diff:
+        flags=flags+1
+    myvec=[SCIO_V2_MAGIC,2,flags,len(sz)]+list(sz)+[mytype,chunk_frames,len(meta)]
+    for name,dtype in meta:
+        myvec.append(dtype2int(dtype))
+        myvec.extend(numpy.frombuffer(name.encode().ljust(SCIO_V2_NAMELEN,b'\0'),dtype='int32'))
+    return numpy.asarray(myvec,dtype='int32')
+
+def _parse_v2_header(mystr):
+    #returns a dict describing a v2 header, or None if mystr is too short to hold it
+    if len(mystr)<16:
+        return None
+    magic,version,flags,ndim=numpy.frombuffer(mystr[:16],dtype='int32')
+    if version!=2:
+        print('Unsupported scio version ' + repr(int(version)))
+        return None
+    icur=16
+    if len(mystr)<icur+4*ndim+12:
+        return None
+    sz=[int(n) for n in numpy.frombuffer(mystr[icur:icur+4*ndim],dtype='int32')]
+    icur=icur+4*ndim
+    mytype,chunk_frames,nmeta=[int(n) for n in numpy.frombuffer(mystr[icur:icur+12],dtype='int32')]
+    icur=icur+12
+    meta=[]
+    for j in range(nmeta):
+        if len(mystr)<icur+4+SCIO_V2_NAMELEN:
+            return None
+        code=int(numpy.frombuffer(mystr[icur:icur+4],dtype='int32')[0])
+        name=bytes(mystr[icur+4:icur+4+SCIO_V2_NAMELEN]).rstrip(b'\0').decode()
+        meta.append((name,numpy.dtype(int2dtype(code))))
+        icur=icur+4+SCIO_V2_NAMELEN
+    dtype=numpy.dtype(int2dtype(mytype))
+    frame_bytes=dtype.itemsize*int(numpy.prod(sz))
+    row_bytes=frame_bytes
+    for name,mdtype in meta:
+        row_bytes=row_bytes+mdtype.itemsize
+    return {'diff':bool(flags&1),'crc':bool(flags&2),'shape':sz,'dtype':dtype,'chunk_frames':chunk_frames,
+            'meta':meta,'nbyte':icur,'frame_bytes':frame_bytes,'row_bytes':row_bytes}
+
+def _decode_v2_chunk(body,hdr,nframe):
+    #split a chunk body into its (nframe, *shape) data and a list of metadata columns
+    nval=int(numpy.prod(hdr['shape']))
+    mat=numpy.frombuffer(body,dtype=hdr['dtype'],count=nframe*nval).reshape([nframe]+hdr['shape'])
+    cols=[]
+    icur=nframe*hdr['frame_bytes']
+    for name,dtype in hdr['meta']:
+        cols.append(numpy.frombuffer(body,dtype=dtype,count=nframe,offset=icur))
+        icur=icur+nframe*dtype.itemsize
+    return mat,cols
+
+def _read_v2_from_string(mystr,meta=False):
+    hdr=_parse_v2_header(mystr)
+    if hdr is None:
+        print('scio v2 header is incomplete.')
+        return None
+    mystr=memoryview(mystr)
+    icur=hdr['nbyte']
+    mats=[]
+    cols=[[] for col in hdr['meta']]
+    ichunk=0
+    while icur<len(mystr):
+        if icur+8>len(mystr):
+            print('scio file ends with a partial chunk header, truncating.')
+            break
+        nframe,crc=[int(n) for n in numpy.frombuffer(mystr[icur:icur+8],dtype='uint32')]
+        body=mystr[icur+8:icur+8+nframe*hdr['row_bytes']]
+        if len(body)<nframe*hdr['row_bytes']:
+            print('scio file ends with a partial chunk, truncating ' + repr(len(body)) + ' bytes.')
+            break
+        icur=icur+8+len(body)
+        if hdr['crc'] and zlib.crc32(body)!=crc:
+            if hdr['diff']:
+                #can't carry the running sum past a bad chunk
+                print('CRC mismatch in scio chunk ' + repr(ichunk) + ', truncating.')
+                break
+            print('CRC mismatch in scio chunk ' + repr(ichunk) + ', skipping its ' + repr(nframe) + ' frames.')
+            ichunk=ichunk+1
+            continue
+        mat,mycols=_decode_v2_chunk(body,hdr,nframe)
+        mats.append(mat)
+        for j in range(len(cols)):
+            cols[j].append(mycols[j])
+        ichunk=ichunk+1
+    if len(mats)==0:
+        mat=numpy.zeros([0]+hdr['shape'],dtype=hdr['dtype'])
+    else:
+        mat=numpy.concatenate(mats)
+    if hdr['diff']:
+        mat=numpy.cumsum(mat,0)
+    if not(meta):
+        return mat
+    metadict={}
+    for j,(name,dtype) in enumerate(hdr['meta']):
+        if len(cols[j])==0:
+            metadict[name]=numpy.zeros(0,dtype=dtype)
+        else:
+            metadict[name]=numpy.concatenate(cols[j])
+    return mat,metadict
+
+def _file_version(fname):
+    f=open(fname,'rb')
+    myint=numpy.fromfile(f,'int32',1)
+    f.close()
+    if myint.size>0 and myint[0]==SCIO_V2_MAGIC:
+        return 2
+    return 1
+
+def _get_compressor(compress):
+    #returns file suffix and compression function for in-process compressors, None otherwise
+    if compress=='bzip2' or compress=='bz2':
+        return '.bz2',bz2.compress
+    if compress=='gzip' or compress=='gz':
+        return '.gz',gzip.compress
+    if compress=='zstd' or compress=='zst':
+        import zstandard
+        return '.zst',zstandard.ZstdCompressor().compress
+    if compress=='lz4':
+        import lz4.frame
+        return '.lz4',lz4.frame.compress
+    return None
+
+def _get_decompressor(fname):
     if fname[-4:]=='.bz2':
-        f=bz2.BZ2File(fname,'r')
-        mystr=f.read()
-        f.close()
-        return mystr
+        return bz2.BZ2Decompressor
     if fname[-3:]=='.gz':
-        f=gzip.GzipFile(fname,'r')
-        mystr=f.read()
-        f.close()
-        return mystr
+        return lambda: zlib.decompressobj(wbits=31)
+    if fname[-4:]=='.zst':
+        import zstandard
+        return lambda: zstandard.ZstdDecompressor().decompressobj()
+    if fname[-4:]=='.lz4':
+        import lz4.frame
+        return lz4.frame.LZ4FrameDecompressor
+    return None
+
+def _is_compressed(fname):
+    for suffix in ['.bz2','.gz','.zst','.lz4']:
+        if fname[-len(suffix):]==suffix:
+            return True
+    return False
 
-    #if we get here, assume it's raw binary
+def _decompress_streams(mystr,decompressor):
+    #files written by scio are a sequence of independent compressed chunks, files compressed
+    #after the fact are a single one.  keep whatever decodes if the last chunk was cut short.
+    out=[]
+    while mystr:
+        d=decompressor()
+        try:
+            out.append(d.decompress(mystr))
+        except:
+            print('Compressed scio chunk appears to be garbled, keeping ' + repr(len(out)) + ' chunks.')
+            break
+        if not(d.eof):
+            print('Compressed scio file ends with a partial chunk.')
+            break
+        mystr=d.unused_data
+    return b''.join(out)
+
+def _read_file_as_string(fname):
+    decompressor=_get_decompressor(fname)
     f=open(fname,'rb')
     mystr=f.read()
     f.close()
-    return mystr
+    if decompressor is None:
+        #if we get here, assume it's raw binary
+        return mystr
+    return _decompress_streams(mystr,decompressor)
+
+def _candidate_fnames(fname):
+    fnames=[fname]
+    if fname[-4:]=='.bz2':
+        fnames.append(fname[:-4])
+    if fname[-3:]=='.gz':
+        fnames.append(fname[:-3])
+    if fname[-4:]=='.zst' or fname[-4:]=='.lz4':
+        fnames.append(fname[:-4])
+    fnames.append(fname+'.bz2')
+    fnames.append(fname+'.gz')
+    fnames.append(fname+'.zst')
+    fnames.append(fname+'.lz4')
+    return fnames
 
-def read(fname,strict=False):
+def read(fname,strict=False,meta=False):
+    #with meta=True, returns the frames and a dict of the per-frame metadata columns of a v2 file
     if True:
         if strict:
             #only read the filename passed in
             mystr=_read_file_as_string(fname)
-            return _read_from_string(mystr)
+            return _read_from_string(mystr,meta)
         else:
             #try some guesses about what other sane filenames might be based on the input filename
-            fnames=[fname]
-            if fname[-4:]=='.bz2':
-                fnames.append(fname[:-4])
-            if fname[-3:]=='.gz':
-                fnames.append(fname[:-3])
-            fnames.append(fname+'.bz2')
-            fnames.append(fname+'.gz')
+            fnames=_candidate_fnames(fname)
             
             for fname in fnames:
                 try:
                     mystr=_read_file_as_string(fname)
                     if len(mystr)>0:
                         try:  #try/except loop added by JLS 11 June 2019 to catch cases where string length is unexpected
-                            return _read_from_string(mystr)
+                            return _read_from_string(mystr,meta)
                         except:
                             print('File ',fname,' appears to be garbled when parsing string of length ',len(mystr))
                             return None
@@ -209,7 +580,7 @@ def read(fname,strict=False):
     sz=numpy.fromfile(f,'int32',ndim)
     mytype=numpy.fromfile(f,'int32',1)
     vec=numpy.fromfile(f,dtype=int2dtype(mytype))
-    nmat=vec.size/numpy.product(sz)
+    nmat=vec.size//numpy.prod(sz)
     new_sz=numpy.zeros(sz.size+1,dtype='int32')
     new_sz[0]=nmat
     new_sz[1:]=sz
@@ -221,6 +592,263 @@ def read(fname,strict=False):
 
     return mat
 
+def _read_header(fid):
+    #parse the int32 scio header from an open file.  returns diff, shape, dtype code and header length in bytes.
+    ndim=numpy.fromfile(fid,'int32',1)
+    if ndim.size==0:
+        return None
+    ndim=int(ndim[0])
+    if ndim==SCIO_V2_MAGIC:
+        return None
+    if (ndim<0):
+        diff=True
+        ndim=-1*ndim
+    else:
+        diff=False
+    sz=numpy.fromfile(fid,'int32',ndim)
+    mytype=numpy.fromfile(fid,'int32',1)
+    if sz.size<ndim or mytype.size==0:
+        return None
+    return diff,sz,int(mytype[0]),4*(ndim+2)
+
+def open_mmap(fname,start=None,stop=None):
+    """Memory-map an uncompressed scio file as an (nframe, *shape) array without reading it.
+
+    Trailing partial frames are left out of the map rather than copied away.  For diff
+    files the map holds the stored frame-to-frame differences; pass start and/or stop to
+    get decoded frames, in which case only frames start:stop are materialized.
+    Compressed and v2 files can't be mapped, so they fall back to read()."""
+    if _is_compressed(fname) or _file_version(fname)==2:
+        print('open_mmap cannot map compressed or v2 file ' + fname + ', reading it instead.')
+        mat=read(fname,strict=True)
+        if mat is None:
+            return None
+        return mat[start:stop]
+    f=open(fname,'rb')
+    hdr=_read_header(f)
+    f.close()
+    if hdr is None:
+        print('File ',fname,' does not have a complete scio header.')
+        return None
+    diff,sz,mytype,icur=hdr
+    dtype=int2dtype(mytype)
+    bytes_per_frame=int(int2nbyte(mytype))*int(numpy.prod(sz))
+    cur_bytes=os.path.getsize(fname)-icur
+    n_to_cut=cur_bytes%bytes_per_frame
+    if n_to_cut>0:
+        print('We have a byte mismatch in mapping scio file.  Ignoring last ' + repr(n_to_cut) + ' bytes.')
+    nframe=cur_bytes//bytes_per_frame
+    shape=tuple([nframe]+[int(n) for n in sz])
+    if nframe==0:
+        #numpy refuses to map zero bytes
+        mat=numpy.zeros(shape,dtype=dtype)
+    else:
+        mat=numpy.memmap(fname,dtype=dtype,mode='r',offset=icur,shape=shape)
+    if not(diff):
+        return mat[start:stop]
+    if start is None and stop is None:
+        return mat
+    start,stop,step=slice(start,stop).indices(nframe)
+    if stop<=start:
+        return numpy.zeros([0]+list(shape[1:]),dtype=numpy.cumsum(mat[:0],0).dtype)
+    out=numpy.cumsum(mat[start:stop],0)
+    if start>0:
+        out+=numpy.sum(mat[:start],0,dtype=out.dtype)
+    return out
+
+def _index_fname(fname):
+    return fname+'.idx'
+
+def _load_index(fname):
+    #sidecar index is an int64 header [SCIO_IDX_MAGIC, every, nframe_indexed, file size, file mtime_ns,
+    #crc32 of the first min(every,nframe_indexed) frames, crc32 of the last indexed frame] followed by
+    #the decoded keyframes 0, every, 2*every, ...
+    try:
+        f=open(_index_fname(fname),'rb')
+    except Exception:
+        return None
+    hdr=numpy.fromfile(f,'int64',7)
+    keys=numpy.fromfile(f,'uint8')
+    f.close()
+    if hdr.size<7 or hdr[0]!=SCIO_IDX_MAGIC:
+        return None
+    return [int(x) for x in hdr[1:]]+[keys]
+
+def _index_crcs(mat,every,nframe):
+    #identifies the indexed part of a file, so a rewritten file isn't matched with an old index
+    if nframe==0:
+        return 0,0
+    head=zlib.crc32(numpy.ascontiguousarray(mat[:min(every,nframe)]))
+    tail=zlib.crc32(numpy.ascontiguousarray(mat[nframe-1]))
+    return head,tail
+
+def build_index(fname,every=256,mat=None):
+    """Build or extend the keyframe index of a diff scio file.
+
+    Every `every` frames the decoded (cumulatively summed) frame is stored in fname.idx,
+    so read_range only has to sum the differences since the nearest keyframe.  If an index
+    already exists and the file has grown, only the new frames are scanned.  The index
+    records the file's size, mtime and checksums of its first and last indexed frames, and
+    is rebuilt if the file was rewritten under it.  Returns (every, nframe_indexed, keyframes)."""
+    if mat is None:
+        mat=open_mmap(fname)
+    if mat is None:
+        return None
+    nframe=mat.shape[0]
+    dtype=numpy.cumsum(mat[:0],0).dtype
+    st=os.stat(fname)
+    idx=_load_index(fname)
+    keys=None
+    if not(idx is None):
+        idx_every,idx_nframe,idx_size,idx_mtime,idx_head,idx_tail,idx_keys=idx
+        nkey_expected=(idx_nframe+idx_every-1)//idx_every
+        ok=idx_every==every and idx_nframe<=nframe and idx_keys.size==nkey_expected*dtype.itemsize*int(numpy.prod(mat.shape[1:]))
+        unchanged=ok and idx_nframe==nframe and idx_size==st.st_size and idx_mtime==st.st_mtime_ns
+        if ok and not(unchanged):
+            ok=_index_crcs(mat,every,idx_nframe)==(idx_head,idx_tail)
+        if ok:
+            keys=idx_keys.view(dtype).reshape([-1]+list(mat.shape[1:]))
+            nindexed=idx_nframe
+            if nindexed==nframe:
+                return every,nframe,keys
+        else:
+            print('Rebuilding stale scio index for ' + fname)
+    if keys is None or keys.shape[0]==0:
+        keys=numpy.zeros([0]+list(mat.shape[1:]),dtype=dtype)
+        nindexed=0
+    #walk the unindexed frames one keyframe interval at a time so memory stays bounded
+    newkeys=[keys]
+    nkey=keys.shape[0]
+    if nkey>0:
+        cur=keys[-1].copy()
+        icur=(nkey-1)*every
+    else:
+        cur=numpy.zeros(mat.shape[1:],dtype=dtype)
+        icur=-1
+    while nkey*every<nframe:
+        target=nkey*every
+        cur=cur+numpy.sum(mat[icur+1:target+1],0,dtype=dtype)
+        icur=target
+        newkeys.append(cur[None].copy())
+        nkey=nkey+1
+    keys=numpy.concatenate(newkeys,0)
+    try:
+        f=open(_index_fname(fname),'wb')
+        head,tail=_index_crcs(mat,every,nframe)
+        numpy.asarray([SCIO_IDX_MAGIC,every,nframe,st.st_size,st.st_mtime_ns,head,tail],dtype='int64').tofile(f)
+        keys.tofile(f)
+        f.close()
+    except Exception:
+        print('Unable to write scio index for ' + fname + ', keeping it in memory only.')
+    return every,nframe,keys
+
+def read_range(fname,start=None,stop=None,step=None,every=256):
+    """Read frames start:stop:step of a scio file without decoding the whole thing.
+
+    Uncompressed files are memory-mapped and only the requested frames are copied.  Diff
+    files use the sidecar keyframe index (see build_index), which is created or extended
+    as needed.  v2 files are read chunk by chunk, skipping chunks before the requested
+    range unless they're needed for a diff sum.  Compressed files can't be seeked and fall
+    back to a full read."""
+    if _is_compressed(fname):
+        mat=read(fname,strict=True)
+        if mat is None:
+            return None
+        return mat[start:stop:step]
+    if _file_version(fname)==2:
+        return _read_v2_range(fname,start,stop,step)
+    f=open(fname,'rb')
+    hdr=_read_header(f)
+    f.close()
+    if hdr is None:
+        print('File ',fname,' does not have a complete scio header.')
+        return None
+    mat=open_mmap(fname)
+    if not(hdr[0]):
+        return numpy.array(mat[start:stop:step])
+    nframe=mat.shape[0]
+    start,stop,step=slice(start,stop,step).indices(nframe)
+    frames=range(start,stop,step)
+    dtype=numpy.cumsum(mat[:0],0).dtype
+    if len(frames)==0:
+        return numpy.zeros([0]+list(mat.shape[1:]),dtype=dtype)
+    if step<0:
+        return read_range(fname,frames[-1],frames[0]+1,-step,every)[::-1]
+    every,nindexed,keys=build_index(fname,every,mat)
+    ikey=start//every
+    if step>every:
+        #sparse request, decode each frame from its own keyframe
+        out=numpy.empty([len(frames)]+list(mat.shape[1:]),dtype=dtype)
+        for i,frame in enumerate(frames):
+            ikey=frame//every
+            out[i]=keys[ikey]+numpy.sum(mat[ikey*every+1:frame+1],0,dtype=dtype)
+        return out
+    out=numpy.cumsum(mat[ikey*every:stop],0,dtype=dtype)
+    #the cumsum above starts at the keyframe's difference, swap it for the decoded keyframe
+    out+=keys[ikey]-mat[ikey*every]
+    return out[start-ikey*every::step]
+
+def _read_v2_range(fname,start,stop,step):
+    f=open(fname,'rb')
+    hdr=_parse_v2_header(f.read(65536))
+    if hdr is None:
+        f.close()
+        print('File ',fname,' does not have a complete scio v2 header.')
+        return None
+    #walk the chunk headers to find where every chunk starts
+    fsize=os.path.getsize(fname)
+    chunks=[]
+    icur=hdr['nbyte']
+    nframe=0
+    while icur+8<=fsize:
+        f.seek(icur)
+        n,crc=[int(x) for x in numpy.fromfile(f,'uint32',2)]
+        if icur+8+n*hdr['row_bytes']>fsize:
+            break
+        chunks.append((icur+8,nframe,n,crc))
+        nframe=nframe+n
+        icur=icur+8+n*hdr['row_bytes']
+    start,stop,step=slice(start,stop,step).indices(nframe)
+    frames=range(start,stop,step)
+    dtype=hdr['dtype']
+    if hdr['diff']:
+        dtype=numpy.cumsum(numpy.zeros(0,dtype=dtype)).dtype
+    if len(frames)==0:
+        f.close()
+        return numpy.zeros([0]+hdr['shape'],dtype=dtype)
+    first,last=min(frames[0],frames[-1]),max(frames[0],frames[-1])
+    mats=[]
+    base=numpy.zeros(hdr['shape'],dtype=dtype)
+    i0=None
+    for offset,iframe,n,crc in chunks:
+        if iframe+n<=first and not(hdr['diff']):
+            continue
+        if iframe>last:
+            break
+        f.seek(offset)
+        body=f.read(n*hdr['row_bytes'])
+        if hdr['crc'] and zlib.crc32(body)!=crc:
+            f.close()
+            print('CRC mismatch in scio chunk starting at frame ' + repr(iframe) + ', falling back to a full read.')
+            mat=read(fname,strict=True)
+            if mat is None:
+                return None
+            return mat[start:stop:step]
+        mat=_decode_v2_chunk(body,hdr,n)[0]
+        if iframe+n<=first:
+            #only needed for the running sum
+            base=base+numpy.sum(mat,0,dtype=dtype)
+            continue
+        if i0 is None:
+            i0=iframe
+        mats.append(mat)
+    f.close()
+    mat=numpy.concatenate(mats)
+    if hdr['diff']:
+        mat=numpy.cumsum(mat,0,dtype=dtype)
+        mat+=base
+    return mat[frames[0]-i0::step][:len(frames)]
+
 def read_files(fnames,ncpu=0):
     t1=time.time()
     if ncpu==0:
@@ -235,58 +863,193 @@ def read_files(fnames,ncpu=0):
     #print 'took ',t2-t1, ' seconds to read files in scio.'
     return data
 
+def _frames_from_string(mystr):
+    #like _read_from_string, but hands back the undecoded frames as a view on mystr
+    hdr=numpy.frombuffer(mystr[:4],dtype='int32')
+    if hdr.size==0:
+        return None
+    ndim=abs(int(hdr[0]))
+    icur=4*(ndim+2)
+    hdr=numpy.frombuffer(mystr[:icur],dtype='int32')
+    if hdr.size<ndim+2:
+        return None
+    sz=[int(n) for n in hdr[1:-1]]
+    mytype=int(hdr[-1])
+    bytes_per_frame=int(int2nbyte(mytype))*int(numpy.prod(sz))
+    nframe=(len(mystr)-icur)//bytes_per_frame
+    vec=numpy.frombuffer(mystr,dtype=int2dtype(mytype),count=nframe*int(numpy.prod(sz)),offset=icur)
+    return hdr[0]<0,numpy.reshape(vec,[nframe]+sz)
+
+def _read_to_shm(fname):
+    #runs in a pool worker.  decode straight into a fresh shared memory block so the parent
+    #only gets handed its name instead of a pickled copy of the data.
+    for myname in _candidate_fnames(fname):
+        if os.path.isfile(myname):
+            break
+    else:
+        print('Could not find scio file ' + fname)
+        return None
+    try:
+        if _is_compressed(myname):
+            mystr=_read_file_as_string(myname)
+            if numpy.frombuffer(mystr[:4],dtype='int32')[0]==SCIO_V2_MAGIC:
+                diff,mat=False,_read_v2_from_string(mystr)
+            else:
+                diff,mat=_frames_from_string(mystr)
+        elif _file_version(myname)==2:
+            diff,mat=False,read(myname,strict=True)
+        else:
+            f=open(myname,'rb')
+            diff=_read_header(f)[0]
+            f.close()
+            mat=open_mmap(myname)
+        if mat is None:
+            #the readers above have already said why
+            return None
+    except Exception:
+        print('File ',myname,' appears to be garbled.')
+        return None
+    dtype=mat.dtype
+    if diff:
+        dtype=numpy.cumsum(mat[:0],0).dtype
+    nbyte=mat.shape[0]*int(numpy.prod(mat.shape[1:]))*dtype.itemsize
+    if nbyte==0:
+        return None,mat.shape,dtype.str
+    shm=shared_memory.SharedMemory(create=True,size=nbyte)
+    out=numpy.ndarray(mat.shape,dtype=dtype,buffer=shm.buf)
+    if diff:
+        numpy.cumsum(mat,0,out=out)
+    else:
+        out[...]=mat
+    del out
+    shm.close()
+    return shm.name,mat.shape,dtype.str
+
+class read_pool:
+    """Read many scio files in parallel with a worker pool that lives as long as this object.
+
+    Workers decode each file into shared memory and the parent stitches them into a single
+    array, so decoded data is never pickled back through a pipe.  Use close(), or use it as
+    a context manager, to shut the pool down."""
+    def __init__(self,ncpu=0):
+        if ncpu==0:
+            ncpu=multiprocessing.cpu_count()
+        #workers have to share our resource tracker, otherwise they clean up the shared
+        #memory they created as soon as they exit
+        resource_tracker.ensure_running()
+        self.pool=multiprocessing.Pool(ncpu)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def close(self):
+        if not(self.pool is None):
+            self.pool.close()
+            self.pool.join()
+            self.pool=None
+
+    def read_files(self,fnames):
+        """Read fnames and return their frames concatenated in the order given."""
+        blocks=self.pool.map(_read_to_shm,fnames)
+        shape=None
+        nframe=0
+        for i,block in enumerate(blocks):
+            if block is None:
+                continue
+            if shape is None:
+                shape=block[1][1:]
+                dtype=numpy.dtype(block[2])
+            if block[1][1:]!=shape or numpy.dtype(block[2])!=dtype:
+                print('Frame shape/dtype of ' + fnames[i] + ' does not match ' + repr(shape) + ', skipping it.')
+                _free_shm(block[0])
+                blocks[i]=None
+                continue
+            nframe=nframe+block[1][0]
+        if shape is None:
+            return None
+        out=numpy.empty([nframe]+list(shape),dtype=dtype)
+        icur=0
+        for block in blocks:
+            if block is None or block[0] is None:
+                continue
+            shm=shared_memory.SharedMemory(name=block[0])
+            out[icur:icur+block[1][0]]=numpy.ndarray(block[1],dtype=dtype,buffer=shm.buf)
+            icur=icur+block[1][0]
+            shm.close()
+            shm.unlink()
+        return out
 
+    def read_dirs(self,dirs,name):
+        """Read file `name` (e.g. 'pol00.scio') out of each dump_spectra directory in dirs.
 
+        Directories are put in time order by their ctime names before concatenating."""
+        dirs=sorted(dirs,key=_dir_time)
+        return self.read_files([os.path.join(d,name) for d in dirs])
+
+def _free_shm(name):
+    if name is None:
+        return
+    shm=shared_memory.SharedMemory(name=name)
+    shm.close()
+    shm.unlink()
+
+def _dir_time(dirname):
+    try:
+        return float(os.path.basename(os.path.normpath(dirname)))
+    except ValueError:
+        return float('inf')
+
+
+
+#dtype codes are +nbyte for floats, -nbyte for ints, -(100+nbyte) for unsigned ints
+#and 200+nbyte for complex
 def int2dtype(myint):
     if (myint==8):
         return 'float64'
     if (myint==4):
         return 'float32'
+    if (myint==2):
+        return 'float16'
+    if (myint==-1):
+        return 'int8'
+    if (myint==-2):
+        return 'int16'
     if (myint==-4):
         return 'int32'
     if (myint==-8):
         return 'int64'
+    if (myint==-101):
+        return 'uint8'
+    if (myint==-102):
+        return 'uint16'
     if (myint==-104):
         return 'uint32'
     if (myint==-108):
         return 'uint64'
+    if (myint==208):
+        return 'complex64'
+    if (myint==216):
+        return 'complex128'
     
 def int2nbyte(myint):
     nbyte=numpy.abs(myint)
+    if nbyte>200:
+        nbyte=nbyte-200
     if nbyte>100:
         nbyte=nbyte-100
     return nbyte
 
 def dtype2int(dtype_str):
     
-    if (type(dtype_str)!=numpy.dtype):
+    if not(isinstance(dtype_str,numpy.dtype)):
         dtype_str=dtype_str.dtype
 
-    aa=numpy.zeros(1,dtype='float64')
-    if (dtype_str==aa.dtype):
-        return 8
-
-    aa=numpy.zeros(1,dtype='float32')
-    if (dtype_str==aa.dtype):
-        return 4
-    
-
-    aa=numpy.zeros(1,dtype='int32')
-    if (dtype_str==aa.dtype):
-        return -4
-    
-    aa=numpy.zeros(1,dtype='int64')
-    if (dtype_str==aa.dtype):
-        return -8
-
-    aa=numpy.zeros(1,dtype='uint32')
-    if (dtype_str==aa.dtype):
-        return -104
-
-    aa=numpy.zeros(1,dtype='uint64')
-    if (dtype_str==aa.dtype):
-        return -108
+    for myint in [8,4,2,-1,-2,-4,-8,-101,-102,-104,-108,208,216]:
+        if (dtype_str==numpy.dtype(int2dtype(myint))):
+            return myint
     
     print('unknown dtype')
     return 0
-
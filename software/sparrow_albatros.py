@@ -1,9 +1,15 @@
+import collections
 import os
 import struct
+import threading
 import time
 import numpy as np
 import ads5404
 import adf4351
+try:
+    from katcp import Message as KatcpMessage # comes with casperfpga
+except ImportError:
+    KatcpMessage = None
 
 # Design register names
 SS_NAME = "ss_adc"
@@ -15,6 +21,33 @@ def str2ip(ip):
         ipint += (iplist[i] << (8*(3-i)))
     return ipint
 
+def struct_dtype(struct_format):
+    """
+    numpy dtype and count equivalent to a struct format of one repeated type,
+    e.g. ">2048q" gives (dtype(">i8"), 2048).
+    """
+    order = struct_format[0] if struct_format[0] in "<>!=@" else "="
+    code = struct_format.lstrip("<>!=@")
+    count = int(code[:-1]) if len(code) > 1 else 1
+    return np.dtype({"!": ">", "@": "="}.get(order, order) + code[-1]), count
+
+def decode(data, dtype, count=-1, out=None, native=True):
+    """
+    Decode bytes read from the FPGA without building Python ints.
+
+    :param out: Array to convert the values into (byteswapping as they are
+        copied), so the same memory can be reused for every read.
+    :param native: Without out, return a new native byte order array if True,
+        else a read-only view of data, no copy at all.
+    """
+    v = np.frombuffer(data, dtype=dtype, count=count)
+    if out is not None:
+        out[...] = v
+        return out
+    if native:
+        return v.astype(v.dtype.newbyteorder("="))
+    return v
+
 def ip2str(ipint):
     ip=""
     for i in range(4):
@@ -109,7 +142,7 @@ class SparrowAlbatros():
         time.sleep(0.3)
         self.adc.power_enable()
 
-    def get_adc_snapshot(self, use_pps_trigger=False):
+    def get_adc_snapshot(self, use_pps_trigger=False, out=None, native=True):
         """
         Get a snapshot of ADC samples simultaneously captured from
         both ADC channels.
@@ -118,18 +151,29 @@ class SparrowAlbatros():
             start capture. Otherwise, capture immediately.
         :type use_pps_trigger: bool
 
+        :param out: Optional array of the snapshot's length (both channels)
+            to decode into, reused between calls, e.g. int16 to save memory.
+            x and y are then strided views of it, in its dtype.
+        :type out: numpy.ndarray
+
+        :param native: If False (and no out), x and y are int16 views of the
+            raw big-endian bytes, no copy at all.
+        :type native: bool
+
         :return: x, y; a pair of numpy arrays containing a snapshot of ADC
-            samples from ADC channel 0 and 1, respectively.
+            samples from ADC channel 0 and 1, respectively. int64 by default,
+            as always, so squares and sums of the samples don't overflow.
         :rtype: (numpy.ndarray, numpy.ndarray)
         """
         if not SS_NAME in self.cfpga.snapshots.keys():
             raise RuntimeError("%s not found in design. Have you provided an appropriate .fpg file?" % SS_NAME)
         ss = self.cfpga.snapshots[SS_NAME]
         d, t = ss.read_raw(man_trig=not use_pps_trigger)    
-        v = np.array(struct.unpack(">%dh" % (d["length"]//2), d["data"]))
-        x = v[0::2]
-        y = v[1::2]
-        return x, y
+        if out is None and native:
+            v = decode(d["data"], ">i2", d["length"]//2, native=False)
+            return v[0::2].astype(np.int64), v[1::2].astype(np.int64)
+        v = decode(d["data"], ">i2", d["length"]//2, out=out, native=native)
+        return v[0::2], v[1::2]
 
 class AlbatrosDigitizer(SparrowAlbatros):
     def __init__(self, cfpga, fpgfile=None, adc_clk=250., logger=None):
@@ -138,6 +182,7 @@ class AlbatrosDigitizer(SparrowAlbatros):
         """
         super().__init__(cfpga, fpgfile, adc_clk)
         self.logger = logger # TODO: sort out logging, default logger?
+        self.transactions = collections.deque(maxlen=100) # records of committed RegisterTransactions
         return 
 
     def print_regs(self):
@@ -177,19 +222,14 @@ class AlbatrosDigitizer(SparrowAlbatros):
         internal state to zero that the sync pulse sets to one. Without
         doing pack_rst and cnt_rst before pulseing the sync, things are 
         not properly synced up and bad things happen."""
-        self.logger.info("Resetting packetizer")
-        self.cfpga.registers.pack_rst.write_int(0)
-        self.cfpga.registers.pack_rst.write_int(1)
-        self.cfpga.registers.pack_rst.write_int(0)
-        self.logger.info("Resetting acc control and syncing")
-        self.cfpga.registers.cnt_rst.write_int(0) # Acc control reset pulse 
-        self.cfpga.registers.cnt_rst.write_int(1)
-        self.cfpga.registers.cnt_rst.write_int(0)
+        self.logger.info("Resetting packetizer, acc control")
+        with self.transaction("reset", verify=False) as tx:
+            tx.pulse("pack_rst")
+            tx.pulse("cnt_rst") # Acc control reset pulse
         self.logger.info("Sending pulse")
         time.sleep(0.3)
-        self.cfpga.registers.sync.write_int(0) # Sync pulse must come after acc cntrl reset
-        self.cfpga.registers.sync.write_int(1) 
-        self.cfpga.registers.sync.write_int(0) 
+        with self.transaction("sync", verify=False) as tx:
+            tx.pulse("sync") # Sync pulse must come after acc cntrl reset
 
     def setup(self):
         self.logger.info("Programming FPGA")
@@ -237,25 +277,28 @@ class AlbatrosDigitizer(SparrowAlbatros):
         # Need to set the ADC gain?
         # Get info from and set registers 
         self.logger.info(f"FPGA clock: {self.cfpga.estimate_fpga_clock():.2f}")
-        self.logger.info(f"Set FFT shift schedule to {fftshift:b}")
-        self.cfpga.registers.pfb_fft_shift.write_int(fftshift)
+        # All the settings go out in one batch and are read back in another
+        with self.transaction("tune") as tx:
+            self.logger.info(f"Set FFT shift schedule to {fftshift:b}")
+            tx.write_int("pfb_fft_shift", fftshift)
+            self.logger.info(f"Set correlator accumulation length to {acc_len}")
+            tx.write_int("acc_len", acc_len)
+            # This firmware only has 4-bit qutnziation
+            self.logger.info("Reset GBE (UDP packetizer)")
+            tx.write_int("gbe_rst", 1)
+            tx.write_int("gbe_en", 0)
+            self.logger.info(f"Set spectra-per-packet to {spectra_per_packet}")
+            tx.write_int("packetiser_spectra_per_packet", spectra_per_packet)
+            self.logger.info(f"Set bytes-per-spectrum to {bytes_per_spectrum}")
+            tx.write_int("packetiser_bytes_per_spectrum", bytes_per_spectrum)
+            self.logger.info(f"Setting destination MAC address to {dest_mac}")
+            # TODO: set destination MAC address
+            self.logger.info(f"Set destination IP address and port to {dest_ip}:{dest_prt}")
+            tx.write_int("dest_ip", str2ip(dest_ip))
+            tx.write_int("dest_prt", dest_prt)
+            # Do we need to set mac address?
+        self.logger.info(f"Tuning registers written and verified in {self.transactions[-1]['latency']*1e3:.1f} ms")
         fft_of_count_init = self.cfpga.registers.fft_of_count.read_uint() # start counting fft overflows above this number
-        self.logger.info(f"Set correlator accumulation length to {acc_len}")
-        self.cfpga.registers.acc_len.write_int(acc_len)
-        # This firmware only has 4-bit qutnziation
-        self.logger.info("Reset GBE (UDP packetizer)")
-        self.cfpga.registers.gbe_rst.write_int(1)
-        self.cfpga.registers.gbe_en.write_int(0)
-        self.logger.info(f"Set spectra-per-packet to {spectra_per_packet}")
-        self.cfpga.registers.packetiser_spectra_per_packet.write_int(spectra_per_packet)
-        self.logger.info(f"Set bytes-per-spectrum to {bytes_per_spectrum}")
-        self.cfpga.registers.packetiser_bytes_per_spectrum.write_int(bytes_per_spectrum)
-        self.logger.info(f"Setting destination MAC address to {dest_mac}")
-        # TODO: set destination MAC address
-        self.logger.info(f"Set destination IP address and port to {dest_ip}:{dest_prt}")
-        self.cfpga.registers.dest_ip.write_int(str2ip(dest_ip))
-        self.cfpga.registers.dest_prt.write_int(dest_prt)
-        # Do we need to set mac address?
         self.sync_pulse()
         fft_of_count = self.cfpga.registers.fft_of_count.read_uint() - fft_of_count_init
         if fft_of_count != 0:
@@ -263,9 +306,10 @@ class AlbatrosDigitizer(SparrowAlbatros):
         else:
             self.logger.info(f"No FFT overflows detected")
         self.logger.info("Enabling 1 GbE output")
-        self.cfpga.registers.gbe_en.write_int(1)
-        #self.logger.info("Leaving GBE reset high; pull it down manually once you think the negotiation has happened well!")
-        self.cfpga.registers.gbe_rst.write_int(0)
+        with self.transaction("gbe_enable") as tx:
+            tx.write_int("gbe_en", 1)
+            #self.logger.info("Leaving GBE reset high; pull it down manually once you think the negotiation has happened well!")
+            tx.write_int("gbe_rst", 0)
         gbe_overflow = self.cfpga.registers.tx_of_cnt.read_uint()
         if gbe_overflow:
             self.logger.warning(f"GbE transmit overflowing: count={gbe_overflow}")
@@ -278,12 +322,124 @@ class AlbatrosDigitizer(SparrowAlbatros):
         self.setup()
         self.tune(**kwargs)
 
-    def read_pols(self, pols, struct_format=">2048q"):
+    def make_pol_buffers(self, pols, struct_format=">2048q"):
+        """Native byte order arrays to pass as `out` to read_pols and read_accumulation."""
+        dtype, count = struct_dtype(struct_format)
+        return {pol: np.empty(count, dtype=dtype.newbyteorder("=")) for pol in pols}
+
+    def read_pols(self, pols, struct_format=">2048q", out=None):
+        """
+        Read accumulator BRAMs.
+
+        :param out: Optional dict of arrays from make_pol_buffers to decode
+            into, the same arrays are returned, overwritten on every call.
+        """
+        dtype, count = struct_dtype(struct_format)
         pols_dict = {}
         for pol in pols:
-            pols_dict[pol] = np.array(struct.unpack(struct_format, self.cfpga.read(pol, 2048*8)), dtype="int64")
+            data = self.cfpga.read(pol, dtype.itemsize*count)
+            pols_dict[pol] = decode(data, dtype, count, out=None if out is None else out[pol])
         return pols_dict
 
+    def _katcp_batch(self, requests, timeout=5.):
+        """
+        Send KATCP requests back to back and wait for all the replies, or
+        return None if the transport can't pipeline (then the caller falls
+        back to plain casperfpga calls). The server handles them in order.
+
+        :param requests: List of (request name, args tuple).
+        :return: List of reply messages, in the order of requests.
+        """
+        transport = getattr(self.cfpga, "transport", None)
+        if KatcpMessage is None or not hasattr(transport, "callback_request"):
+            return None
+        replies = [None]*len(requests)
+        remaining = [len(requests)]
+        lock = threading.Lock()
+        done = threading.Event()
+        def reply_cb(msg, i):
+            replies[i] = msg
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    done.set()
+        for i, (name, args) in enumerate(requests):
+            transport.callback_request(KatcpMessage.request(name, *args),
+                                       reply_cb=reply_cb, user_data=(i,), timeout=timeout)
+        if not done.wait(timeout):
+            raise RuntimeError(f"Timed out waiting for {remaining[0]} of {len(requests)} KATCP replies")
+        for (name, args), msg in zip(requests, replies):
+            if not msg.reply_ok():
+                raise RuntimeError(f"KATCP {name} of {args[0]} failed: {msg.arguments}")
+        return replies
+
+    def read_devices(self, reads, timeout=5.):
+        """
+        Read several devices with as few round trips as the transport allows.
+
+        Over KATCP every ?read request is sent before waiting for any reply, so
+        the whole batch costs about one round trip instead of one per device.
+        Other transports (or no katcp module) fall back to one cfpga.read each.
+
+        :param reads: List of (device name, number of bytes) to read from offset 0.
+        :param timeout: Seconds to wait for all the replies.
+
+        :return: List of bytes, in the order of reads.
+        """
+        replies = self._katcp_batch([("read", (dev, "0", str(size))) for dev, size in reads], timeout)
+        if replies is None:
+            return [self.cfpga.read(dev, size) for dev, size in reads]
+        return [msg.arguments[1] for msg in replies]
+
+    def write_devices(self, writes, timeout=5.):
+        """
+        Blind writes of several devices in one batch, the counterpart of
+        read_devices. They happen in the order given, so a 0, 1, 0 sequence
+        to one register is still a pulse.
+
+        :param writes: List of (device name, bytes) to write at offset 0.
+        :param timeout: Seconds to wait for all the replies.
+        """
+        replies = self._katcp_batch([("write", (dev, "0", data)) for dev, data in writes], timeout)
+        if replies is None:
+            for dev, data in writes:
+                self.cfpga.blindwrite(dev, data)
+
+    def transaction(self, name, verify=True):
+        """A RegisterTransaction on this digitizer, use it as a context manager."""
+        return RegisterTransaction(self, name, verify)
+
+    def read_accumulation(self, pols, regs, struct_format=">2048q", out=None):
+        """
+        Read the metadata registers, the pols and the registers again in a
+        single batch (see read_devices), keeping the window in which the
+        accumulation can turn over as short as possible.
+
+        :param pols: Pol BRAM names, e.g. ["pol00", "pol11", "pol01r", "pol01i"].
+        :param regs: Register names, read as uint like read_registers does.
+        :param out: Optional dict of arrays from make_pol_buffers to decode the pols into.
+
+        :return: (pols dict, registers before dict, registers after dict, timing
+            dict with the system times "start" and "stop" around the batch,
+            "latency", their difference in seconds, and the time.monotonic_ns()
+            values "start_mono_ns" and "stop_mono_ns", for timing.GpsClock)
+        """
+        dtype, count = struct_dtype(struct_format)
+        nbytes = dtype.itemsize*count
+        reads = [(r, 4) for r in regs] + [(p, nbytes) for p in pols] + [(r, 4) for r in regs]
+        mono_start = time.monotonic_ns()
+        t_start = time.time()
+        data = self.read_devices(reads)
+        t_stop = time.time()
+        mono_stop = time.monotonic_ns()
+        nreg = len(regs)
+        regs_start = {r: np.array(struct.unpack(">I", d)[0]) for r, d in zip(regs, data[:nreg])}
+        regs_end = {r: np.array(struct.unpack(">I", d)[0]) for r, d in zip(regs, data[nreg + len(pols):])}
+        pols_dict = {p: decode(d, dtype, count, out=None if out is None else out[p])
+                     for p, d in zip(pols, data[nreg:nreg + len(pols)])}
+        return pols_dict, regs_start, regs_end, {"start": t_start, "stop": t_stop, "latency": t_stop - t_start,
+                                                 "start_mono_ns": mono_start, "stop_mono_ns": mono_stop}
+
     def get_optimal_coeffs_from_acc(self, chans):
         """Reads accumulator to set 4-bit digital gain coefficients
 
@@ -350,6 +506,10 @@ class AlbatrosDigitizer(SparrowAlbatros):
         self.logger.warning("get_adc_stats not yet implemented")
         return None
 
+    def watch_accumulations(self, **kwargs):
+        """An AccumulationWatcher on this digitizer, see its constructor for kwargs."""
+        return AccumulationWatcher(self, **kwargs)
+
     def read_registers(self, regs):
         """regs is a list of register names, reads uint and returns dict of vals"""
         reg_dict = {}
@@ -357,9 +517,243 @@ class AlbatrosDigitizer(SparrowAlbatros):
             reg_dict[r] = np.array(self.cfpga.registers[r].read_uint())
         return reg_dict
 
+class RegisterTransaction():
+    """
+    Register writes collected and sent in one batch (AlbatrosDigitizer.write_devices),
+    optionally followed by one batch reading every written register back.
 
+    Plain write_int costs a round trip per write (two without blindwrite, and
+    casperfpga's own check only compares the readback of that one write). Here
+    a whole block of settings costs about two round trips, and a register
+    which doesn't hold its last written value raises a RuntimeError. Writes
+    happen in the order they were added, when the block commits, so reads in
+    between see the old values.
 
+    Each commit appends a record to sparrow.transactions with the number of
+    writes and the write, verify and total latency in seconds.
 
+    Usage::
 
+        with sparrow.transaction("packetizer") as tx:
+            tx.write_int("gbe_en", 0)
+            tx.pulse("pack_rst")
+    """
+    def __init__(self, sparrow, name, verify=True):
+        """
+        :param sparrow: AlbatrosDigitizer to write to.
+        :param name: Name for the log and the transaction record.
+        :param verify: Read the registers back after writing.
+        """
+        self.sparrow = sparrow
+        self.name = name
+        self.verify = verify
+        self.writes = [] # (register, value) in order
+        self.committed = False
+
+    def write_int(self, reg, value):
+        """Queue a write of a 32-bit integer, signed or unsigned, as cfpga.write_int packs it."""
+        self.writes.append((reg, int(value)))
+
+    def pulse(self, reg):
+        """Queue a 0, 1, 0 pulse on a register."""
+        for v in (0, 1, 0):
+            self.write_int(reg, v)
+
+    def commit(self):
+        """Send the writes and verify them, returns the transaction record."""
+        if self.committed:
+            raise RuntimeError(f"Transaction {self.name} already committed")
+        self.committed = True
+        t0 = time.perf_counter()
+        self.sparrow.write_devices([(r, struct.pack(">i" if v < 0 else ">I", v)) for r, v in self.writes])
+        t1 = time.perf_counter()
+        expected = dict(self.writes) # last value written to each register
+        mismatches = {}
+        if self.verify and expected:
+            regs = list(expected)
+            data = self.sparrow.read_devices([(r, 4) for r in regs])
+            for r, d in zip(regs, data):
+                got = struct.unpack(">I", d)[0]
+                if got != expected[r] & 0xffffffff:
+                    mismatches[r] = (expected[r], got)
+        t2 = time.perf_counter()
+        record = {"name": self.name, "writes": len(self.writes), "verified": self.verify and not mismatches,
+                  "write_latency": t1 - t0, "verify_latency": t2 - t1, "latency": t2 - t0}
+        self.sparrow.transactions.append(record)
+        if self.sparrow.logger is not None:
+            self.sparrow.logger.debug(f"Transaction {self.name}: {len(self.writes)} writes in {(t1 - t0)*1e3:.2f} ms, "
+                                      f"verify {(t2 - t1)*1e3:.2f} ms")
+        if mismatches:
+            raise RuntimeError(f"Transaction {self.name}: registers don't hold the values written, (written, read) {mismatches}")
+        return record
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        return False
+
+class AccumulationWatcher():
+    """
+    Waits for accumulations to complete without polling acc_cnt all the time.
+
+    The accumulation period is acc_len*2048 FPGA clocks. The watcher fits the
+    times at which acc_cnt was seen to tick against acc_cnt, sleeps until
+    `guard` seconds before the next predicted tick and only then polls acc_cnt
+    every `poll` seconds, so every tick is caught within about one poll (plus
+    a register read) of happening. Each observed tick refines the fit, which
+    absorbs any error in the clock estimate. Until the first tick is seen it
+    polls only every `first_poll` seconds, and that tick just aims the next
+    wait (from the nominal period), it isn't fit.
+
+    Usage::
+
+        watcher = sparrow.watch_accumulations()
+        while True:
+            acc_cnt = watcher.wait()
+            pols = sparrow.read_pols(pols)
+    """
+    def __init__(self, sparrow, fpga_clk_mhz=None, guard=0.01, poll=0.002, nfit=32, first_poll=0.025, logger=None):
+        """
+        :param sparrow: AlbatrosDigitizer to watch.
+        :param fpga_clk_mhz: FPGA clock, measured with estimate_fpga_clock if None.
+        :param guard: Seconds before the predicted tick to start polling, doubled
+            (up to a quarter period) whenever a tick is missed by waking too late.
+        :param poll: Seconds between acc_cnt reads while waiting for the tick.
+        :param nfit: Number of recent ticks the period and phase are fit to.
+        :param first_poll: Seconds between acc_cnt reads while looking for the
+            first tick, before there is anything to predict from.
+        """
+        self.sparrow = sparrow
+        self.logger = logger if logger is not None else sparrow.logger
+        if fpga_clk_mhz is None:
+            fpga_clk_mhz = sparrow.cfpga.estimate_fpga_clock()
+        self.fpga_clk_mhz = fpga_clk_mhz
+        self.acc_len = sparrow.cfpga.registers.acc_len.read_uint()
+        self.nominal_period = self.acc_len*2048/(fpga_clk_mhz*1e6)
+        self.period = self.nominal_period
+        self.guard_min = guard
+        self.guard = guard
+        self.poll = poll
+        self.first_poll = max(poll, first_poll)
+        self.coarse_tick = None # (acc_cnt, monotonic time) of the first tick, found polling every first_poll
+        self.ticks = collections.deque(maxlen=nfit) # (acc_cnt, monotonic time of tick)
+        self.acc_cnt = None
+        self.jitter = [] # observed minus predicted tick time
+        self.latency = [] # return time minus tick time
+        self.npoll = 0
+        self.nwait = 0
+        self.nmissed = 0 # accumulations that completed without wait returning them
+        self.nlate = 0 # wakeups after the tick had already happened
+        self.nreset = 0 # times acc_cnt went backwards
+
+    def _read_acc_cnt(self):
+        return self.sparrow.cfpga.registers.acc_cnt.read_uint()
+
+    def predict(self, acc_cnt):
+        """Monotonic time at which acc_cnt should tick over to acc_cnt."""
+        if len(self.ticks) == 0:
+            return None
+        counts, times = np.array(self.ticks, dtype=np.float64).T
+        if len(self.ticks) >= 2 and counts[-1] > counts[0]:
+            self.period, t0 = np.polyfit(counts - counts[-1], times, 1)
+        else:
+            t0 = times[-1]
+        return t0 + (acc_cnt - counts[-1])*self.period
+
+    def _poll_until_tick(self, deadline, poll):
+        """Read acc_cnt every `poll` seconds until it changes, return it, the time of the read and the number of reads."""
+        nread = 0
+        while True:
+            last_read = time.monotonic()
+            acc_cnt = self._read_acc_cnt()
+            nread += 1
+            if acc_cnt != self.acc_cnt or (deadline is not None and last_read >= deadline):
+                self.npoll += nread
+                return acc_cnt, last_read, nread
+            time.sleep(poll)
+
+    def wait(self, timeout=None):
+        """
+        Block until the next accumulation is complete.
 
-
+        :param timeout: Seconds to give up after, returning None.
+        :return: The new acc_cnt, or None on timeout.
+        """
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        if self.acc_cnt is None:
+            # find where we are: the first tick we see anchors the fit
+            self.acc_cnt = self._read_acc_cnt()
+            self.npoll += 1
+        predicted = self.predict(self.acc_cnt + 1)
+        guard = self.guard
+        poll = self.poll
+        searching = False
+        if predicted is None and self.coarse_tick is not None:
+            # only the coarsely timed first tick so far, the nominal period gets us close to the next
+            coarse_cnt, coarse_time = self.coarse_tick
+            predicted = coarse_time + (self.acc_cnt + 1 - coarse_cnt)*self.period
+            guard += self.first_poll
+        elif predicted is None:
+            # nothing to predict from yet, look for the first tick without flooding the bus
+            poll = self.first_poll
+            searching = True
+        if predicted is not None:
+            wake = predicted - guard
+            if deadline is not None:
+                wake = min(wake, deadline)
+            if wake > start:
+                time.sleep(wake - start)
+        acc_cnt, seen, nread = self._poll_until_tick(deadline, poll)
+        if acc_cnt == self.acc_cnt:
+            return None
+        if acc_cnt < self.acc_cnt:
+            # counter was reset (sync pulse, cnt_rst, reprogramming), the old ticks no longer apply
+            self.logger.warning(f"acc_cnt went back from {self.acc_cnt} to {acc_cnt}, restarting the accumulation fit")
+            self.nreset += 1
+            self.ticks.clear()
+            self.coarse_tick = None
+            self.guard = self.guard_min
+            self.acc_cnt = acc_cnt
+            # the accumulation in progress started at the reset, wait for it to complete
+            return self.wait(None if deadline is None else max(0., deadline - time.monotonic()))
+        self.nwait += 1
+        if acc_cnt != self.acc_cnt + 1:
+            self.nmissed += acc_cnt - self.acc_cnt - 1
+            self.logger.warning(f"Missed {acc_cnt - self.acc_cnt - 1} accumulations")
+        if searching:
+            # known to within first_poll, good enough to aim the next wait but kept out of the fit
+            self.coarse_tick = (acc_cnt, seen - poll/2)
+        elif nread == 1:
+            # already ticked when we woke, so we only know it was before now
+            self.nlate += 1
+            self.guard = min(2*self.guard, self.period/4)
+            if len(self.ticks) == 0:
+                self.coarse_tick = (acc_cnt, seen - self.first_poll/2)
+        else:
+            # ticked between the last two reads
+            tick = seen - poll/2
+            if len(self.ticks) > 0 and acc_cnt == self.acc_cnt + 1:
+                self.jitter.append(tick - predicted)
+            self.ticks.append((acc_cnt, tick))
+            self.guard = max(self.guard_min, 0.9*self.guard)
+            self.latency.append(time.monotonic() - tick)
+        self.acc_cnt = acc_cnt
+        return acc_cnt
+
+    def stats(self):
+        """Period, tick prediction jitter and latency (seconds), poll and miss counts."""
+        jitter = np.array(self.jitter)
+        latency = np.array(self.latency)
+        return {"nominal_period": self.nominal_period, "period": self.period, "waits": self.nwait,
+                "polls_per_wait": self.npoll/max(self.nwait, 1), "missed": self.nmissed, "late_wakeups": self.nlate,
+                "resets": self.nreset,
+                "guard": self.guard,
+                "jitter_mean": float(jitter.mean()) if len(jitter) else 0.,
+                "jitter_std": float(jitter.std()) if len(jitter) else 0.,
+                "jitter_max": float(np.abs(jitter).max()) if len(jitter) else 0.,
+                "latency_mean": float(latency.mean()) if len(latency) else 0.,
+                "latency_max": float(latency.max()) if len(latency) else 0.}
@@ -0,0 +1,37 @@
+"""
+AccumulationWatcher against mock_fpga.MockFpga, run with python -m pytest software.
+"""
+import logging
+import mock_fpga
+import sparrow_albatros
+
+def make_watcher(acc_len=3000):
+    logger = logging.getLogger("test_accumulation_watcher")
+    fpga = mock_fpga.MockFpga(acc_len=acc_len) # ~49 ms accumulations
+    sparrow = sparrow_albatros.AlbatrosDigitizer(fpga, None, 250., logger)
+    return fpga, sparrow.watch_accumulations(fpga_clk_mhz=fpga.fpga_clk_mhz)
+
+def test_waits_follow_acc_cnt():
+    fpga, watcher = make_watcher()
+    counts = [watcher.wait(timeout=1) for i in range(6)]
+    assert None not in counts
+    assert counts == list(range(counts[0], counts[0] + 6))
+    assert watcher.stats()["missed"] == 0
+
+def test_acc_cnt_reset_restarts_fit():
+    fpga, watcher = make_watcher()
+    for i in range(6):
+        watcher.wait(timeout=1)
+    assert watcher.acc_cnt >= 6
+    fpga.write_int("sync", 1) # resets acc_cnt to 0, as sync_pulse does
+    fpga.write_int("sync", 0)
+    acc_cnt = watcher.wait(timeout=1)
+    stats = watcher.stats()
+    assert acc_cnt == 1
+    assert stats["resets"] == 1
+    assert stats["missed"] == 0
+    assert all(count <= acc_cnt for count, t in watcher.ticks)
+    for i in range(5):
+        assert watcher.wait(timeout=1) == acc_cnt + 1 + i
+    assert abs(watcher.period - watcher.nominal_period) < 0.1*watcher.nominal_period
+    assert watcher.stats()["missed"] == 0
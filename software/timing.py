@@ -0,0 +1,143 @@
+"""
+Sub-millisecond UTC from GPS fixes and the monotonic clock.
+
+Each NAV-PVT fix from the Leo Bodnar carries its UTC to the nanosecond
+(the whole second plus the nano field), and lbtools_l.GpsReader records the
+time.monotonic_ns() at which the report carrying it arrived. GpsClock fits
+UTC against the monotonic clock over the last `nfit` fixes (an offset and a
+rate, which absorbs the drift of the system oscillator), so any monotonic
+time, in particular now, converts to UTC without touching the USB device,
+with an uncertainty from the scatter of the fixes about the fit.
+
+The fixes arrive some time after the epoch they describe (receiver output and
+USB polling), `latency` is subtracted from the arrival times if it has been
+measured, otherwise that constant delay stays in the offset.
+
+Usage::
+
+    gps = lbtools_l.GpsReader().start()
+    clock = timing.GpsClock(gps)
+    utc, err = clock.now()
+"""
+import collections
+import time
+import numpy as np
+
+def fix_utc(fix):
+    """UTC of a GpsFix in seconds, with the nano field, or None if the fix's date and time aren't valid."""
+    nano, validity = fix.auxdat[0], fix.auxdat[1]
+    if validity[-1] != "1" or validity[-2] != "1": # validDate, validTime
+        return None
+    return fix.tstamp + nano
+
+class GpsClock():
+    def __init__(self, source=None, nfit=64, latency=0., min_err=1e-3, max_residual=0.1, logger=None):
+        """
+        :param source: Object with latest() returning the newest lbtools_l.GpsFix,
+            e.g. a GpsReader, polled on every call. If it also has fixes_since,
+            as GpsReader does, every fix since the last call is fit, however
+            rarely the clock is used. Fixes can also be added with add_fix.
+        :param nfit: Number of recent fixes fit.
+        :param latency: Seconds from a fix's epoch to its arrival, if known.
+        :param min_err: Uncertainty to quote until there are enough fixes to
+            estimate one.
+        :param max_residual: Seconds a fix may be off the fit before it is
+            rejected. After three rejections in a row the fit restarts (e.g.
+            after a leap second or a clock step).
+        """
+        self.source = source
+        self.latency = latency
+        self.min_err = min_err
+        self.max_residual = max_residual
+        self.logger = logger
+        self.fixes = collections.deque(maxlen=nfit) # (monotonic ns, utc)
+        self.last_mono_ns = None
+        self.nrejected = 0
+        self.nreject_run = 0
+        self._fit = None
+
+    def update(self):
+        """
+        Take the new fixes from the source: every one since the last update if
+        it keeps a history (GpsReader.fixes_since), otherwise just the latest.
+        """
+        if self.source is None:
+            return
+        if hasattr(self.source, "fixes_since"):
+            # only the last nfit can end up in the fit
+            fixes = self.source.fixes_since(self.last_mono_ns)[-self.fixes.maxlen:]
+        else:
+            fix = self.source.latest()
+            fixes = [] if fix is None or fix.mono_ns == self.last_mono_ns else [fix]
+        for fix in fixes:
+            self.last_mono_ns = fix.mono_ns
+            utc = fix_utc(fix)
+            if utc is not None:
+                self.add_fix(utc, fix.mono_ns)
+
+    def add_fix(self, utc, mono_ns):
+        """Add a fix: its UTC in seconds and the time.monotonic_ns() at which it arrived."""
+        mono_ns = mono_ns - int(self.latency*1e9)
+        if self._fit is not None:
+            predicted, err = self.to_utc(mono_ns)
+            if abs(utc - predicted) > self.max_residual:
+                self.nrejected += 1
+                self.nreject_run += 1
+                if self.nreject_run < 3:
+                    return
+                if self.logger is not None:
+                    self.logger.warning(f"GPS time jumped by {utc - predicted:.3f} s, restarting the clock fit")
+                self.fixes.clear()
+        self.nreject_run = 0
+        self.fixes.append((mono_ns, utc))
+        self._refit()
+
+    def _refit(self):
+        # work relative to the newest fix, so float64 keeps sub-microsecond precision
+        mono_ref, utc_ref = self.fixes[-1]
+        x = np.array([(m - mono_ref)*1e-9 for m, u in self.fixes])
+        y = np.array([u - utc_ref for m, u in self.fixes]) - x
+        n = len(x)
+        if n < 2:
+            self._fit = (mono_ref, utc_ref, 0., 0., 0., 0., None, n)
+            return
+        xmean = x.mean()
+        sxx = np.sum((x - xmean)**2)
+        rate = np.sum((x - xmean)*(y - y.mean()))/sxx if sxx > 0 else 0.
+        offset = y.mean() - rate*xmean
+        rms = np.sqrt(np.sum((y - offset - rate*x)**2)/(n - 2)) if n > 2 else None
+        self._fit = (mono_ref, utc_ref, offset, rate, xmean, sxx, rms, n)
+
+    def fit(self):
+        """The current fit, (mono_ref, utc_ref, offset, rate, xmean, sxx, rms, n), or None without fixes."""
+        return self._fit
+
+    def to_utc(self, mono_ns):
+        """
+        UTC at a time.monotonic_ns() value.
+
+        :return: (utc seconds, uncertainty seconds), or (None, None) without fixes.
+        """
+        if self._fit is None:
+            return None, None
+        mono_ref, utc_ref, offset, rate, xmean, sxx, rms, n = self._fit
+        x = (mono_ns - mono_ref)*1e-9
+        utc = utc_ref + x + offset + rate*x
+        if rms is None:
+            # one or two fixes: no scatter to go on, and the rate is a guess
+            return utc, self.min_err + 1e-5*abs(x)
+        # standard error of the fitted line at x, plus the scatter of a single fix
+        err = rms*np.sqrt(1 + 1/n + ((x - xmean)**2/sxx if sxx > 0 else 0.))
+        return utc, float(err)
+
+    def now(self):
+        """Current UTC from the fit: (utc seconds, uncertainty seconds), (None, None) if there are no fixes yet."""
+        self.update()
+        return self.to_utc(time.monotonic_ns())
+
+    def stats(self):
+        if self._fit is None:
+            return {"fixes": 0, "rejected": self.nrejected}
+        mono_ref, utc_ref, offset, rate, xmean, sxx, rms, n = self._fit
+        return {"fixes": n, "rejected": self.nrejected, "rate_ppm": float(rate*1e6),
+                "rms": None if rms is None else float(rms), "span": float(-xmean*2) if n > 1 else 0.}
@@ -0,0 +1,178 @@
+"""
+Streaming parser for the u-blox UBX protocol, as read from the Leo Bodnar.
+
+The USB reads are 64-byte pieces of the receiver's output stream, and a
+100-byte NAV-PVT packet always spans two or more of them, so UbxParser keeps
+the unconsumed tail of each read and prepends it to the next. Packets are
+found with bytes.find on the sync characters, checked against their
+Fletcher checksum and NAV-PVT payloads are decoded by a single precompiled
+struct.Struct into a NavPvt.
+
+Usage::
+
+    parser = UbxParser()
+    for report in reports:
+        for pvt in parser.feed(report):
+            print(pvt.utc, pvt.lat, pvt.lon)
+"""
+import datetime
+import itertools
+import struct
+
+SYNC = b"\xb5\x62"
+CLASS_NAV = 0x01
+ID_PVT = 0x07
+MAX_LENGTH = 2048 # longer than any message we expect, a length field beyond this is a false sync
+
+# UBX-NAV-PVT payload, u-blox 8 protocol
+NAV_PVT = struct.Struct("<IHBBBBBBIiBBBBiiiiIIiiiiiIIH6xihH")
+NAV_PVT_FIELDS = ("iTOW", "year", "month", "day", "hour", "minute", "second", "valid", "tAcc", "nano",
+                  "fixType", "flags", "flags2", "numSV", "lon_raw", "lat_raw", "height", "hMSL",
+                  "hAcc", "vAcc", "velN", "velE", "velD", "gSpeed", "headMot", "sAcc", "headAcc",
+                  "pDOP", "headVeh", "magDec", "magAcc")
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+def checksum(body):
+    """UBX 8-bit Fletcher checksum (ck_a, ck_b) of class, id, length and payload."""
+    return sum(body) & 0xff, sum(itertools.accumulate(body)) & 0xff
+
+class NavPvt():
+    """
+    One decoded NAV-PVT message, fields named as in the u-blox manual (raw
+    integer units: ms, ns, mm, 1e-7 deg), plus mono_ns, the time.monotonic_ns()
+    of the read that completed it, if the caller gave one.
+    """
+    __slots__ = NAV_PVT_FIELDS + ("mono_ns",)
+
+    def __init__(self, values, mono_ns=None):
+        for name, v in zip(NAV_PVT_FIELDS, values):
+            setattr(self, name, v)
+        self.mono_ns = mono_ns
+
+    @property
+    def valid_date(self):
+        return bool(self.valid & 0x01)
+
+    @property
+    def valid_time(self):
+        return bool(self.valid & 0x02)
+
+    @property
+    def gpstime(self):
+        """The whole-second UTC as a datetime, raises ValueError if the fields are out of range."""
+        return datetime.datetime(self.year, self.month, self.day, self.hour, self.minute, self.second)
+
+    @property
+    def tstamp(self):
+        """Whole-second Linux time."""
+        return (self.gpstime - _EPOCH).total_seconds()
+
+    @property
+    def utc(self):
+        """Linux time including the nano field."""
+        return self.tstamp + self.nano*1e-9
+
+    @property
+    def lat(self):
+        return self.lat_raw*1e-7
+
+    @property
+    def lon(self):
+        return self.lon_raw*1e-7
+
+    @property
+    def alt(self):
+        """Height above mean sea level in m."""
+        return self.hMSL*1e-3
+
+    def to_lb_read(self):
+        """(tstamp, (nano, validity, lon, lat, alt), gpstime) as lbtools_l.lb_read returns."""
+        validity = "{0:b}".format(self.valid)
+        validity = (4-len(validity))*'0'+validity
+        gpstime = self.gpstime
+        return (gpstime - _EPOCH).total_seconds(), (self.nano*1e-9, validity, self.lon, self.lat, self.alt), gpstime
+
+    def __repr__(self):
+        return f"NavPvt({self.year:04d}-{self.month:02d}-{self.day:02d}T{self.hour:02d}:{self.minute:02d}:{self.second:02d} nano={self.nano} lat={self.lat:.7f} lon={self.lon:.7f} fixType={self.fixType} numSV={self.numSV})"
+
+class UbxParser():
+    """
+    Feed it the stream a read at a time, get back the NAV-PVTs completed by
+    each read. Other messages are counted and skipped.
+    """
+    def __init__(self):
+        self.buf = bytearray()
+        self.npvt = 0
+        self.nother = 0
+        self.nbad = 0 # checksum failures
+        self.nskipped = 0 # bytes outside any packet
+
+    def feed(self, data, mono_ns=None):
+        """
+        :param data: bytes (or array of bytes) just read.
+        :param mono_ns: Time of the read, stored in the NavPvts it completes.
+        :return: List of NavPvt.
+        """
+        buf = self.buf
+        buf += data
+        out = []
+        pos = 0
+        n = len(buf)
+        while True:
+            i = buf.find(SYNC, pos)
+            if i < 0:
+                # keep a trailing first sync char, the second may be in the next read
+                keep = n - 1 if n > pos and buf[-1] == SYNC[0] else n
+                self.nskipped += keep - pos
+                pos = keep
+                break
+            self.nskipped += i - pos
+            if n - i < 6:
+                pos = i
+                break
+            length = buf[i+4] | buf[i+5] << 8
+            if length > MAX_LENGTH:
+                pos = i + 1
+                self.nbad += 1
+                continue
+            end = i + 8 + length
+            if end > n:
+                pos = i # incomplete, wait for more
+                break
+            body = buf[i+2:end-2]
+            if checksum(body) != (buf[end-2], buf[end-1]):
+                self.nbad += 1
+                pos = i + 1
+                continue
+            if buf[i+2] == CLASS_NAV and buf[i+3] == ID_PVT and length == NAV_PVT.size:
+                out.append(NavPvt(NAV_PVT.unpack_from(buf, i + 6), mono_ns))
+                self.npvt += 1
+            else:
+                self.nother += 1
+            pos = end
+        del buf[:pos]
+        return out
+
+    def stats(self):
+        return {"nav_pvt": self.npvt, "other": self.nother, "bad_checksum": self.nbad,
+                "skipped_bytes": self.nskipped, "buffered": len(self.buf)}
+
+def make_packet(cls, msg_id, payload):
+    """A UBX packet with its checksum."""
+    body = bytes([cls, msg_id]) + struct.pack("<H", len(payload)) + bytes(payload)
+    return SYNC + body + bytes(checksum(body))
+
+def make_nav_pvt(tstamp, lat=0., lon=0., alt=0., valid=0x07, nano=0, mono_ns=None):
+    """
+    A NAV-PVT packet as the receiver sends it every navigation epoch, for
+    lbtools_l.FakeLbDevice and benchmarks.
+
+    :param tstamp: Linux time of the fix, whole seconds.
+    """
+    t = _EPOCH + datetime.timedelta(seconds=int(tstamp))
+    values = dict.fromkeys(NAV_PVT_FIELDS, 0)
+    values.update(year=t.year, month=t.month, day=t.day, hour=t.hour, minute=t.minute, second=t.second,
+                  valid=valid, nano=nano, fixType=3, numSV=8, lon_raw=round(lon*1e7), lat_raw=round(lat*1e7),
+                  height=round(alt*1e3), hMSL=round(alt*1e3))
+    return make_packet(CLASS_NAV, ID_PVT, NAV_PVT.pack(*[values[f] for f in NAV_PVT_FIELDS]))